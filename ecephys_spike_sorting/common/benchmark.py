@@ -0,0 +1,518 @@
+"""
+Timing and memory benchmarks of the sorting modules on synthetic data
+
+Each module is run on a synthetic Kilosort output folder (see synthetic.py)
+at one or more scales, in a fresh process, and timed; a further run under
+tracemalloc gives the peak memory allocated by Python and numpy, and the
+peak resident set size of the process is recorded alongside it. Results
+are written to JSON together with the git commit, so runs from two commits
+can be compared:
+
+    python -m ecephys_spike_sorting.common.benchmark --scales small medium --output before.json
+    python -m ecephys_spike_sorting.common.benchmark --scales small medium --output after.json --compare before.json
+
+The synthetic folders are kept in --data_directory and are only regenerated
+when the generator arguments change. The large scale needs about 25 GB of
+disk for its AP band binary.
+
+A module that fails to import or run is reported with status 'error' and
+its exception, rather than stopping the suite.
+
+The in-process C_Waves engine (c_waves) can be timed against the C_Waves
+executable (c_waves_external) on the same synthetic data; the external
+run needs the folder holding runit.sh / runit.bat:
+
+    python -m ecephys_spike_sorting.common.benchmark --modules c_waves c_waves_external --c_waves_path /path/to/C_Waves
+
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import tempfile
+import argparse
+import contextlib
+import subprocess
+import tracemalloc
+import multiprocessing
+
+import numpy as np
+
+from .synthetic import load_or_make_kilosort_output
+
+
+SCALES = {'small' : {'num_units' : 32, 'duration' : 60.0, 'num_channels' : 64},
+          'medium' : {'num_units' : 150, 'duration' : 600.0, 'num_channels' : 192},
+          'large' : {'num_units' : 400, 'duration' : 900.0, 'num_channels' : 384}}
+
+DEFAULT_DATA_DIRECTORY = os.path.join(tempfile.gettempdir(), 'ecephys_benchmark_data')
+
+C_WAVES_SNR_UM = 160         # as in create_input_json
+
+
+def load_synthetic(manifest, include_pcs = False, convert_to_seconds = True):
+
+    from .utils import load_kilosort_data
+
+    return load_kilosort_data(manifest['kilosort_output_directory'],
+                              manifest['sample_rate'],
+                              convert_to_seconds = convert_to_seconds,
+                              include_pcs = include_pcs)
+
+
+def bench_quality_metrics(manifest):
+
+    from ..modules.quality_metrics._schemas import QualityMetricsParams
+    from ..modules.quality_metrics.metrics import calculate_metrics
+
+    params = QualityMetricsParams().load({})
+
+    spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
+    channel_pos, cluster_ids, cluster_quality, cluster_amplitude, pc_features, pc_feature_ind, template_features = \
+        load_synthetic(manifest, include_pcs = True)
+
+    calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes, channel_map, channel_pos,
+                      templates, pc_features, pc_feature_ind, params)
+
+
+def bench_mean_waveforms(manifest):
+
+    from scipy.io import loadmat
+    from .schemas import EphysParams
+    from .utils import open_binary
+    from ..modules.mean_waveforms._schemas import MeanWaveformParams
+    from ..modules.mean_waveforms.extract_waveforms import extract_waveforms
+
+    if manifest['ap_band_file'] is None:
+        raise FileNotFoundError('no AP band binary was generated')
+
+    ephys_params = EphysParams().load({})
+    params = MeanWaveformParams().load({'mean_waveforms_file' : 'mean_waveforms.npy'})
+
+    chanMap = loadmat(os.path.splitext(manifest['ap_band_file'])[0] + '_chanMap.mat')
+
+    data = open_binary(manifest['ap_band_file'], manifest['num_channels'])
+
+    spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
+    channel_pos, cluster_ids, cluster_quality, cluster_amplitude = \
+        load_synthetic(manifest, convert_to_seconds = False)
+
+    extract_waveforms(data, spike_times, spike_clusters, templates, channel_map,
+                      manifest['bit_volts'], manifest['sample_rate'], ephys_params['vertical_site_spacing'],
+                      np.squeeze(chanMap['xcoords']), np.squeeze(chanMap['ycoords']), params)
+
+
+def bench_kilosort_postprocessing(manifest):
+
+    from ..modules.kilosort_postprocessing._schemas import PostprocessingParams
+    from ..modules.kilosort_postprocessing.postprocessing import remove_double_counted_spikes
+
+    params = PostprocessingParams().load({})
+
+    spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
+    channel_pos, cluster_ids, cluster_quality, cluster_amplitude, pc_features, pc_feature_ind, template_features = \
+        load_synthetic(manifest, include_pcs = True, convert_to_seconds = False)
+
+    remove_double_counted_spikes(spike_times, spike_clusters, spike_templates, amplitudes, channel_map,
+                                 channel_pos, templates, pc_features, pc_feature_ind, template_features,
+                                 cluster_amplitude, manifest['sample_rate'], params)
+
+
+def bench_noise_templates(manifest):
+
+    from ..modules.noise_templates._schemas import NoiseWaveformParams
+    from ..modules.noise_templates.id_noise_templates import id_noise_templates
+
+    classifier_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'modules', 'noise_templates', 'rf_classifier.pkl')
+    params = NoiseWaveformParams().load({'classifier_path' : classifier_path})
+
+    spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
+    channel_pos, cluster_ids, cluster_quality, cluster_amplitude = \
+        load_synthetic(manifest)
+
+    id_noise_templates(np.unique(spike_clusters), templates, np.squeeze(channel_map), params)
+
+
+def bench_automerging(manifest):
+
+    from ..modules.automerging._schemas import AutomergingParams
+    from ..modules.automerging.automerging import automerging
+
+    params = AutomergingParams().load({})
+
+    spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
+    channel_pos, cluster_ids, cluster_quality, cluster_amplitude = \
+        load_synthetic(manifest)
+
+    automerging(spike_times, spike_clusters, cluster_ids, np.array(cluster_quality), templates, params)
+
+
+def bench_depth_estimation(manifest):
+
+    from ..modules.depth_estimation._schemas import DepthEstimationParams
+    from ..modules.depth_estimation.depth_estimation import find_surface_channel
+    from .synthetic import probe_geometry
+
+    if manifest['lfp_band_file'] is None:
+        raise FileNotFoundError('no LFP band binary was generated')
+
+    channel_pos = probe_geometry(manifest['num_channels'])
+    top = np.max(channel_pos[:, 1])
+
+    # saline lies above the synthetic brain surface
+    params = DepthEstimationParams().load({'save_figure' : False,
+                                           'figure_location' : os.path.join(manifest['kilosort_output_directory'], 'probe_depth.png'),
+                                           'saline_range_um' : [top - 0.1 * (top - manifest['surface_y']), top + 1]})
+    ephys_params = {'lfp_sample_rate' : manifest['lfp_sample_rate'], 'reference_channels' : []}
+
+    data = np.memmap(manifest['lfp_band_file'], dtype = 'int16', mode = 'r')
+    data = np.reshape(data, (data.size // manifest['num_channels'], manifest['num_channels']))
+
+    find_surface_channel(data, ephys_params, params, channel_pos[:, 0], channel_pos[:, 1],
+                         np.zeros((manifest['num_channels'],), dtype = 'int'))
+
+
+def c_waves_inputs(manifest):
+
+    """ Cluster table, spike times and labels, and site positions for the C_Waves benchmarks """
+
+    from scipy.io import loadmat
+    from .utils import sortResultsTable
+
+    if manifest['ap_band_file'] is None:
+        raise FileNotFoundError('no AP band binary was generated')
+
+    directory = manifest['kilosort_output_directory']
+
+    chanMap = loadmat(os.path.splitext(manifest['ap_band_file'])[0] + '_chanMap.mat')
+
+    return sortResultsTable(directory)[0], np.load(os.path.join(directory, 'spike_times.npy')), \
+        np.load(os.path.join(directory, 'spike_clusters.npy')), np.squeeze(chanMap['xcoords']), np.squeeze(chanMap['ycoords'])
+
+
+def bench_c_waves(manifest):
+
+    from .c_waves import calculate_c_waves, open_spikeglx_bin
+
+    clus_table, spike_times, spike_clusters, site_x, site_y = c_waves_inputs(manifest)
+
+    data, num_ap_channels = open_spikeglx_bin(manifest['ap_band_file'], manifest['num_channels'])
+
+    calculate_c_waves(data, spike_times, spike_clusters, clus_table, manifest['bit_volts'],
+                      snr_radius_um = C_WAVES_SNR_UM, site_x = site_x, site_y = site_y,
+                      num_channels = num_ap_channels)
+
+
+def bench_c_waves_external(manifest):
+
+    from .synthetic import write_spikeglx_meta, probe_geometry
+
+    c_waves_path = os.environ.get('C_WAVES_PATH')
+
+    if not c_waves_path:
+        raise FileNotFoundError('set C_WAVES_PATH (or pass --c_waves_path) to the folder holding the C_Waves executable')
+
+    executable = os.path.join(c_waves_path, 'runit.bat' if sys.platform.startswith('win') else 'runit.sh')
+
+    # folders generated before the .meta file was added to the synthetic data
+    meta_file = os.path.splitext(manifest['ap_band_file'])[0] + '.meta'
+    if not os.path.exists(meta_file):
+        write_spikeglx_meta(meta_file, manifest['num_channels'], int(manifest['duration'] * manifest['sample_rate']),
+                            manifest['sample_rate'], manifest['bit_volts'], probe_geometry(manifest['num_channels']))
+
+    clus_table = c_waves_inputs(manifest)[0]
+    directory = manifest['kilosort_output_directory']
+
+    with tempfile.TemporaryDirectory() as dest:
+
+        clus_table_npy = os.path.join(dest, 'clus_Table.npy')
+        np.save(clus_table_npy, clus_table)
+
+        subprocess.run([executable,
+                        '-spikeglx_bin=' + manifest['ap_band_file'],
+                        '-clus_table_npy=' + clus_table_npy,
+                        '-clus_time_npy=' + os.path.join(directory, 'spike_times.npy'),
+                        '-clus_lbl_npy=' + os.path.join(directory, 'spike_clusters.npy'),
+                        '-dest=' + dest,
+                        '-samples_per_spike=82',
+                        '-pre_samples=20',
+                        '-num_spikes=1000',
+                        '-snr_radius=8',
+                        '-snr_radius_um=' + repr(C_WAVES_SNR_UM)], check = True)
+
+
+BENCHMARKS = {'quality_metrics' : bench_quality_metrics,
+              'mean_waveforms' : bench_mean_waveforms,
+              'kilosort_postprocessing' : bench_kilosort_postprocessing,
+              'noise_templates' : bench_noise_templates,
+              'automerging' : bench_automerging,
+              'depth_estimation' : bench_depth_estimation,
+              'c_waves' : bench_c_waves,
+              'c_waves_external' : bench_c_waves_external}
+
+
+def max_rss_mb():
+
+    """ Peak resident set size of this process, or None where it isn't available """
+
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # kilobytes on Linux, bytes on macOS
+    return max_rss / 1024**2 if sys.platform == 'darwin' else max_rss / 1024
+
+
+def run_benchmark(module, manifest, repeat = 1, measure_memory = True):
+
+    """
+    Times one module on one synthetic folder, in this process
+
+    Inputs:
+    -------
+    module : String
+        Key of BENCHMARKS
+    manifest : dict
+        Returned by synthetic.make_kilosort_output
+    repeat : int
+        Number of timed runs
+    measure_memory : bool
+        Flags whether to make one further run under tracemalloc
+
+    Outputs:
+    --------
+    result : dict
+        status ('ok' or 'error'), times_s, best_s, peak_traced_mb, max_rss_mb and error
+
+    """
+
+    result = {'status' : 'ok', 'times_s' : [], 'best_s' : None, 'peak_traced_mb' : None,
+              'max_rss_mb' : None, 'error' : None}
+
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+
+            for i in range(repeat):
+                start = time.perf_counter()
+                BENCHMARKS[module](manifest)
+                result['times_s'].append(time.perf_counter() - start)
+
+            if measure_memory:
+                tracemalloc.start()
+                try:
+                    BENCHMARKS[module](manifest)
+                    result['peak_traced_mb'] = tracemalloc.get_traced_memory()[1] / 1024**2
+                finally:
+                    tracemalloc.stop()
+
+    except Exception as e:
+        result['status'] = 'error'
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+
+    if result['times_s']:
+        result['best_s'] = min(result['times_s'])
+
+    result['max_rss_mb'] = max_rss_mb()
+
+    return result
+
+
+def _run_in_child(connection, module, manifest, repeat, measure_memory):
+
+    connection.send(run_benchmark(module, manifest, repeat, measure_memory))
+    connection.close()
+
+
+def run_isolated(module, manifest, repeat = 1, measure_memory = True):
+
+    """ run_benchmark in a fresh process, so each module's peak RSS is its own """
+
+    context = multiprocessing.get_context('spawn')
+    receiver, sender = context.Pipe(duplex = False)
+
+    process = context.Process(target = _run_in_child, args = (sender, module, manifest, repeat, measure_memory))
+    process.start()
+    sender.close()
+
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = None
+
+    process.join()
+
+    if result is None:
+        result = {'status' : 'error', 'times_s' : [], 'best_s' : None, 'peak_traced_mb' : None,
+                  'max_rss_mb' : None, 'error' : 'process exited with code {}'.format(process.exitcode)}
+
+    return result
+
+
+def git_info():
+
+    """ Commit hash of the repository holding this package, and whether it has uncommitted changes """
+
+    repo = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd = repo, capture_output = True,
+                                text = True, check = True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd = repo,
+                                capture_output = True, text = True, check = True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+    return commit, len(status.strip()) > 0
+
+
+def run_benchmarks(modules = None, scales = ('small',), data_directory = DEFAULT_DATA_DIRECTORY,
+                   repeat = 1, measure_memory = True, isolate = True, scale_params = SCALES):
+
+    """
+    Runs every module at every scale
+
+    Inputs:
+    -------
+    modules : list of Strings (optional)
+        Keys of BENCHMARKS (default: all, with c_waves_external only if C_WAVES_PATH is set)
+    scales : list of Strings
+        Keys of scale_params
+    data_directory : String
+        Location of the synthetic folders, one per scale
+    repeat : int
+        Number of timed runs of each module
+    measure_memory : bool
+        Flags whether to measure peak traced memory
+    isolate : bool
+        Flags whether to run each module in a fresh process
+    scale_params : dict
+        Generator arguments for each scale
+
+    Outputs:
+    --------
+    report : dict
+        Environment, commit and per-module results, as written to JSON
+
+    """
+
+    if modules is None:
+        # the external C_Waves run is only included when the executable is available
+        modules = [module for module in BENCHMARKS if module != 'c_waves_external' or os.environ.get('C_WAVES_PATH')]
+
+    commit, dirty = git_info()
+
+    report = {'commit' : commit,
+              'dirty' : dirty,
+              'date' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'platform' : platform.platform(),
+              'python' : platform.python_version(),
+              'numpy' : np.__version__,
+              'cpu_count' : multiprocessing.cpu_count(),
+              'repeat' : repeat,
+              'scales' : {},
+              'results' : []}
+
+    for scale in scales:
+
+        print('Generating {} data...'.format(scale))
+
+        manifest = load_or_make_kilosort_output(os.path.join(data_directory, scale), **scale_params[scale])
+
+        report['scales'][scale] = dict(scale_params[scale], num_spikes = manifest['num_spikes'])
+
+        for module in modules:
+
+            print('  {:<24} '.format(module), end = '', flush = True)
+
+            if isolate:
+                result = run_isolated(module, manifest, repeat, measure_memory)
+            else:
+                result = run_benchmark(module, manifest, repeat, measure_memory)
+
+            if result['status'] == 'ok':
+                print('{:9.2f} s'.format(result['best_s']))
+            else:
+                print('error: ' + result['error'])
+
+            report['results'].append(dict(result, module = module, scale = scale))
+
+    return report
+
+
+def compare_results(baseline, current):
+
+    """
+    Ratios of best time and peak traced memory, current / baseline, for each module and scale both ran
+
+    """
+
+    previous = {(r['module'], r['scale']) : r for r in baseline['results'] if r['status'] == 'ok'}
+
+    rows = []
+
+    for result in current['results']:
+
+        before = previous.get((result['module'], result['scale']))
+
+        if before is None or result['status'] != 'ok':
+            continue
+
+        memory_ratio = None
+        if before['peak_traced_mb'] and result['peak_traced_mb'] is not None:
+            memory_ratio = result['peak_traced_mb'] / before['peak_traced_mb']
+
+        rows.append({'module' : result['module'],
+                     'scale' : result['scale'],
+                     'time_ratio' : result['best_s'] / before['best_s'],
+                     'memory_ratio' : memory_ratio})
+
+    return rows
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description = 'Time and memory-profile the modules on synthetic Kilosort output')
+    parser.add_argument('--modules', nargs = '+', choices = list(BENCHMARKS.keys()), default = None)
+    parser.add_argument('--scales', nargs = '+', choices = list(SCALES.keys()), default = ['small'])
+    parser.add_argument('--data_directory', default = DEFAULT_DATA_DIRECTORY, help = 'Location of the synthetic data')
+    parser.add_argument('--repeat', type = int, default = 1, help = 'Number of timed runs of each module')
+    parser.add_argument('--no_memory', action = 'store_true', help = 'Skip the tracemalloc run')
+    parser.add_argument('--in_process', action = 'store_true', help = 'Run modules in this process instead of a fresh one each')
+    parser.add_argument('--output', default = None, help = 'JSON file for the results (default: benchmark_<commit>.json)')
+    parser.add_argument('--compare', default = None, help = 'JSON results of an earlier run to compare against')
+    parser.add_argument('--c_waves_path', default = None, help = 'Folder holding the C_Waves executable, for c_waves_external')
+
+    options = parser.parse_args()
+
+    if options.c_waves_path is not None:
+        os.environ['C_WAVES_PATH'] = options.c_waves_path
+
+    report = run_benchmarks(options.modules, options.scales, options.data_directory, options.repeat,
+                            measure_memory = not options.no_memory, isolate = not options.in_process)
+
+    output = options.output or 'benchmark_{}.json'.format((report['commit'] or 'unknown')[:8])
+
+    with open(output, 'w') as f:
+        json.dump(report, f, indent = 2)
+
+    print('Results saved to ' + output)
+
+    if options.compare is not None:
+
+        with open(options.compare) as f:
+            baseline = json.load(f)
+
+        print('Compared with {} ({}):'.format((baseline['commit'] or 'unknown')[:8], baseline['date']))
+
+        for row in compare_results(baseline, report):
+            memory = '{:6.2f}x'.format(row['memory_ratio']) if row['memory_ratio'] is not None else '     -'
+            print('  {:<24} {:<7} time {:6.2f}x  memory {}'.format(row['module'], row['scale'], row['time_ratio'], memory))
+
+
+if __name__ == "__main__":
+    main()
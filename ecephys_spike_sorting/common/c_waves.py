@@ -0,0 +1,244 @@
+"""
+In-process equivalent of the C_Waves mean waveform tool
+
+C_Waves (one of the SpikeGLX post-processing tools) reads an AP band binary,
+the cluster table written by getSortResults, and the spike times and
+labels; it writes mean_waveforms.npy and cluster_snr.npy. calculate_c_waves
+computes the same two arrays with numpy, without an executable, a
+subprocess or intermediate files. The binary is read in one time-ordered
+sweep (see snippet_batches).
+
+For each row of the cluster table:
+
+    - up to num_spikes spikes, evenly spaced through the cluster's spike
+      train, are averaged; spikes whose window extends past the start or
+      end of the file are skipped
+    - mean_waveforms[cluster] is the mean waveform (channels x samples), in uV;
+      as in C_Waves, the spike sample is at index pre_samples - 1 (the
+      offset align_spike_times assumes)
+    - cluster_snr[cluster] is (SNR, number of spikes averaged), with
+
+          SNR = (Vmax - Vmin) of the mean on the peak channel / (2 * sqrt(variance))
+          variance = sum(residuals^2) / (N - degrees of freedom)
+
+      where the residuals (spike - mean) are taken over the first
+      NOISE_SAMPLES samples of the sites in a disk about the peak channel,
+      and there is one degree of freedom per site and sample
+
+Clusters without spikes have a zero mean waveform and SNR.
+
+"""
+
+import os
+import pathlib
+
+import numpy as np
+
+from .utils import SpikeIndex, snippet_batches, WaveformAccumulator, open_binary, CHUNK_BYTES
+
+
+NOISE_SAMPLES = 15
+
+
+def open_spikeglx_bin(spikeglx_bin, num_channels):
+
+    """
+    Memory-maps a SpikeGLX binary
+
+    The number of channels to average is the number of AP channels in the
+    .meta file next to the binary (leaving out the sync channel), or
+    num_channels if there is no .meta file.
+
+    Outputs:
+    --------
+    data : numpy.memmap (samples x num_channels)
+    num_ap_channels : int
+
+    """
+
+    data = open_binary(spikeglx_bin, num_channels)
+
+    meta_file = os.path.splitext(spikeglx_bin)[0] + '.meta'
+    num_ap_channels = num_channels
+
+    if os.path.exists(meta_file):
+        # imported here: SGLXMetaToCoords loads matplotlib
+        from .SGLXMetaToCoords import readMeta, ChannelCountsIM
+        meta = readMeta(pathlib.Path(meta_file))
+        if 'snsApLfSy' in meta:
+            num_ap_channels = min(ChannelCountsIM(meta)[0], num_channels)
+
+    return data, num_ap_channels
+
+
+def snr_sites(peak_channel, num_channels, snr_radius, snr_radius_um = 0, site_x = None, site_y = None):
+
+    """
+    Channels in the SNR disk about peak_channel
+
+    The disk has radius snr_radius_um (in um) if that is positive and the
+    site positions are known; otherwise it covers the snr_radius channels
+    on either side of the peak channel.
+
+    """
+
+    if snr_radius_um > 0 and site_x is not None and site_y is not None:
+        distance = np.sqrt(np.square(site_x[:num_channels] - site_x[peak_channel]) +
+                           np.square(site_y[:num_channels] - site_y[peak_channel]))
+        return np.flatnonzero(distance <= snr_radius_um)
+
+    return np.arange(max(0, peak_channel - snr_radius), min(num_channels, peak_channel + snr_radius + 1))
+
+
+def select_evenly(spike_index, num_clusters, num_spikes):
+
+    """
+    Up to num_spikes spikes of each cluster, evenly spaced through its spike train
+
+    Outputs:
+    --------
+    spikes : numpy.ndarray
+        Indices of the selected spikes
+    clusters : numpy.ndarray
+        Cluster of each selected spike
+
+    """
+
+    spikes = []
+    clusters = []
+
+    for cluster in range(num_clusters):
+
+        in_cluster = spike_index.spikes_for(cluster)
+
+        if in_cluster.size > num_spikes:
+            in_cluster = in_cluster[(np.arange(num_spikes) * in_cluster.size) // num_spikes]
+
+        spikes.append(in_cluster)
+        clusters.append(np.full(in_cluster.size, cluster))
+
+    return np.concatenate(spikes + [np.zeros(0, dtype = 'int')]), np.concatenate(clusters + [np.zeros(0, dtype = 'int')])
+
+
+def calculate_c_waves(raw_data,
+                      spike_times,
+                      spike_clusters,
+                      clus_table,
+                      bit_volts,
+                      samples_per_spike = 82,
+                      pre_samples = 20,
+                      num_spikes = 1000,
+                      snr_radius = 8,
+                      snr_radius_um = 0,
+                      site_x = None,
+                      site_y = None,
+                      num_channels = None,
+                      chunk_bytes = CHUNK_BYTES):
+
+    """
+    Mean waveforms and SNR of every cluster in a cluster table, as computed by C_Waves
+
+    Inputs:
+    -------
+    raw_data : numpy.ndarray or numpy.memmap (samples x channels)
+        int16 AP band data
+    spike_times : numpy.ndarray
+        Spike times (in samples)
+    spike_clusters : numpy.ndarray
+        Cluster label of each spike
+    clus_table : numpy.ndarray (clusters x 2)
+        Spike count and peak channel of each cluster, as written by getSortResults
+    bit_volts : float
+        uV per bit
+    samples_per_spike, pre_samples : int
+        Length of the waveforms and C_Waves' pre_samples (the spike sample
+        is at index pre_samples - 1)
+    num_spikes : int
+        Maximum number of spikes to average per cluster
+    snr_radius, snr_radius_um : int
+        Radius of the SNR disk in channels, or in um (see snr_sites)
+    site_x, site_y : numpy.ndarray (optional)
+        Site positions, in um
+    num_channels : int (optional)
+        Number of leading channels of raw_data to average (default: all)
+    chunk_bytes : int (optional)
+        Size of the blocks of raw_data read at once
+
+    Outputs:
+    --------
+    mean_waveforms : numpy.ndarray (clusters x channels x samples), float32
+    cluster_snr : numpy.ndarray (clusters x 2), float32
+        SNR and number of spikes averaged for each cluster
+
+    """
+
+    num_clusters = clus_table.shape[0]
+
+    if num_channels is None:
+        num_channels = raw_data.shape[1]
+
+    spike_times = np.squeeze(spike_times).astype('int64')
+    spike_clusters = np.squeeze(spike_clusters)
+
+    spike_index = SpikeIndex(spike_clusters, max(num_clusters, int(np.max(spike_clusters)) + 1))
+
+    spikes, clusters = select_evenly(spike_index, num_clusters, num_spikes)
+
+    # C_Waves windows start pre_samples - 1 samples before the spike
+    starts = spike_times[spikes] - (pre_samples - 1)
+    complete = (starts >= 0) * (starts + samples_per_spike <= raw_data.shape[0])
+
+    order = np.argsort(starts[complete], kind = 'stable')
+    starts = starts[complete][order]
+    clusters = clusters[complete][order]
+
+    accumulator = WaveformAccumulator(num_clusters, samples_per_spike, num_channels)
+
+    for index, snippets in snippet_batches(raw_data, starts, samples_per_spike, chunk_bytes):
+        accumulator.add(clusters[index], snippets[:, :, :num_channels])
+
+    mean, std = accumulator.mean_std(bit_volts)
+
+    mean_waveforms = np.zeros((num_clusters, num_channels, samples_per_spike), dtype = 'float32')
+    cluster_snr = np.zeros((num_clusters, 2), dtype = 'float32')
+
+    for cluster in np.flatnonzero(accumulator.count):
+
+        peak_channel = int(clus_table[cluster, 1])
+        sites = snr_sites(peak_channel, num_channels, snr_radius, snr_radius_um, site_x, site_y)
+
+        count = accumulator.count[cluster]
+        degrees_of_freedom = sites.size * NOISE_SAMPLES
+
+        residuals = np.sum(accumulator.M2[cluster, :NOISE_SAMPLES][:, sites], dtype = 'float64') * bit_volts ** 2
+
+        mean_waveforms[cluster] = mean[cluster]
+        cluster_snr[cluster, 1] = count
+
+        if count > 1 and residuals > 0:
+            variance = residuals / (count * degrees_of_freedom - degrees_of_freedom)
+            cluster_snr[cluster, 0] = np.ptp(mean[cluster, peak_channel]) / (2 * np.sqrt(variance))
+
+    return mean_waveforms, cluster_snr
+
+
+def write_c_waves_output(dest, mean_waveforms, cluster_snr, prefix = ''):
+
+    """
+    Saves the outputs of calculate_c_waves under the names C_Waves uses
+
+    Outputs:
+    --------
+    mean_waveform_fullpath, snr_fullpath : String
+
+    """
+
+    prefix = prefix + '_' if prefix else ''
+
+    mean_waveform_fullpath = os.path.join(dest, prefix + 'mean_waveforms.npy')
+    snr_fullpath = os.path.join(dest, prefix + 'cluster_snr.npy')
+
+    np.save(mean_waveform_fullpath, mean_waveforms)
+    np.save(snr_fullpath, cluster_snr)
+
+    return mean_waveform_fullpath, snr_fullpath
@@ -0,0 +1,368 @@
+"""
+Content-addressed cache of module results
+
+A module run is identified by a hash of the module name, its argschema
+parameters and the state of its input files (size and modification time,
+or the full contents if hash_file_contents is set). When a module is run
+again with the same key, its output manifest is returned without running
+it, and any of its output files that have since been deleted or overwritten
+are restored from the cache.
+
+The key is taken after the module has run, so a module that rewrites its
+own inputs (e.g. kilosort_postprocessing) is skipped when rerun on its own
+output, rather than being applied twice. For that to hold once later modules
+have run, each module lists exactly the files it reads: the later modules 
+write to the same Kilosort directory (cluster_group.tsv, clus_Table.npy, 
+mean_waveforms.npy, ...), and any of those in the key would change it.
+
+Inspect or trim a cache from the command line:
+
+    python -m ecephys_spike_sorting.common.result_cache list CACHE_DIR
+    python -m ecephys_spike_sorting.common.result_cache evict CACHE_DIR KEY [KEY ...]
+    python -m ecephys_spike_sorting.common.result_cache prune CACHE_DIR --max_size_gb 5
+    python -m ecephys_spike_sorting.common.result_cache clear CACHE_DIR
+
+"""
+
+import os
+import glob
+import json
+import time
+import shutil
+import hashlib
+import argparse
+
+import numpy as np
+
+
+CACHE_DIRECTORY_NAME = '.result_cache'
+
+# arguments that don't affect what a module computes
+IGNORED_ARGS = ('cache_params', 'input_json', 'output_json', 'log_level')
+
+# files read by utils.load_kilosort_data
+KILOSORT_FILES = ('spike_times.npy', 'spike_clusters.npy', 'spike_templates.npy', 'amplitudes.npy',
+                  'templates.npy', 'whitening_mat_inv.npy', 'channel_map.npy', 'channel_positions.npy',
+                  'cluster_Amplitude.tsv')
+
+# and with include_pcs
+KILOSORT_PC_FILES = ('pc_features.npy', 'pc_feature_ind.npy', 'template_features.npy')
+
+
+def kilosort_files(kilosort_output_directory, names = KILOSORT_FILES):
+
+    """ Paths of named Kilosort/Phy output files, as inputs or outputs for run_cached """
+
+    return [os.path.join(kilosort_output_directory, name) for name in names]
+
+
+def versioned_files(filename):
+
+    """ A file and its numbered versions (see utils.getFileVersion), as a glob pattern """
+
+    stem, ext = os.path.splitext(filename)
+
+    return stem + '*' + ext
+
+
+def file_state(filename, hash_contents = False):
+
+    """ Size and modification time of a file (or its contents hash); None if missing """
+
+    if not os.path.isfile(filename):
+        return None
+
+    stat = os.stat(filename)
+
+    if not hash_contents:
+        return [stat.st_size, stat.st_mtime_ns]
+
+    digest = hashlib.sha1()
+
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(16 * 1024 * 1024), b''):
+            digest.update(block)
+
+    return [stat.st_size, digest.hexdigest()]
+
+
+def _jsonable(value):
+
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+
+    if isinstance(value, np.generic):
+        return value.item()
+
+    return repr(value)
+
+
+def cache_key(module_name, args, input_files, hash_contents = False):
+
+    """
+    Hash identifying one run of a module
+
+    Inputs:
+    -------
+    module_name : str
+    args : dict
+        Module parameters (as parsed by argschema)
+    input_files : list of str
+        Files the module reads
+    hash_contents : bool
+        Hash file contents instead of size and modification time
+
+    Outputs:
+    --------
+    key : str
+        Hex digest
+
+    """
+
+    description = {'module' : module_name,
+                   'args' : {k : v for k, v in args.items() if k not in IGNORED_ARGS},
+                   'inputs' : [[os.path.abspath(f), file_state(f, hash_contents)] for f in sorted(set(input_files))]}
+
+    return hashlib.sha1(json.dumps(description, sort_keys = True, default = _jsonable).encode('utf-8')).hexdigest()
+
+
+class ResultCache():
+
+    """
+    Directory of cached module results, one subdirectory per key
+
+    Each entry holds the output manifest (manifest.json), a description
+    of the run (info.json) and copies of the module's output files. Entries
+    are evicted least-recently-used first once the cache exceeds max_bytes.
+
+    """
+
+    def __init__(self, directory, max_bytes = None):
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def _entry(self, key):
+
+        return os.path.join(self.directory, key)
+
+    def keys(self):
+
+        if not os.path.isdir(self.directory):
+            return []
+
+        return [key for key in os.listdir(self.directory)
+                if os.path.isfile(os.path.join(self._entry(key), 'info.json'))]
+
+    def info(self, key):
+
+        with open(os.path.join(self._entry(key), 'info.json')) as f:
+            info = json.load(f)
+
+        info['key'] = key
+        info['size'] = entry_size(self._entry(key))
+        info['last_used'] = os.path.getmtime(os.path.join(self._entry(key), 'info.json'))
+
+        return info
+
+    def entries(self):
+
+        """ Info of every entry, most recently used first """
+
+        return sorted((self.info(key) for key in self.keys()), key = lambda info: -info['last_used'])
+
+    def size(self):
+
+        return sum(info['size'] for info in self.entries())
+
+    def load(self, key):
+
+        """
+        Manifest stored under key, after restoring any missing or modified
+        output files; None on a cache miss
+
+        """
+
+        if key not in self.keys():
+            return None
+
+        entry = self._entry(key)
+
+        with open(os.path.join(entry, 'info.json')) as f:
+            info = json.load(f)
+
+        for filename, state, copy in info['outputs']:
+
+            if file_state(filename) != state:
+
+                if not os.path.isfile(os.path.join(entry, copy)):
+                    return None
+
+                print('Restoring ' + filename + ' from the result cache')
+                shutil.copy2(os.path.join(entry, copy), filename)
+
+        with open(os.path.join(entry, 'manifest.json')) as f:
+            manifest = json.load(f)
+
+        # mark as recently used
+        os.utime(os.path.join(entry, 'info.json'))
+
+        return manifest
+
+    def store(self, key, module_name, manifest, output_files):
+
+        """ Saves a manifest and copies of its output files under key """
+
+        os.makedirs(self.directory, exist_ok = True)
+
+        tmp_entry = self._entry(key) + '.tmp-' + repr(os.getpid())
+        shutil.rmtree(tmp_entry, ignore_errors = True)
+        os.makedirs(tmp_entry)
+
+        outputs = []
+
+        for idx, filename in enumerate(output_files):
+
+            filename = os.path.abspath(filename)
+            copy = repr(idx) + '_' + os.path.basename(filename)
+            shutil.copy2(filename, os.path.join(tmp_entry, copy))
+            outputs.append([filename, file_state(filename), copy])
+
+        with open(os.path.join(tmp_entry, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent = 2, default = _jsonable)
+
+        with open(os.path.join(tmp_entry, 'info.json'), 'w') as f:
+            json.dump({'module' : module_name, 'created' : time.time(), 'outputs' : outputs}, f, indent = 2)
+
+        self.evict(key)
+        os.replace(tmp_entry, self._entry(key))
+
+        if self.max_bytes is not None:
+            self.prune(self.max_bytes)
+
+    def evict(self, key):
+
+        shutil.rmtree(self._entry(key), ignore_errors = True)
+
+    def prune(self, max_bytes):
+
+        """ Evicts least recently used entries until the cache fits in max_bytes """
+
+        entries = self.entries()
+        total = sum(info['size'] for info in entries)
+
+        while entries and total > max_bytes:
+            info = entries.pop()
+            print('Evicting ' + info['module'] + ' result ' + info['key'] + ' from the result cache')
+            self.evict(info['key'])
+            total -= info['size']
+
+    def clear(self):
+
+        for key in self.keys():
+            self.evict(key)
+
+
+def entry_size(path):
+
+    return sum(os.path.getsize(os.path.join(root, f)) for root, dirs, files in os.walk(path) for f in files)
+
+
+def manifest_files(manifest):
+
+    """ Output files named in a manifest """
+
+    return [value for value in manifest.values() if isinstance(value, str) and os.path.isfile(value)]
+
+
+def run_cached(module_name, args, run, input_files, output_files = ()):
+
+    """
+    Runs a module, or returns its cached manifest if nothing has changed
+
+    Caching is off unless args['cache_params']['use_cache'] is set. The
+    cache lives in cache_params['cache_directory'], by default a
+    .result_cache directory inside the Kilosort output directory.
+
+    Inputs:
+    -------
+    module_name : str
+    args : dict
+        Module parameters (as parsed by argschema)
+    run : function
+        Takes args and returns the output manifest
+    input_files : list of str
+        Files the module reads
+    output_files : list of str
+        Files or glob patterns the module writes, besides any files named 
+        in its manifest
+
+    Outputs:
+    --------
+    manifest : dict
+
+    """
+
+    cache_params = args.get('cache_params', {})
+
+    if not cache_params.get('use_cache', False):
+        return run(args)
+
+    directory = cache_params.get('cache_directory') or \
+        os.path.join(args['directories']['kilosort_output_directory'], CACHE_DIRECTORY_NAME)
+    max_size_gb = cache_params.get('max_cache_size_gb', 10.0)
+    hash_contents = cache_params.get('hash_file_contents', False)
+
+    cache = ResultCache(directory, int(max_size_gb * 1024**3))
+
+    key = cache_key(module_name, args, input_files, hash_contents)
+    manifest = cache.load(key)
+
+    if manifest is not None:
+        print(module_name + ': inputs and parameters unchanged, using cached result ' + key)
+        return manifest
+
+    manifest = run(args)
+
+    # the module may have rewritten its own inputs
+    key = cache_key(module_name, args, input_files, hash_contents)
+    written = [f for pattern in output_files for f in glob.glob(pattern)] + manifest_files(manifest)
+    written = sorted(set(os.path.abspath(f) for f in written if os.path.isfile(f)))
+    cache.store(key, module_name, manifest, written)
+
+    return manifest
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description = 'Inspect or trim a module result cache')
+    parser.add_argument('command', choices = ['list', 'evict', 'prune', 'clear'])
+    parser.add_argument('cache_directory')
+    parser.add_argument('keys', nargs = '*', help = 'Entries to evict')
+    parser.add_argument('--max_size_gb', type = float, default = 10.0, help = 'Size to prune the cache to')
+
+    options = parser.parse_args()
+
+    cache = ResultCache(options.cache_directory)
+
+    if options.command == 'list':
+        for info in cache.entries():
+            print('{}  {:<24}  {:>10.1f} MB  last used {}'.format(info['key'],
+                                                              info['module'],
+                                                              info['size'] / 1024**2,
+                                                              time.strftime('%Y-%m-%d %H:%M', time.localtime(info['last_used']))))
+        print('total: {:.1f} MB'.format(cache.size() / 1024**2))
+
+    elif options.command == 'evict':
+        for key in options.keys:
+            cache.evict(key)
+
+    elif options.command == 'prune':
+        cache.prune(int(options.max_size_gb * 1024**3))
+
+    elif options.command == 'clear':
+        cache.clear()
+
+
+if __name__ == "__main__":
+    main()
@@ -30,6 +30,14 @@ class CommonFiles(DefaultSchema):
 
 class WaveformMetricsFile(DefaultSchema):
     waveform_metrics_file = String(help='Location of waveform metrics CSV')
+    write_feather = Bool(required=False, default=False, help='Also write the waveform metrics as a typed Feather (Arrow) file next to the CSV, which later modules read instead (requires pyarrow)')
     
 class ClusterMetricsFile(DefaultSchema):
     cluster_metrics_file = String(help='Location of cluster metrics CSV')
+    write_feather = Bool(required=False, default=False, help='Also write the cluster metrics as a typed Feather (Arrow) file next to the CSV, which later modules read instead (requires pyarrow)')
+
+class CacheParams(DefaultSchema):
+    use_cache = Bool(required=False, default=False, help='Skip a module and restore its outputs if its inputs and parameters are unchanged since a cached run')
+    cache_directory = String(required=False, help='Location of the result cache (default: .result_cache in the Kilosort output directory)')
+    max_cache_size_gb = Float(required=False, default=10.0, help='Least recently used results are evicted beyond this size')
+    hash_file_contents = Bool(required=False, default=False, help='Identify input files by content hash instead of size and modification time (slow for large files)')
@@ -0,0 +1,592 @@
+"""
+Deterministic synthetic Kilosort/Phy output
+
+Writes a Kilosort output directory (spike times, clusters, templates,
+amplitudes, PC and template features, whitening matrices, cluster tsv
+files and params.py) together with the int16 AP band binary the spikes
+were injected into, its _chanMap.mat and a minimal SpikeGLX .meta file,
+and an LFP band binary with a brain surface. The same arguments always produce identical files.
+
+Generate a folder from the command line:
+
+    python -m ecephys_spike_sorting.common.synthetic OUTPUT_DIR --num_units 50 --duration 60
+
+"""
+
+import os
+import json
+import inspect
+import argparse
+
+import numpy as np
+import pandas as pd
+from scipy.io import savemat
+from scipy.ndimage import gaussian_filter1d
+
+from .utils import channel_distances
+
+
+MANIFEST_NAME = 'synthetic.json'
+
+PROBE_X = [43, 11, 59, 27]   # Neuropixels 1.0 checkerboard, in microns
+
+TEMPLATE_SAMPLES = 82
+TEMPLATE_ZERO_PADDING = 21
+TROUGH_SAMPLE = 20           # trough of the unpadded template, aligned with the spike time
+
+REFRACTORY_PERIOD = 0.0015   # s
+UV_PER_AMPLITUDE = 4.0       # microvolts at the peak channel per unit of Kilosort amplitude
+DETECTION_THRESHOLD = 8.0    # spikes below this amplitude are not detected
+
+
+def probe_geometry(num_channels, vertical_site_spacing = 20.0):
+
+    """
+    Site positions of a single-shank Neuropixels 1.0 style probe
+
+    Inputs:
+    -------
+    num_channels : int
+    vertical_site_spacing : float
+        In microns
+
+    Outputs:
+    --------
+    channel_pos : numpy.ndarray (channels x 2)
+        X and Z coordinates of each site, in microns
+
+    """
+
+    channels = np.arange(num_channels)
+
+    return np.column_stack((np.array(PROBE_X)[channels % 4],
+                            (channels // 2) * vertical_site_spacing)).astype('float64')
+
+
+def template_waveforms(peak_channels, channel_pos, rng):
+
+    """
+    Biphasic waveforms that decay with distance from each peak channel
+
+    Inputs:
+    -------
+    peak_channels : numpy.ndarray (M x 0)
+        Peak channel of each template
+    channel_pos : numpy.ndarray (channels x 2)
+    rng : numpy.random.Generator
+
+    Outputs:
+    --------
+    waveforms : numpy.ndarray (M x samples x channels)
+        Unpadded waveforms, with a trough of -1 on the peak channel at TROUGH_SAMPLE
+
+    """
+
+    num_samples = TEMPLATE_SAMPLES - TEMPLATE_ZERO_PADDING
+    num_templates = peak_channels.size
+
+    t = np.arange(num_samples)[np.newaxis, :, np.newaxis]
+
+    distances = channel_distances(channel_pos)[peak_channels][:, np.newaxis, :]
+
+    trough_width = rng.uniform(1.5, 3.0, num_templates)[:, np.newaxis, np.newaxis]
+    peak_width = rng.uniform(4.0, 9.0, num_templates)[:, np.newaxis, np.newaxis]
+    peak_delay = rng.uniform(6.0, 16.0, num_templates)[:, np.newaxis, np.newaxis]
+    peak_ratio = rng.uniform(0.2, 0.6, num_templates)[:, np.newaxis, np.newaxis]
+    decay_um = rng.uniform(20.0, 45.0, num_templates)[:, np.newaxis, np.newaxis]
+
+    delay = distances / 400.0   # samples of propagation delay per micron
+
+    trough = -np.exp(-0.5 * np.square((t - TROUGH_SAMPLE - delay) / trough_width))
+    peak = peak_ratio * np.exp(-0.5 * np.square((t - TROUGH_SAMPLE - peak_delay - delay) / peak_width))
+
+    return ((trough + peak) * np.exp(-distances / decay_um)).astype('float32')
+
+
+def spike_trains(rates, duration, sample_rate, rng):
+
+    """
+    Spike times with a refractory period, plus contaminating spikes that violate it
+
+    Inputs:
+    -------
+    rates : numpy.ndarray (M x 0)
+        Firing rate of each unit, in Hz
+    duration : float
+        In seconds
+    sample_rate : float
+    rng : numpy.random.Generator
+
+    Outputs:
+    --------
+    spike_times : numpy.ndarray (N x 0)
+        Spike times in samples, sorted
+    spike_units : numpy.ndarray (N x 0)
+        Unit of each spike
+
+    """
+
+    refractory_samples = REFRACTORY_PERIOD * sample_rate
+    num_samples = int(duration * sample_rate)
+
+    times = []
+    units = []
+
+    for unit, rate in enumerate(rates):
+
+        mean_interval = sample_rate / rate - refractory_samples
+        num_spikes = int(rate * duration * 1.2) + 10
+
+        unit_times = np.cumsum(refractory_samples + rng.exponential(mean_interval, num_spikes))
+        unit_times = unit_times[unit_times < num_samples - TEMPLATE_SAMPLES]
+
+        contamination = rng.beta(1.0, 30.0)
+        extra = rng.uniform(TEMPLATE_SAMPLES, num_samples - TEMPLATE_SAMPLES, int(contamination * unit_times.size))
+
+        unit_times = np.concatenate((unit_times, extra)).astype('int64')
+
+        times.append(unit_times)
+        units.append(np.full(unit_times.size, unit))
+
+    times = np.concatenate(times)
+    units = np.concatenate(units)
+
+    order = np.lexsort((units, times))
+
+    return times[order], units[order]
+
+
+def add_double_counted_spikes(spike_times, spike_units, peak_channels, fraction, sample_rate, rng):
+
+    """
+    Copies of existing spikes a few samples later, assigned to the same unit
+    or to a unit with a neighbouring peak channel, as Kilosort produces them
+
+    """
+
+    num_copies = int(spike_times.size * fraction)
+
+    if num_copies == 0:
+        return spike_times, spike_units
+
+    source = np.sort(rng.choice(spike_times.size, num_copies, replace = False))
+    offsets = rng.integers(1, int(0.000166 * sample_rate) + 1, num_copies)
+
+    copy_units = spike_units[source].copy()
+    neighbours = rng.random(num_copies) < 0.5
+
+    for i in np.where(neighbours)[0]:
+        nearby = np.where(np.abs(peak_channels - peak_channels[copy_units[i]]) <= 4)[0]
+        copy_units[i] = rng.choice(nearby)
+
+    times = np.concatenate((spike_times, spike_times[source] + offsets))
+    units = np.concatenate((spike_units, copy_units))
+
+    order = np.lexsort((units, times))
+
+    return times[order], units[order]
+
+
+def whitening_matrices(channel_pos):
+
+    """
+    Inverse whitening matrix from the spatial correlation of the noise, and its inverse
+
+    """
+
+    whitening_mat_inv = 0.5 * np.exp(-channel_distances(channel_pos) / 30.0) + 0.5 * np.eye(channel_pos.shape[0])
+
+    return np.linalg.inv(whitening_mat_inv), whitening_mat_inv
+
+
+def nearest_channels(peak_channels, channel_pos, num_channels):
+
+    """ Channels closest to each peak channel, nearest first """
+
+    distances = channel_distances(channel_pos)[peak_channels]
+
+    return np.argsort(distances, axis = 1, kind = 'stable')[:, :num_channels]
+
+
+def write_features(directory, spike_units, amplitudes, waveforms, peak_channels, channel_pos,
+                   num_pc_channels, num_template_features, rng, block_size = 2**18):
+
+    """
+    Writes pc_features.npy, pc_feature_ind.npy, template_features.npy and template_feature_ind.npy
+
+    The first PC scales with the spike amplitude and the template footprint on
+    each channel; the second holds a per-unit offset, so units are separable.
+
+    """
+
+    num_templates, _, num_channels = waveforms.shape
+    num_pc_channels = min(num_pc_channels, num_channels)
+    num_template_features = min(num_template_features, num_templates)
+
+    pc_feature_ind = nearest_channels(peak_channels, channel_pos, num_pc_channels).astype('uint32')
+    footprint = np.max(np.abs(waveforms), 1)
+    footprint = np.take_along_axis(footprint, pc_feature_ind.astype('int64'), 1).astype('float32')
+
+    unit_offsets = rng.normal(0, 3.0, (num_templates, 2, num_pc_channels)).astype('float32')
+
+    peak_distances = channel_distances(channel_pos[peak_channels])
+    template_feature_ind = np.argsort(peak_distances, axis = 1, kind = 'stable')[:, :num_template_features]
+    similarity = np.exp(-np.take_along_axis(peak_distances, template_feature_ind, 1) / 50.0).astype('float32')
+
+    np.save(os.path.join(directory, 'pc_feature_ind.npy'), pc_feature_ind)
+    np.save(os.path.join(directory, 'template_feature_ind.npy'), template_feature_ind.astype('uint32'))
+
+    pc_features = np.lib.format.open_memmap(os.path.join(directory, 'pc_features.npy'), mode = 'w+',
+                                            dtype = 'float32', shape = (spike_units.size, 3, num_pc_channels))
+    template_features = np.lib.format.open_memmap(os.path.join(directory, 'template_features.npy'), mode = 'w+',
+                                                  dtype = 'float32', shape = (spike_units.size, num_template_features))
+
+    for start in range(0, spike_units.size, block_size):
+
+        units = spike_units[start:start + block_size]
+        scale = amplitudes[start:start + block_size, np.newaxis].astype('float32')
+
+        block = rng.normal(0, 1.0, (units.size, 3, num_pc_channels)).astype('float32')
+        block[:, 0, :] += scale * footprint[units]
+        block[:, 1:, :] += unit_offsets[units]
+
+        pc_features[start:start + block_size] = block
+        template_features[start:start + block_size] = scale * similarity[units] + \
+            rng.normal(0, 1.0, (units.size, num_template_features)).astype('float32')
+
+    pc_features.flush()
+    template_features.flush()
+
+    del pc_features, template_features
+
+
+def write_ap_band(filename, spike_times, spike_units, amplitudes, waveforms, num_samples,
+                  sample_rate, bit_volts, noise_uv, seed, block_seconds = 1.0):
+
+    """
+    Writes an int16 binary (samples x channels) of Gaussian noise with every spike injected
+
+    Each block of samples draws its noise from its own seed, so the file does
+    not depend on the block size of any reader.
+
+    """
+
+    num_channels = waveforms.shape[2]
+    block_samples = int(block_seconds * sample_rate)
+    window = waveforms.shape[1]
+
+    data = np.memmap(filename, dtype = 'int16', mode = 'w+', shape = (num_samples, num_channels))
+
+    starts = spike_times - TROUGH_SAMPLE
+    scale = amplitudes * UV_PER_AMPLITUDE / bit_volts
+
+    for block, block_start in enumerate(range(0, num_samples, block_samples)):
+
+        block_end = min(block_start + block_samples, num_samples)
+
+        block_rng = np.random.default_rng([seed, 1, block])
+        chunk = block_rng.standard_normal((block_end - block_start, num_channels), dtype = 'float32')
+        chunk *= noise_uv / bit_volts
+
+        first, last = np.searchsorted(starts, [block_start - window, block_end])
+
+        for i in range(first, last):
+
+            start = starts[i] - block_start
+            lo = max(start, 0)
+            hi = min(start + window, block_end - block_start)
+
+            if hi > lo:
+                chunk[lo:hi, :] += scale[i] * waveforms[spike_units[i], lo - start:hi - start, :]
+
+        data[block_start:block_end, :] = np.clip(np.round(chunk), -32768, 32767).astype('int16')
+
+    data.flush()
+
+    del data
+
+
+def write_lfp_band(filename, channel_pos, duration, lfp_sample_rate, bit_volts, surface_y, seed, block_seconds = 10.0):
+
+    """
+    Writes an int16 LFP binary in which channels below surface_y carry strong
+    low-frequency power, and channels above it mostly noise
+
+    """
+
+    num_channels = channel_pos.shape[0]
+    num_samples = int(duration * lfp_sample_rate)
+    block_samples = int(block_seconds * lfp_sample_rate)
+
+    in_brain = channel_pos[:, 1] < surface_y
+    gain = np.where(in_brain, 1.0, 0.05).astype('float32')
+
+    data = np.memmap(filename, dtype = 'int16', mode = 'w+', shape = (num_samples, num_channels))
+
+    for block, block_start in enumerate(range(0, num_samples, block_samples)):
+
+        block_end = min(block_start + block_samples, num_samples)
+        block_rng = np.random.default_rng([seed, 2, block])
+
+        shared = gaussian_filter1d(block_rng.standard_normal(block_end - block_start, dtype = 'float32'), lfp_sample_rate / 30.0)
+        shared *= 300.0 / np.std(shared)
+        local = gaussian_filter1d(block_rng.standard_normal((block_end - block_start, num_channels), dtype = 'float32'),
+                                  lfp_sample_rate / 30.0, axis = 0)
+        local *= 100.0 / np.std(local)
+
+        chunk = gain * (shared[:, np.newaxis] + local) + 10.0 * block_rng.standard_normal((block_end - block_start, num_channels), dtype = 'float32')
+
+        data[block_start:block_end, :] = np.clip(np.round(chunk / bit_volts), -32768, 32767).astype('int16')
+
+    data.flush()
+
+    del data
+
+
+def write_spikeglx_meta(filename, num_channels, num_samples, sample_rate, bit_volts, channel_pos):
+
+    """
+    Writes a minimal SpikeGLX .meta file for a synthetic AP band binary
+
+    There is no sync channel, and the gain is chosen so that one bit is
+    bit_volts microvolts.
+
+    """
+
+    geometry = ''.join('({}:{:g}:{:g}:1)'.format(0, x, y) for x, y in channel_pos)
+
+    items = [('typeThis', 'imec'),
+             ('imSampRate', sample_rate),
+             ('nSavedChans', num_channels),
+             ('snsApLfSy', '{},0,0'.format(num_channels)),
+             ('snsSaveChanSubset', 'all'),
+             ('fileSizeBytes', 2 * num_channels * num_samples),
+             ('fileTimeSecs', num_samples / sample_rate),
+             ('imAiRangeMax', 0.6),
+             ('imAiRangeMin', -0.6),
+             ('imMaxInt', 512),
+             ('imChan0apGain', 0.6 / 512 / (bit_volts * 1e-6)),
+             ('~snsGeomMap', '(NP1000,1,0,70)' + geometry)]
+
+    with open(filename, 'w') as f:
+        for key, value in items:
+            f.write('{}={}\n'.format(key, value))
+
+
+def make_kilosort_output(directory,
+                         num_units = 50,
+                         duration = 60.0,
+                         num_channels = 64,
+                         sample_rate = 30000.0,
+                         lfp_sample_rate = 2500.0,
+                         bit_volts = 0.195,
+                         mean_firing_rate = 4.0,
+                         duplicate_fraction = 0.005,
+                         noise_uv = 8.0,
+                         num_pc_channels = 32,
+                         num_template_features = 32,
+                         write_binary = True,
+                         write_lfp = True,
+                         seed = 0):
+
+    """
+    Writes a synthetic Kilosort output directory and the binaries it was sorted from
+
+    Inputs:
+    -------
+    directory : String
+        Output location; the Kilosort files and binaries are all written here
+    num_units : int
+        Number of units (one template each)
+    duration : float
+        Recording length in seconds
+    num_channels : int
+        Number of sites, in a Neuropixels 1.0 layout
+    sample_rate, lfp_sample_rate : float
+        In Hz
+    bit_volts : float
+        Microvolts per int16 count in the binaries
+    mean_firing_rate : float
+        Median of the (log-normal) unit firing rates, in Hz
+    duplicate_fraction : float
+        Fraction of spikes double-counted within or between nearby units
+    noise_uv : float
+        Standard deviation of the AP band noise
+    num_pc_channels, num_template_features : int
+        Sizes of the PC and template feature arrays
+    write_binary, write_lfp : bool
+        Flags whether to write the AP and LFP band binaries
+    seed : int
+        Random seed; identical arguments produce identical files
+
+    Outputs:
+    --------
+    manifest : dict
+        The arguments and the locations of the files written; also saved as synthetic.json
+
+    """
+
+    os.makedirs(directory, exist_ok = True)
+
+    rng = np.random.default_rng(seed)
+
+    channel_pos = probe_geometry(num_channels)
+    channel_map = np.arange(num_channels, dtype = 'int32')
+
+    peak_channels = np.sort(rng.integers(0, num_channels, num_units))
+    waveforms = template_waveforms(peak_channels, channel_pos, rng)
+
+    whitening_mat, whitening_mat_inv = whitening_matrices(channel_pos)
+
+    rates = np.clip(mean_firing_rate * rng.lognormal(0, 0.8, num_units), 0.1, 60.0)
+    spike_times, spike_units = spike_trains(rates, duration, sample_rate, rng)
+    spike_times, spike_units = add_double_counted_spikes(spike_times, spike_units, peak_channels,
+                                                          duplicate_fraction, sample_rate, rng)
+
+    # amplitudes drift slowly; spikes that drift below threshold go undetected
+    unit_amplitudes = rng.lognormal(np.log(20.0), 0.4, num_units)
+    drift_phase = rng.uniform(0, 2 * np.pi, num_units)
+    drift = 1.0 + 0.2 * np.sin(2 * np.pi * spike_times / sample_rate / duration + drift_phase[spike_units])
+    amplitudes = unit_amplitudes[spike_units] * drift * rng.gamma(25.0, 1 / 25.0, spike_times.size)
+
+    detected = amplitudes > DETECTION_THRESHOLD
+    spike_times = spike_times[detected]
+    spike_units = spike_units[detected]
+    amplitudes = amplitudes[detected]
+
+    np.save(os.path.join(directory, 'spike_times.npy'), spike_times.astype('uint64')[:, np.newaxis])
+    np.save(os.path.join(directory, 'spike_templates.npy'), spike_units.astype('uint32')[:, np.newaxis])
+    np.save(os.path.join(directory, 'spike_clusters.npy'), spike_units.astype('uint32'))
+    np.save(os.path.join(directory, 'amplitudes.npy'), amplitudes[:, np.newaxis])
+
+    # Kilosort saves whitened templates with leading zero padding
+    templates = np.zeros((num_units, TEMPLATE_SAMPLES, num_channels), dtype = 'float32')
+    templates[:, TEMPLATE_ZERO_PADDING:, :] = np.dot(waveforms, whitening_mat.astype('float32'))
+
+    np.save(os.path.join(directory, 'templates.npy'), templates)
+    np.save(os.path.join(directory, 'whitening_mat.npy'), whitening_mat)
+    np.save(os.path.join(directory, 'whitening_mat_inv.npy'), whitening_mat_inv)
+    np.save(os.path.join(directory, 'channel_map.npy'), channel_map)
+    np.save(os.path.join(directory, 'channel_positions.npy'), channel_pos)
+
+    write_features(directory, spike_units, amplitudes, waveforms, peak_channels, channel_pos,
+                   num_pc_channels, num_template_features, rng)
+
+    cluster_ids = np.arange(num_units)
+    spike_counts = np.bincount(spike_units, minlength = num_units)
+    cluster_amplitude = np.bincount(spike_units, amplitudes, minlength = num_units) / np.maximum(spike_counts, 1)
+    labels = np.where(spike_counts > 100, 'good', 'mua')
+
+    pd.DataFrame({'cluster_id' : cluster_ids, 'Amplitude' : np.around(cluster_amplitude, 1)}) \
+        .to_csv(os.path.join(directory, 'cluster_Amplitude.tsv'), sep = '\t', index = False)
+    pd.DataFrame({'cluster_id' : cluster_ids, 'KSLabel' : labels}) \
+        .to_csv(os.path.join(directory, 'cluster_KSLabel.tsv'), sep = '\t', index = False)
+    pd.DataFrame({'cluster_id' : cluster_ids, 'group' : labels}) \
+        .to_csv(os.path.join(directory, 'cluster_group.tsv'), sep = '\t', index = False)
+
+    ap_band_file = os.path.join(directory, 'continuous.imec0.ap.bin')
+    lfp_band_file = os.path.join(directory, 'continuous.imec0.lf.bin')
+
+    with open(os.path.join(directory, 'params.py'), 'w') as f:
+        f.write("dat_path = '{}'\n".format(os.path.basename(ap_band_file)))
+        f.write('n_channels_dat = {}\n'.format(num_channels))
+        f.write("dtype = 'int16'\n")
+        f.write('offset = 0\n')
+        f.write('sample_rate = {}\n'.format(sample_rate))
+        f.write('hp_filtered = True\n')
+
+    savemat(os.path.join(directory, 'continuous.imec0.ap_chanMap.mat'),
+            {'chanMap' : (channel_map + 1).astype('float64'),
+             'chanMap0ind' : channel_map.astype('float64'),
+             'connected' : np.ones(num_channels, dtype = 'float64'),
+             'xcoords' : channel_pos[:, 0],
+             'ycoords' : channel_pos[:, 1],
+             'kcoords' : np.ones(num_channels, dtype = 'float64'),
+             'fs' : sample_rate})
+
+    surface_y = float(np.around(0.75 * np.max(channel_pos[:, 1]), -1))
+
+    if write_binary:
+        write_ap_band(ap_band_file, spike_times, spike_units, amplitudes, waveforms,
+                      int(duration * sample_rate), sample_rate, bit_volts, noise_uv, seed)
+        write_spikeglx_meta(os.path.splitext(ap_band_file)[0] + '.meta', num_channels,
+                            int(duration * sample_rate), sample_rate, bit_volts, channel_pos)
+
+    if write_lfp:
+        write_lfp_band(lfp_band_file, channel_pos, duration, lfp_sample_rate, bit_volts, surface_y, seed)
+
+    manifest = {'num_units' : num_units,
+                'duration' : duration,
+                'num_channels' : num_channels,
+                'sample_rate' : sample_rate,
+                'lfp_sample_rate' : lfp_sample_rate,
+                'bit_volts' : bit_volts,
+                'mean_firing_rate' : mean_firing_rate,
+                'duplicate_fraction' : duplicate_fraction,
+                'noise_uv' : noise_uv,
+                'num_pc_channels' : num_pc_channels,
+                'num_template_features' : num_template_features,
+                'write_binary' : write_binary,
+                'write_lfp' : write_lfp,
+                'seed' : seed,
+                'num_spikes' : int(spike_times.size),
+                'surface_y' : surface_y,
+                'kilosort_output_directory' : directory,
+                'ap_band_file' : ap_band_file if write_binary else None,
+                'lfp_band_file' : lfp_band_file if write_lfp else None}
+
+    with open(os.path.join(directory, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent = 2)
+
+    return manifest
+
+
+def load_or_make_kilosort_output(directory, **kwargs):
+
+    """
+    Returns the manifest of a synthetic folder, generating it only if it is
+    missing or was written with different arguments
+
+    """
+
+    manifest_file = os.path.join(directory, MANIFEST_NAME)
+
+    if os.path.exists(manifest_file):
+
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+
+        arguments = inspect.signature(make_kilosort_output).bind(directory, **kwargs)
+        arguments.apply_defaults()
+
+        if all(manifest.get(key) == value for key, value in arguments.arguments.items() if key != 'directory'):
+            return manifest
+
+    return make_kilosort_output(directory, **kwargs)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description = 'Write a synthetic Kilosort output directory')
+    parser.add_argument('directory')
+    parser.add_argument('--num_units', type = int, default = 50)
+    parser.add_argument('--duration', type = float, default = 60.0, help = 'Recording length in seconds')
+    parser.add_argument('--num_channels', type = int, default = 64)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--no_binary', action = 'store_true', help = 'Skip the AP and LFP band binaries')
+
+    options = parser.parse_args()
+
+    manifest = make_kilosort_output(options.directory,
+                                    num_units = options.num_units,
+                                    duration = options.duration,
+                                    num_channels = options.num_channels,
+                                    write_binary = not options.no_binary,
+                                    write_lfp = not options.no_binary,
+                                    seed = options.seed)
+
+    print('{} spikes from {} units written to {}'.format(manifest['num_spikes'], manifest['num_units'], options.directory))
+
+
+if __name__ == "__main__":
+    main()
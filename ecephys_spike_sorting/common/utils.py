@@ -221,7 +221,75 @@ def read_cluster_amplitude_tsv(filename):
 
     return cluster_amplitude
 
-def load(folder, filename):
+def metrics_feather_file(filename):
+
+    """ Location of the Feather copy of a metrics CSV file """
+
+    return os.path.splitext(filename)[0] + '.feather'
+
+def write_metrics(metrics, filename, write_feather = False):
+
+    """
+    Writes a metrics table as CSV (for Phy) and, optionally, as a Feather
+    (Arrow) file next to it, which keeps the column types and is read by
+    read_metrics instead of the CSV
+
+    Inputs:
+    -------
+    metrics : pandas.DataFrame
+    filename : String
+        Location of the CSV file
+    write_feather : bool
+        Flags whether to also write the .feather copy (requires pyarrow)
+
+    """
+
+    metrics.to_csv(filename, index=False)
+
+    feather_file = metrics_feather_file(filename)
+
+    if write_feather:
+        try:
+            metrics.reset_index(drop=True).to_feather(feather_file)
+            return
+        except ImportError:
+            print('pyarrow not available; metrics saved as CSV only')
+
+    # an older copy would no longer match the CSV
+    if os.path.exists(feather_file):
+        os.remove(feather_file)
+
+def read_metrics(filename):
+
+    """
+    Reads a metrics table written by write_metrics
+
+    The Feather copy is read if there is one that is at least as new as the
+    CSV (and pyarrow is installed); otherwise the CSV is parsed.
+
+    Inputs:
+    -------
+    filename : String
+        Location of the CSV file
+
+    Outputs:
+    --------
+    metrics : pandas.DataFrame
+
+    """
+
+    feather_file = metrics_feather_file(filename)
+
+    if os.path.exists(feather_file) and \
+       (not os.path.exists(filename) or os.path.getmtime(feather_file) >= os.path.getmtime(filename)):
+        try:
+            return pd.read_feather(feather_file)
+        except ImportError:
+            pass
+
+    return pd.read_csv(filename)
+
+def load(folder, filename, mmap_mode = None):
 
     """
     Loads a numpy file from a folder.
@@ -232,6 +300,8 @@ def load(folder, filename):
         Directory containing the file to load
     filename : String
         Name of the numpy file
+    mmap_mode : String (optional)
+        Passed to np.load; 'r' opens the file as a read-only memory map
 
     Outputs:
     --------
@@ -240,7 +310,7 @@ def load(folder, filename):
 
     """
 
-    return np.load(os.path.join(folder, filename))
+    return np.load(os.path.join(folder, filename), mmap_mode = mmap_mode)
 
 
 def load_kilosort_data(folder, 
@@ -248,7 +318,8 @@ def load_kilosort_data(folder,
                        convert_to_seconds = True, 
                        use_master_clock = False, 
                        include_pcs = False,
-                       template_zero_padding= 21):
+                       template_zero_padding= 21,
+                       mmap_features = False):
 
     """
     Loads Kilosort output files from a directory
@@ -267,6 +338,9 @@ def load_kilosort_data(folder,
         Flags whether to load spike principal components (large file)
     template_zero_padding : int (default = 21)
         Number of zeros added to the beginning of each template
+    mmap_features : bool (optional)
+        Flags whether to open pc_features and template_features as read-only 
+        memory maps instead of reading them into memory
 
     Outputs:
     --------
@@ -313,9 +387,10 @@ def load_kilosort_data(folder,
     channel_pos = load(folder, 'channel_positions.npy')
 
     if include_pcs:
-        pc_features = load(folder, 'pc_features.npy')
+        feature_mmap_mode = 'r' if mmap_features else None
+        pc_features = load(folder, 'pc_features.npy', feature_mmap_mode)
         pc_feature_ind = load(folder, 'pc_feature_ind.npy')
-        template_features = load(folder, 'template_features.npy') 
+        template_features = load(folder, 'template_features.npy', feature_mmap_mode) 
 
                 
     templates = templates[:,template_zero_padding:,:] # remove zeros
@@ -348,6 +423,809 @@ def load_kilosort_data(folder,
                pc_features, pc_feature_ind, template_features
 
 
+class SpikeIndex():
+
+    """
+    Maps cluster IDs to the indices of their spikes (CSR layout)
+
+    The spike array is sorted once by cluster ID with a stable argsort, so
+    the spikes for each unit occupy a contiguous block of `order` and keep
+    their original (time-sorted) order. The block for cluster c is
+    order[offsets[c]:offsets[c+1]], which is found in O(1) instead of
+    scanning the full spike array with spike_clusters == c.
+
+    """
+
+    def __init__(self, spike_clusters, total_units = None):
+
+        """
+        spike_clusters : numpy.ndarray (num_spikes x 0)
+            Cluster IDs for each spike
+        total_units : int (optional)
+            Number of cluster IDs to index; defaults to max(spike_clusters) + 1
+        """
+
+        spike_clusters = np.asarray(spike_clusters).ravel()
+
+        if total_units is None:
+            total_units = int(np.max(spike_clusters)) + 1 if spike_clusters.size > 0 else 0
+
+        self.total_units = total_units
+        self.order = np.argsort(spike_clusters, kind = 'stable')
+        self.counts = np.bincount(spike_clusters, minlength = total_units)
+        self.offsets = np.zeros((total_units + 1,), dtype = 'int64')
+        self.offsets[1:] = np.cumsum(self.counts[:total_units])
+
+        # cluster IDs that have at least one spike, in ascending order
+        self.cluster_ids = np.flatnonzero(self.counts[:total_units])
+
+    @classmethod
+    def from_arrays(cls, order, counts, total_units):
+
+        """ Rebuilds an index from its order and counts arrays without re-sorting
+
+        Used by worker processes, which receive `order` through shared memory.
+        """
+
+        spike_index = cls.__new__(cls)
+        spike_index.total_units = total_units
+        spike_index.order = order
+        spike_index.counts = counts
+        spike_index.offsets = np.zeros((total_units + 1,), dtype = 'int64')
+        spike_index.offsets[1:] = np.cumsum(counts[:total_units])
+        spike_index.cluster_ids = np.flatnonzero(counts[:total_units])
+
+        return spike_index
+
+    def restrict(self, start, stop):
+
+        """ Index of only the spikes in positions start:stop, without re-sorting
+
+        The spikes of each cluster stay contiguous and ascending, so this is a
+        single pass over `order`. Indices in the new index are relative to 
+        start (i.e. they index into spike_array[start:stop]).
+        """
+
+        keep = (self.order >= start) * (self.order < stop)
+
+        kept_before = np.zeros((keep.size + 1,), dtype = 'int64')
+        kept_before[1:] = np.cumsum(keep)
+
+        bounds = np.zeros((self.counts.size + 1,), dtype = 'int64')
+        bounds[1:] = np.cumsum(self.counts)
+        counts = np.diff(kept_before[bounds])
+
+        return SpikeIndex.from_arrays(self.order[keep] - start, counts, self.total_units)
+
+    def spikes_for(self, cluster_id):
+
+        """ Indices (into the original spike arrays) of the spikes for one cluster """
+
+        return self.order[self.offsets[cluster_id]:self.offsets[cluster_id + 1]]
+
+    def sort(self, values):
+
+        """ Returns a copy of a per-spike array with all spikes grouped by cluster """
+
+        return values[self.order]
+
+    def sorted_clusters(self):
+
+        """ Cluster ID for each spike in cluster-sorted order """
+
+        return np.repeat(np.arange(self.total_units), self.counts[:self.total_units])
+
+
+class ClusterTemplateCounts():
+
+    """
+    Number of spikes of each cluster found with each template (a sparse
+    cluster x template contingency matrix)
+
+    Built in one pass over the spikes, in blocks so that memory stays
+    bounded; more spikes can be added later (e.g. one block of a memory-
+    mapped recording at a time). Gives every cluster's spike count,
+    majority template and template purity without a scan of the spike
+    arrays per cluster.
+
+    """
+
+    def __init__(self, spike_clusters = None, spike_templates = None, total_units = 0, num_templates = 0):
+
+        """
+        spike_clusters : numpy.ndarray (num_spikes x 0) (optional)
+            Cluster IDs for each spike
+        spike_templates : numpy.ndarray (num_spikes x 0) (optional)
+            Template IDs for each spike
+        total_units, num_templates : int (optional)
+            Minimum size of the matrix; it grows to fit the spikes
+        """
+
+        from scipy.sparse import csr_matrix
+
+        self.matrix = csr_matrix((total_units, num_templates), dtype = 'int64')
+
+        if spike_clusters is not None:
+            self.add(spike_clusters, spike_templates)
+
+    @property
+    def total_units(self):
+
+        return self.matrix.shape[0]
+
+    @property
+    def num_templates(self):
+
+        return self.matrix.shape[1]
+
+    def add(self, spike_clusters, spike_templates, block_size = 2**24):
+
+        """ Counts more spikes """
+
+        from scipy.sparse import csr_matrix
+
+        spike_clusters = np.asarray(spike_clusters).ravel()
+        spike_templates = np.asarray(spike_templates).ravel()
+
+        for start in range(0, spike_clusters.size, block_size):
+
+            clusters = spike_clusters[start:start + block_size].astype('int64')
+            templates = spike_templates[start:start + block_size].astype('int64')
+
+            shape = (max(self.total_units, int(np.max(clusters)) + 1),
+                     max(self.num_templates, int(np.max(templates)) + 1))
+
+            if shape != self.matrix.shape:
+                self.matrix.resize(shape)
+
+            # duplicate (cluster, template) entries are summed
+            self.matrix = self.matrix + csr_matrix((np.ones((clusters.size,), dtype = 'int64'), (clusters, templates)),
+                                                   shape = shape)
+
+        self.matrix.sum_duplicates()
+
+    def spike_counts(self):
+
+        """ Number of spikes in each cluster """
+
+        return np.asarray(self.matrix.sum(1)).ravel()
+
+    def cluster_ids(self):
+
+        """ Clusters with at least one spike, in ascending order """
+
+        return np.flatnonzero(np.diff(self.matrix.indptr))
+
+    def majority_templates(self, unassigned = -1):
+
+        """ Most common template of each cluster
+
+        Ties go to the lowest template ID (as np.argmax of np.bincount);
+        clusters without spikes get the value unassigned.
+        """
+
+        majority = np.zeros((self.total_units,), dtype = 'int64') + unassigned
+
+        cluster_ids = self.cluster_ids()
+
+        if cluster_ids.size == 0:
+            return majority
+
+        indptr = self.matrix.indptr
+        data = self.matrix.data
+        row_lengths = np.diff(indptr)
+
+        row_max = np.maximum.reduceat(data, indptr[cluster_ids])
+        is_max = data == np.repeat(row_max, row_lengths[cluster_ids])
+
+        # column indices are sorted within each row, so the first maximum has the lowest template ID
+        first_max = np.minimum.reduceat(np.where(is_max, np.arange(data.size), data.size), indptr[cluster_ids])
+        majority[cluster_ids] = self.matrix.indices[first_max]
+
+        return majority
+
+    def purity(self):
+
+        """ Fraction of each cluster's spikes found with its majority template (NaN if no spikes) """
+
+        counts = self.spike_counts()
+        purity = np.zeros((self.total_units,)) + np.nan
+
+        cluster_ids = self.cluster_ids()
+
+        if cluster_ids.size > 0:
+            row_max = np.maximum.reduceat(self.matrix.data, self.matrix.indptr[cluster_ids])
+            purity[cluster_ids] = row_max / counts[cluster_ids]
+
+        return purity
+
+
+def channel_distances(channel_pos):
+
+    """ Distance between every pair of channels
+
+    Inputs:
+    -------
+    channel_pos : numpy.ndarray (num_channels x 2)
+        X and Z coordinates of each channel
+
+    Outputs:
+    --------
+    distances : numpy.ndarray (num_channels x num_channels)
+        distances[i, :] is the distance from channel i to every channel
+
+    """
+
+    x = channel_pos[:, 0]
+    z = channel_pos[:, 1]
+
+    return np.sqrt(np.square(x[np.newaxis, :] - x[:, np.newaxis]) + \
+                   np.square(z[np.newaxis, :] - z[:, np.newaxis]))
+
+
+class ChannelIndex():
+
+    """
+    Maps channels to the templates with PCs on them, and to the units
+    assigned to those templates (CSR layout, as in SpikeIndex)
+
+    Built once from pc_feature_ind, so finding the units near a channel is
+    a slice instead of a scan of pc_feature_ind and of the template
+    assignment of every unit. Also holds the channel distance matrix.
+
+    """
+
+    def __init__(self, pc_feature_ind, channel_pos, template_ids = None):
+
+        """
+        pc_feature_ind : numpy.ndarray (num_templates x num_pc_channels)
+            Channels of the PCs for each template
+        channel_pos : numpy.ndarray (num_channels x 2)
+            X and Z coordinates of each channel
+        template_ids : numpy.ndarray (num_units x 0) (optional)
+            Template assigned to each unit (values without a template are ignored)
+        """
+
+        pc_feature_ind = np.asarray(pc_feature_ind)
+        channels = pc_feature_ind.ravel().astype('int64')
+
+        self.num_templates = pc_feature_ind.shape[0]
+        self.num_channels = max(channel_pos.shape[0], int(np.max(channels)) + 1 if channels.size > 0 else 0)
+        self.distances = channel_distances(channel_pos)
+
+        # templates with PCs on each channel, in ascending order (a template
+        # is listed once for each time the channel appears in its row)
+        order = np.argsort(channels, kind = 'stable')
+        self.templates = np.unravel_index(order, pc_feature_ind.shape)[0]
+        self.template_offsets = np.zeros((self.num_channels + 1,), dtype = 'int64')
+        self.template_offsets[1:] = np.cumsum(np.bincount(channels, minlength = self.num_channels))
+
+        self.units = None
+        self.unit_offsets = None
+
+        if template_ids is not None:
+            self.assign_units(template_ids)
+
+    def assign_units(self, template_ids):
+
+        """ Indexes the units of each channel for a (new) template assignment """
+
+        template_ids = np.asarray(template_ids).astype('int64')
+        has_template = template_ids < self.num_templates
+
+        # units of each template, in ascending order
+        units_by_template = np.flatnonzero(has_template)[np.argsort(template_ids[has_template], kind = 'stable')]
+        units_per_template = np.bincount(template_ids[has_template], minlength = self.num_templates)
+        template_starts = np.cumsum(units_per_template) - units_per_template
+
+        # for each channel, the units of each of its templates in turn
+        counts = units_per_template[self.templates]
+        total = np.sum(counts)
+        block_starts = np.cumsum(counts) - counts
+        positions = np.arange(total) - np.repeat(block_starts - template_starts[self.templates], counts)
+
+        self.units = units_by_template[positions]
+        self.unit_offsets = np.zeros((self.num_channels + 1,), dtype = 'int64')
+        self.unit_offsets[1:] = np.cumsum(np.add.reduceat(np.append(counts, 0), self.template_offsets[:-1]) * \
+                                          (np.diff(self.template_offsets) > 0))
+
+    def templates_for(self, channel):
+
+        """ Templates with PCs on one channel """
+
+        return self.templates[self.template_offsets[channel]:self.template_offsets[channel + 1]]
+
+    def units_for(self, channel):
+
+        """ Units whose template has PCs on one channel """
+
+        return self.units[self.unit_offsets[channel]:self.unit_offsets[channel + 1]]
+
+    def channels_within(self, channel, radius):
+
+        """ Channels closer than radius to one channel """
+
+        return np.where(self.distances[channel] < radius)[0]
+
+
+# upper bound on the size of each block read from a memory-mapped array
+CHUNK_BYTES = 64 * 1024 * 1024
+
+def row_chunks(array, num_rows = None, chunk_bytes = CHUNK_BYTES):
+
+    """
+    Yields (start, stop) bounds of blocks of rows no larger than chunk_bytes
+
+    Inputs:
+    -------
+    array : numpy.ndarray
+        Array whose rows will be read (only shape and dtype are used)
+    num_rows : int (optional)
+        Number of rows to split; defaults to array.shape[0]
+    chunk_bytes : int (optional)
+        Maximum number of bytes per block
+
+    """
+
+    if num_rows is None:
+        num_rows = array.shape[0]
+
+    row_bytes = array.dtype.itemsize * int(np.prod(array.shape[1:]))
+    rows_per_chunk = max(1, chunk_bytes // max(row_bytes, 1))
+
+    for start in range(0, num_rows, rows_per_chunk):
+        yield start, min(start + rows_per_chunk, num_rows)
+
+
+def gather_rows(array, rows, chunk_bytes = CHUNK_BYTES):
+
+    """
+    Copies array[rows] in blocks of bounded size
+
+    For a memory-mapped array only the pages holding the selected rows are
+    read, and no temporary larger than chunk_bytes is created.
+
+    Inputs:
+    -------
+    array : numpy.ndarray or numpy.memmap
+        Source array
+    rows : numpy.ndarray
+        Boolean mask or integer indices along the first dimension
+
+    Outputs:
+    --------
+    out : numpy.ndarray
+        In-memory copy of the selected rows
+
+    """
+
+    rows = np.asarray(rows)
+
+    if rows.dtype == bool:
+        rows = np.flatnonzero(rows)
+
+    out = np.empty((rows.size,) + array.shape[1:], dtype = array.dtype)
+
+    for start, stop in row_chunks(array, rows.size, chunk_bytes):
+        out[start:stop] = array[rows[start:stop]]
+
+    return out
+
+
+def select_rows(array, mask):
+
+    """
+    Rows of an array selected by a boolean mask, without a copy if possible
+
+    If the selected rows form one contiguous block (e.g. an epoch of a 
+    time-sorted spike array), a view is returned (see memmap_rows), which 
+    stays lazy for memory-mapped arrays. Otherwise the rows are copied with
+    gather_rows.
+
+    """
+
+    rows = np.flatnonzero(mask)
+
+    if rows.size == 0:
+        return array[0:0]
+
+    if rows[-1] - rows[0] + 1 == rows.size:
+        return memmap_rows(array, rows[0], rows[-1] + 1)
+
+    return gather_rows(array, rows)
+
+
+def write_rows(filename, array, rows, chunk_bytes = CHUNK_BYTES):
+
+    """
+    Writes array[rows] to a new .npy file in blocks of bounded size
+
+    Outputs:
+    --------
+    out : numpy.memmap
+        The new file, opened read-only
+
+    """
+
+    rows = np.asarray(rows)
+
+    if rows.dtype == bool:
+        rows = np.flatnonzero(rows)
+
+    out = np.lib.format.open_memmap(filename, mode = 'w+', dtype = array.dtype, 
+                                    shape = (rows.size,) + array.shape[1:])
+
+    for start, stop in row_chunks(array, rows.size, chunk_bytes):
+        out[start:stop] = array[rows[start:stop]]
+
+    out.flush()
+    del out
+
+    return np.load(filename, mmap_mode = 'r')
+
+
+def snippet_batches(raw_data, starts, samples_per_spike, chunk_bytes = CHUNK_BYTES, blocks = None):
+
+    """
+    Reads spike snippets in time order, one block of raw_data at a time
+
+    Blocks of consecutive rows are read sequentially (each extended by one
+    snippet length so that every snippet starting in the block is complete),
+    and blocks without spikes are skipped.
+
+    Inputs:
+    -------
+    raw_data : numpy.ndarray or numpy.memmap (samples x channels)
+    starts : numpy.ndarray
+        First sample of each snippet, sorted, with every snippet inside raw_data
+    samples_per_spike : int
+    chunk_bytes : int (optional)
+        Size of the blocks read at once; also bounds a float64 copy of a batch
+    blocks : list of (start, stop) (optional)
+        Blocks of rows to read, in order; defaults to all of raw_data in
+        blocks of chunk_bytes
+
+    Yields:
+    -------
+    index : numpy.ndarray
+        Positions in starts of the snippets in the batch
+    snippets : numpy.ndarray (spikes x samples x channels)
+        Snippets in the dtype of raw_data
+
+    """
+
+    num_samples = raw_data.shape[0]
+    window = np.arange(samples_per_spike)
+
+    snippet_bytes = 8 * samples_per_spike * int(np.prod(raw_data.shape[1:]))
+    batch_spikes = max(1, chunk_bytes // snippet_bytes)
+
+    if blocks is None:
+        blocks = row_chunks(raw_data, chunk_bytes = chunk_bytes)
+
+    for block_start, block_end in blocks:
+
+        first, last = np.searchsorted(starts, [block_start, block_end])
+
+        if first == last:
+            continue
+
+        block = np.asarray(raw_data[block_start:min(block_end + samples_per_spike, num_samples)])
+
+        for batch_start in range(first, last, batch_spikes):
+
+            index = np.arange(batch_start, min(batch_start + batch_spikes, last))
+
+            yield index, block[(starts[index] - block_start)[:, np.newaxis] + window]
+
+
+class WaveformAccumulator:
+
+    """
+    Running count, mean and sum of squared deviations (M2) of spike snippets
+
+    Each batch of snippets is reduced to per-group statistics and merged
+    into the running ones (Welford's update, in the pairwise form of Chan
+    et al.), so memory is independent of the number of spikes per group.
+
+    Parameters:
+    -----------
+    num_groups : int
+    samples_per_spike : int
+    num_channels : int
+    dtype : str or numpy.dtype
+        'float32' or 'float64'; precision of the running mean and M2
+    out : tuple of numpy.ndarray (optional)
+        Zeroed (count, mean, M2) arrays to accumulate into, of shapes 
+        (num_groups), (num_groups x samples_per_spike x num_channels) twice,
+        e.g. views of shared memory
+
+    """
+
+    def __init__(self, num_groups, samples_per_spike, num_channels, dtype = 'float64', out = None):
+
+        if out is not None:
+            self.count, self.mean, self.M2 = out
+            return
+
+        self.count = np.zeros(num_groups, dtype = 'int64')
+        self.mean = np.zeros((num_groups, samples_per_spike, num_channels), dtype = dtype)
+        self.M2 = np.zeros((num_groups, samples_per_spike, num_channels), dtype = dtype)
+
+    def add(self, groups, snippets):
+
+        """ Adds snippets (spikes x samples x channels) to their groups """
+
+        order = np.argsort(groups, kind = 'stable')
+        groups = groups[order]
+        snippets = snippets[order].astype(self.mean.dtype)
+
+        unique_groups, first = np.unique(groups, return_index = True)
+        count = np.diff(np.append(first, groups.size))
+
+        mean = np.add.reduceat(snippets, first, axis = 0) / count[:, np.newaxis, np.newaxis]
+        snippets -= np.repeat(mean, count, axis = 0)
+        M2 = np.add.reduceat(np.square(snippets), first, axis = 0)
+
+        self.merge(unique_groups, count, mean, M2)
+
+    def merge(self, groups, count, mean, M2):
+
+        """ Merges the statistics of other sets of snippets (e.g. from statistics()) into groups """
+
+        count_a = self.count[groups][:, np.newaxis, np.newaxis]
+        count_b = count[:, np.newaxis, np.newaxis]
+        total = count_a + count_b
+
+        delta = mean - self.mean[groups]
+
+        self.mean[groups] += delta * (count_b / total)
+        self.M2[groups] += M2 + np.square(delta) * (count_a * count_b / total)
+        self.count[groups] += count
+
+    def statistics(self):
+
+        """ Groups with snippets, with their count, mean and M2 """
+
+        groups = np.flatnonzero(self.count)
+
+        return groups, self.count[groups], self.mean[groups], self.M2[groups]
+
+    def mean_std(self, scale = 1.0):
+
+        """
+        Mean and standard deviation (ddof = 0) of each group, times scale
+
+        Outputs:
+        --------
+        mean, std : numpy.ndarray (groups x channels x samples)
+            float64; NaN for groups without snippets
+
+        """
+
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+
+            count = self.count[:, np.newaxis, np.newaxis]
+            mean = np.where(count > 0, self.mean, np.nan).astype('float64')
+            std = np.sqrt(self.M2 / count).astype('float64')
+
+        return np.transpose(mean * scale, (0, 2, 1)), np.transpose(std * scale, (0, 2, 1))
+
+
+def file_location(array):
+
+    """
+    File name and byte offset of a memory-mapped array opened at its own location
+
+    These are the filename and offset attributes of a numpy.memmap opened 
+    by np.memmap, np.load(mmap_mode = ...), open_binary or memmap_rows. A
+    slice or reshape of such an array keeps the offset of the whole array,
+    so it gives None, as do arrays that are not memory-mapped.
+
+    Outputs:
+    --------
+    (filename, offset) : tuple or None
+
+    """
+
+    if isinstance(array, np.memmap) and array.filename is not None and array.flags.c_contiguous \
+            and not isinstance(array.base, np.ndarray):
+        return array.filename, array.offset
+
+    return None
+
+
+def open_binary(filename, num_channels, dtype = 'int16', mode = 'r'):
+
+    """ Memory-maps a flat binary file of interleaved channels as (samples x num_channels) """
+
+    dtype = np.dtype(dtype)
+    num_samples = os.path.getsize(filename) // (dtype.itemsize * num_channels)
+
+    return np.memmap(filename, dtype = dtype, mode = mode, shape = (num_samples, num_channels))
+
+
+def memmap_rows(array, first, last):
+
+    """
+    Rows [first, last) of an array, without a copy
+
+    For a memory-mapped file opened at its own location (see file_location),
+    the rows are opened as a memmap of their own, so that their location 
+    in the file stays known (e.g. to share_array); other arrays are sliced.
+
+    """
+
+    location = file_location(array)
+
+    if location is None or last <= first:
+        return array[first:last]
+
+    row_bytes = array.dtype.itemsize * int(np.prod(array.shape[1:]))
+
+    return np.memmap(location[0], dtype = array.dtype, mode = 'r' if array.mode == 'r' else 'r+',
+                     offset = location[1] + first * row_bytes, shape = (last - first,) + array.shape[1:])
+
+
+def share_array(array):
+
+    """
+    Copies an array into a new block of shared memory
+
+    Worker processes attach to the block with attach_shared_array instead of
+    receiving a pickled copy of the array. The caller owns the block and must
+    call close() and unlink() on it when the workers are done.
+
+    Memory-mapped arrays opened at their own location (see file_location)
+    are not copied: the workers re-open the same file read-only, and shm is
+    None. Slices of memory-mapped arrays are copied; take them with 
+    memmap_rows to avoid that.
+
+    Inputs:
+    -------
+    array : numpy.ndarray or numpy.memmap
+
+    Outputs:
+    --------
+    shm : multiprocessing.shared_memory.SharedMemory
+        Handle for the shared block (None for memory-mapped arrays)
+    spec : dict
+        Location, shape and dtype to pass to attach_shared_array
+
+    """
+
+    from multiprocessing import shared_memory
+
+    location = file_location(array)
+
+    if location is not None:
+        return None, {'filename' : location[0], 'offset' : location[1], 
+                      'shape' : array.shape, 'dtype' : array.dtype.str}
+
+    array = np.asarray(array)
+    shm = shared_memory.SharedMemory(create = True, size = max(array.nbytes, 1))
+    shared = np.ndarray(array.shape, dtype = array.dtype, buffer = shm.buf)
+    shared[...] = array
+
+    return shm, {'name' : shm.name, 'shape' : array.shape, 'dtype' : array.dtype.str}
+
+
+def shared_zeros(shape, dtype):
+
+    """
+    New zeroed array in a block of shared memory
+
+    As for share_array, but without an array to copy; workers attach with
+    attach_shared_array(spec, writeable = True) to fill it in.
+
+    Outputs:
+    --------
+    shm : multiprocessing.shared_memory.SharedMemory
+    spec : dict
+    array : numpy.ndarray
+        The caller's view of the block
+
+    """
+
+    from multiprocessing import shared_memory
+
+    dtype = np.dtype(dtype)
+    shm = shared_memory.SharedMemory(create = True, size = max(int(np.prod(shape)) * dtype.itemsize, 1))
+    array = np.ndarray(shape, dtype = dtype, buffer = shm.buf)
+    array[...] = 0
+
+    return shm, {'name' : shm.name, 'shape' : tuple(shape), 'dtype' : dtype.str}, array
+
+
+def attach_shared_array(spec, writeable = False):
+
+    """
+    Opens a view of an array created by share_array or shared_zeros
+
+    Returns the SharedMemory handle (which must be kept alive as long as the
+    view is used; None for memory-mapped arrays) and the array view, which
+    is read-only unless writeable is set (shared memory only).
+
+    """
+
+    from multiprocessing import shared_memory
+
+    if 'filename' in spec:
+        array = np.memmap(spec['filename'], dtype = np.dtype(spec['dtype']), mode = 'r', 
+                          offset = spec['offset'], shape = spec['shape'])
+        return None, array
+
+    shm = shared_memory.SharedMemory(name = spec['name'])
+
+    array = np.ndarray(spec['shape'], dtype = np.dtype(spec['dtype']), buffer = shm.buf)
+    array.flags.writeable = writeable
+
+    return shm, array
+
+
+def scatter_pcs_to_channels(pc_features, spike_templates, pc_feature_ind, spike_inds = None, sparse = False):
+
+    """
+    Places each spike's PC features in columns for the channels they came from
+
+    Kilosort stores PCs for a small block of channels per template; this builds
+    the matrix used for silhouette scores and t-SNE, in which every spike has
+    one column per (PC, channel): column = channel + max(pc_feature_ind) * pc.
+    Columns of neighboring PCs overlap at the highest channel; as in the 
+    original per-spike loop, the later PC overwrites the earlier one.
+
+    Inputs:
+    -------
+    pc_features : numpy.ndarray (num_spikes x num_pcs x num_template_channels)
+        PC features for each spike (may be memory-mapped)
+    spike_templates : numpy.ndarray (num_spikes x 0)
+        Template ID for each spike
+    pc_feature_ind : numpy.ndarray (num_templates x num_template_channels)
+        Channels used for PC calculation for each template
+    spike_inds : numpy.ndarray (optional)
+        Spikes to include (one row each, in this order); defaults to all spikes
+    sparse : bool (optional)
+        If True, return a scipy.sparse.csr_matrix instead of a dense array
+
+    Outputs:
+    --------
+    all_pcs : numpy.ndarray or scipy.sparse.csr_matrix (len(spike_inds) x num_pcs * max(pc_feature_ind) + 1)
+
+    """
+
+    spike_templates = np.squeeze(spike_templates)
+
+    if spike_inds is None:
+        spike_inds = np.arange(pc_features.shape[0])
+
+    num_pc_features = pc_features.shape[1]
+    max_channel = int(np.max(pc_feature_ind))
+    num_rows = len(spike_inds)
+    num_columns = max_channel * num_pc_features + 1
+
+    values = gather_rows(pc_features, spike_inds)
+    channels = pc_feature_ind[spike_templates[spike_inds], :]
+
+    # (num_rows x num_pcs x num_template_channels), in the order the loop wrote them
+    rows = np.broadcast_to(np.arange(num_rows)[:, np.newaxis, np.newaxis], values.shape).ravel()
+    columns = (channels[:, np.newaxis, :] + max_channel * np.arange(num_pc_features)[np.newaxis, :, np.newaxis]).ravel()
+    values = values.ravel()
+
+    # keep only the last write to each (row, column)
+    keys = rows.astype('int64') * num_columns + columns
+    last_write = keys.size - 1 - np.unique(keys[::-1], return_index = True)[1]
+    rows, columns, values = rows[last_write], columns[last_write], values[last_write]
+
+    if sparse:
+        from scipy.sparse import csr_matrix
+        return csr_matrix((values.astype('float64'), (rows, columns)), shape = (num_rows, num_columns))
+
+    all_pcs = np.zeros((num_rows, num_columns))
+    all_pcs[rows, columns] = values
+
+    return all_pcs
+
+
 def get_spike_depths(spike_clusters, unit_template_ids, first_pc_sq, pc_feature_ind, channel_pos):
 
     """
@@ -595,12 +1473,30 @@ def catGT_ex_params_from_str(ex_str):
 def getSortResults(output_dir, clu_version):
     # load results from phy for run logging and creation of the table for C_Waves
 
+    clus_Table, nTemplate, nTot = sortResultsTable(output_dir)
+
+    if clu_version == 0:
+        np.save(os.path.join(output_dir, 'clus_Table.npy'), clus_Table)
+    else:
+        clu_Name = 'clus_Table_' + repr(clu_version) + '.npy'
+        np.save(os.path.join(output_dir, clu_Name), clus_Table)
+ 
+    return nTemplate, nTot
+
+def sortResultsTable(output_dir):
+    # table for C_Waves of the spike count and peak channel of each label,
+    # returned rather than saved, along with the template and spike counts
+
     cluLabel = np.load(os.path.join(output_dir, 'spike_clusters.npy'))
     spkTemplate = np.load(os.path.join(output_dir,'spike_templates.npy'))
     cluLabel = np.squeeze(cluLabel)
     spkTemplate = np.squeeze(spkTemplate)
 
-    unqLabel, labelCounts = np.unique(cluLabel, return_counts = True)
+    # spikes of each label found with each template, in one pass
+    template_counts = ClusterTemplateCounts(cluLabel, spkTemplate)
+    unqLabel = template_counts.cluster_ids()
+    labelCounts = template_counts.spike_counts()[unqLabel]
+    template_modes = template_counts.majority_templates()[unqLabel]
     nTot = cluLabel.shape[0]
     nLabel = unqLabel.shape[0]
     maxLabel = np.max(unqLabel)
@@ -624,8 +1520,7 @@ def getSortResults(output_dir, clu_version):
     # the whitening matrix (nchan x nchan); get max and min along tthe time axis (1)
     # to find the peak channel
     for i in np.arange(0,nLabel):
-        curr_spkTemplate = spkTemplate[np.where(cluLabel==unqLabel[i])]
-        template_mode = np.argmax(np.bincount(curr_spkTemplate))
+        template_mode = template_modes[i]
         currT = templates[template_mode,:].T
         curr_unwh = np.matmul(w_inv, currT)
         currdiff = np.max(curr_unwh,1) - np.min(curr_unwh,1)
@@ -635,13 +1530,7 @@ def getSortResults(output_dir, clu_version):
     clus_Table[unqLabel, 0] = labelCounts
     clus_Table[unqLabel, 1] = peak_channels
 
-    if clu_version == 0:
-        np.save(os.path.join(output_dir, 'clus_Table.npy'), clus_Table)
-    else:
-        clu_Name = 'clus_Table_' + repr(clu_version) + '.npy'
-        np.save(os.path.join(output_dir, clu_Name), clus_Table)
- 
-    return nTemplate, nTot
+    return clus_Table, nTemplate, nTot
 
 def getFileVersion(input_filePath):
     
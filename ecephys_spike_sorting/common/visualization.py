@@ -6,6 +6,7 @@ from scipy.signal import butter, filtfilt, medfilt
 from .utils import (get_spike_depths, 
                     get_spike_amplitudes,
                     load_kilosort_data,
+                    scatter_pcs_to_channels,
                     rms)
 
 
@@ -372,19 +373,12 @@ def plotFullProbeTSNE(ks_directory, total_spikes=150000, exclude_noise = True, f
 
     random_spike_inds = np.random.permutation(spikes_from_good_units.size)
     random_spike_inds = random_spike_inds[:total_spikes]
-    num_pc_features = pc_features.shape[1]
 
     good_spike_clusters = spike_clusters[spikes_from_good_units]
 
-    all_pcs = np.zeros((total_spikes, np.max(pc_feature_ind) * num_pc_features + 1))
-
-    for idx, i in enumerate(random_spike_inds):
-        
-        unit_id = good_spike_clusters[i]
-        channels = pc_feature_ind[unit_id,:]
-        
-        for j in range(0,num_pc_features):
-            all_pcs[idx, channels + np.max(pc_feature_ind) * j] = pc_features[i,j,:]
+    # channels are looked up by the template that extracted each spike
+    all_pcs = scatter_pcs_to_channels(pc_features, spike_templates, pc_feature_ind, 
+                                      spikes_from_good_units[random_spike_inds])
 
     print("Computing T-SNE")
     Z = fast_tsne(all_pcs, perplexity=50, seed=42)
@@ -5,6 +5,7 @@ import numpy as np
 from .metrics import compare_templates, make_interp_temp, compute_isi_score, compute_isi_score
 from .merges import compute_overall_score, ID_merge_groups, make_merges
 from ...common.spike_template_helpers import find_depth
+from ...common.utils import SpikeIndex
 
 def automerging(spike_times, spike_clusters, clusterIDs, cluster_quality, templates, params):
 
@@ -39,19 +40,21 @@ def automerging(spike_times, spike_clusters, clusterIDs, cluster_quality, templa
 
     max_time = np.max(spike_times)
 
+    spike_index = SpikeIndex(spike_clusters)
+
     for i in range(0,depths.size):
 
         if is_good[i]:
             
             temp1 = make_interp_temp(templates,[clusterIDs[i]]) #
-            times1 = spike_times[spike_clusters == clusterIDs[i]]
+            times1 = spike_times[spike_index.spikes_for(clusterIDs[i])]
             
             for j in range(i+1,depths.size):
                 
                 if comparison_matrix[i,j,0] == 1:
                     
                     temp2 = make_interp_temp(templates, [clusterIDs[j]]) #
-                    times2 = spike_times[spike_clusters == clusterIDs[j]]
+                    times2 = spike_times[spike_index.spikes_for(clusterIDs[j])]
                     
                     rms, offset_distance = compare_templates(temp1, temp2) #
                    # overlap = percent_overlap(times1, times2, min_t, max_t, 50) #
@@ -7,6 +7,7 @@ import time
 import numpy as np
 
 from ...common.utils import load_kilosort_data, getSortResults
+from ...common.result_cache import run_cached, kilosort_files, KILOSORT_PC_FILES
 
 from .postprocessing import remove_double_counted_spikes
 from .postprocessing import align_spike_times
@@ -31,7 +32,8 @@ def run_postprocessing(args):
                         args['ephys_params']['sample_rate'], \
                         convert_to_seconds = False, \
                         use_master_clock = False, \
-                        include_pcs = include_pcs )
+                        include_pcs = include_pcs, \
+                        mmap_features = args['ks_postprocessing_params']['mmap_features'] )
     else:
         spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
         channel_pos, clusterIDs, cluster_quality, cluster_amplitude = \
@@ -50,7 +52,10 @@ def run_postprocessing(args):
                                         spike_clusters,
                                         args['ephys_params']['ap_band_file'], 
                                         args['directories']['kilosort_output_directory'], 
-                                        args['ks_postprocessing_params']['cWaves_path'])
+                                        args['ks_postprocessing_params']['cWaves_path'],
+                                        engine = args['ks_postprocessing_params']['cWaves_engine'],
+                                        num_channels = args['ephys_params']['num_channels'],
+                                        bit_volts = args['ephys_params']['bit_volts'])
         
     if args['ks_postprocessing_params']['remove_duplicates']:
         spike_times, spike_clusters, spike_templates, amplitudes, pc_features, \
@@ -80,8 +85,19 @@ def run_postprocessing(args):
     np.save(os.path.join(output_dir, 'spike_templates.npy'), spike_templates)
     
     if args['ks_postprocessing_params']['include_pcs']:
-        np.save(os.path.join(output_dir, 'pc_features.npy'), pc_features)
-        np.save(os.path.join(output_dir, 'template_features.npy'), template_features)
+        if isinstance(pc_features, np.memmap):
+            # memory-mapped features were rewritten to new files by remove_double_counted_spikes;
+            # close the mappings and move those files into place
+            feature_files = [(pc_features.filename, 'pc_features.npy'), 
+                             (template_features.filename, 'template_features.npy')]
+            del pc_features, template_features
+            for source, name in feature_files:
+                target = os.path.join(output_dir, name)
+                if not (os.path.exists(target) and os.path.samefile(source, target)):
+                    os.replace(source, target)
+        else:
+            np.save(os.path.join(output_dir, 'pc_features.npy'), pc_features)
+            np.save(os.path.join(output_dir, 'template_features.npy'), template_features)
     
     if args['ks_postprocessing_params']['remove_duplicates']:
         np.save(os.path.join(output_dir, 'overlap_matrix.npy'), overlap_matrix)
@@ -97,6 +113,32 @@ def run_postprocessing(args):
     return {"execution_time" : execution_time} # output manifest
 
 
+def cache_files(args):
+
+    """ Files read and written by this module, for the result cache """
+
+    output_dir = args['directories']['kilosort_output_directory']
+    params = args['ks_postprocessing_params']
+
+    # the spike (and feature) files are rewritten in place, so they are both inputs and outputs
+    input_files = kilosort_files(output_dir)
+    output_files = kilosort_files(output_dir, ('spike_times.npy', 'amplitudes.npy', 'spike_clusters.npy', 'spike_templates.npy'))
+
+    if params['include_pcs']:
+        input_files += kilosort_files(output_dir, KILOSORT_PC_FILES)
+        output_files += kilosort_files(output_dir, ('pc_features.npy', 'template_features.npy'))
+
+    if params['align_avg_waveform']:
+        input_files.append(args['ephys_params']['ap_band_file'])
+        if params['cWaves_engine'] == 'external':
+            output_files += kilosort_files(output_dir, ('clus_Table.npy', 'preprocess_mean_waveforms.npy', 'preprocess_cluster_snr.npy'))
+
+    if params['remove_duplicates']:
+        output_files += kilosort_files(output_dir, ('overlap_matrix.npy', 'overlap_summary.npy', 'overlap_summary.csv'))
+
+    return input_files, output_files
+
+
 def main():
 
     from ._schemas import InputParameters, OutputParameters
@@ -105,7 +147,7 @@ def main():
     mod = ArgSchemaParser(schema_type=InputParameters,
                           output_schema_type=OutputParameters)
 
-    output = run_postprocessing(mod.args)
+    output = run_cached('kilosort_postprocessing', mod.args, run_postprocessing, *cache_files(mod.args))
 
     output.update({"input_parameters": mod.args})
     if "output_json" in mod.args:
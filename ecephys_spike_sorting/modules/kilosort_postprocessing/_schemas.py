@@ -1,7 +1,8 @@
 from argschema import ArgSchema, ArgSchemaParser 
 from argschema.schemas import DefaultSchema
+from marshmallow.validate import OneOf
 from argschema.fields import Nested, InputDir, String, Float, Dict, Int, Boolean
-from ...common.schemas import EphysParams, Directories
+from ...common.schemas import EphysParams, Directories, CacheParams
 
 
 class PostprocessingParams(DefaultSchema):
@@ -10,15 +11,18 @@ class PostprocessingParams(DefaultSchema):
     between_unit_dist_um = Int(required=False, default=5, help='Number of channels (above and below peak channel) to search for overlapping spikes')
     deletion_mode = String(required=False, default='lowAmpCluster', help='lowAmpCluster or deleteFirst')
     include_pcs = Boolean(required=False, default=True, help='Set to false if features were not saved with Phy output')
+    mmap_features = Boolean(required=False, default=False, help='Set to true to memory-map pc_features.npy and template_features.npy; duplicate removal then rewrites them in bounded chunks')
     remove_duplicates = Boolean(required=False, default=True, help='Set to True for duplicate removal')
     align_avg_waveform = Boolean(required=False, default=True, help='Set to true to set spike times for mean waveform min = t0')
     cWaves_path = InputDir(require=False, help='directory containing the CWaves executable.')
+    cWaves_engine = String(required=False, default='external', validate=OneOf(['external', 'python']), help="'external' runs the CWaves executable in cWaves_path to align spike times; 'python' computes the mean waveforms in-process")
 
 class InputParameters(ArgSchema):
     
     ks_postprocessing_params = Nested(PostprocessingParams)
     directories = Nested(Directories)
     ephys_params = Nested(EphysParams)
+    cache_params = Nested(CacheParams, required=False, default={})
     
     
 class OutputSchema(DefaultSchema): 
@@ -4,8 +4,9 @@ import sys
 import subprocess
 from collections import OrderedDict
 
-from ...common.utils import printProgressBar
-from ...common.utils import getSortResults
+from ...common.utils import printProgressBar, SpikeIndex, write_rows, channel_distances
+from ...common.utils import getSortResults, sortResultsTable
+from ...common.c_waves import calculate_c_waves, open_spikeglx_bin
 
 def remove_double_counted_spikes(spike_times, spike_clusters, spike_templates, 
                                  amplitudes, channel_map, channel_pos, templates, pc_features, 
@@ -32,6 +33,9 @@ def remove_double_counted_spikes(spike_times, spike_clusters, spike_templates,
         Spike templates for each unit
     pc_features : numpy.ndarray (num_spikes x num_pcs x num_channels)
         Pre-computed PCs for blocks of channels around each spike
+        If pc_features and template_features are memory-mapped, the rows that
+        are kept are written to new .npy files next to the originals
+        (suffix '_deduplicated') in bounded chunks and returned memory-mapped
     pc_feature_ind : numpy.ndarray (num_units x num_channels)
         Channel indices of PCs for each unit
     sample_rate : Float
@@ -64,6 +68,11 @@ def remove_double_counted_spikes(spike_times, spike_clusters, spike_templates,
 
     """
     include_pcs = params['include_pcs']
+
+    # memory-mapped features are never copied into RAM: track the rows that
+    # survive both removal passes and write them out once at the end
+    mmap_features = include_pcs and isinstance(pc_features, np.memmap)
+    kept_spikes = np.arange(spike_times.size)
     
     # if Kilosort failed to save .tsv outputs for every template, 
     # ignore missing templates
@@ -93,11 +102,14 @@ def remove_double_counted_spikes(spike_times, spike_clusters, spike_templates,
 
     spikes_to_remove = np.zeros((0,), dtype = 'int')
 
+    total_units = max(num_clusters, int(np.max(spike_clusters)) + 1)
+    spike_index = SpikeIndex(spike_clusters, total_units)
+
     for idx1, unit_id1 in enumerate(sorted_unit_list):
 
         printProgressBar(idx1+1, len(unit_list))
 
-        for_unit1 = np.where(spike_clusters == unit_id1)[0]
+        for_unit1 = spike_index.spikes_for(unit_id1)
 
         to_remove = find_within_unit_overlap(spike_times[for_unit1], within_unit_overlap_samples)
 
@@ -112,38 +124,44 @@ def remove_double_counted_spikes(spike_times, spike_clusters, spike_templates,
                                                                         pc_features, 
                                                                         template_features, 
                                                                         spikes_to_remove,
-                                                                        include_pcs)
+                                                                        include_pcs and not mmap_features)
+    kept_spikes = np.delete(kept_spikes, spikes_to_remove)
 
     print('Removing between-unit overlapping spikes...')
 
     spikes_to_remove = np.zeros((0,), dtype = 'int')
 
+    # spikes have been removed, so the index has to be rebuilt
+    spike_index = SpikeIndex(spike_clusters, total_units)
+
+    # distance between the peak channels of every pair of units (in sorted order)
+    sorted_peak_chan_idx = peak_chan_idx[sorted_unit_list]
+    unit_distances = channel_distances(channel_pos)[np.ix_(sorted_peak_chan_idx, sorted_peak_chan_idx)]
+
     for idx1, unit_id1 in enumerate(sorted_unit_list):
 
         printProgressBar(idx1+1, len(unit_list))
 
-        for_unit1 = np.where(spike_clusters == unit_id1)[0]
+        for_unit1 = spike_index.spikes_for(unit_id1)
+
+        # units later in the list with peak channels in range
+        nearby = np.where(unit_distances[idx1, idx1+1:] < params['between_unit_dist_um'])[0] + idx1 + 1
         
-        for idx2, unit_id2 in enumerate(sorted_unit_list):
-            
-            deltaX = np.squeeze(channel_pos[peak_chan_idx[unit_id2],0] - channel_pos[peak_chan_idx[unit_id1],0])
-            deltaZ = np.squeeze(channel_pos[peak_chan_idx[unit_id2],1] - channel_pos[peak_chan_idx[unit_id1],1])
+        for idx2 in nearby:
+
+            unit_id2 = sorted_unit_list[idx2]
             
-            dist = pow( (pow(deltaX,2) + pow(deltaZ,2)), 0.5 )
+            amp1 = cluster_amplitude[unit_id1]
+            amp2 = cluster_amplitude[unit_id2]
             
-            if idx2 > idx1 and dist < params['between_unit_dist_um']:
-                
-                amp1 = cluster_amplitude[unit_id1]
-                amp2 = cluster_amplitude[unit_id2]
-                
-                for_unit2 = np.where(spike_clusters == unit_id2)[0]
+            for_unit2 = spike_index.spikes_for(unit_id2)
 
-                to_remove1, to_remove2 = find_between_unit_overlap(spike_times[for_unit1], spike_times[for_unit2], amp1, amp2, between_unit_overlap_samples, params['deletion_mode'] )
+            to_remove1, to_remove2 = find_between_unit_overlap(spike_times[for_unit1], spike_times[for_unit2], amp1, amp2, between_unit_overlap_samples, params['deletion_mode'] )
 
-                overlap_matrix[idx1, idx2] = overlap_matrix[idx1, idx2] + len(to_remove1) 
-                overlap_matrix[idx2, idx1] = overlap_matrix[idx2, idx1] + len(to_remove2)
+            overlap_matrix[idx1, idx2] = overlap_matrix[idx1, idx2] + len(to_remove1) 
+            overlap_matrix[idx2, idx1] = overlap_matrix[idx2, idx1] + len(to_remove2)
 
-                spikes_to_remove = np.concatenate((spikes_to_remove, for_unit1[to_remove1], for_unit2[to_remove2]))
+            spikes_to_remove = np.concatenate((spikes_to_remove, for_unit1[to_remove1], for_unit2[to_remove2]))
 
 
     spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features = remove_spikes(spike_times, 
@@ -153,12 +171,19 @@ def remove_double_counted_spikes(spike_times, spike_clusters, spike_templates,
                                                                          pc_features, 
                                                                          template_features, 
                                                                          np.unique(spikes_to_remove),
-                                                                         include_pcs)
+                                                                         include_pcs and not mmap_features)
+    kept_spikes = np.delete(kept_spikes, np.unique(spikes_to_remove))
+
+    if mmap_features:
+        pc_features = write_rows(deduplicated_filename(pc_features.filename), pc_features, kept_spikes)
+        template_features = write_rows(deduplicated_filename(template_features.filename), template_features, kept_spikes)
+
 #   build overlap summary 
+    spike_counts = np.bincount(spike_clusters, minlength = total_units)
     overlap_summary = np.zeros((num_clusters, 5), dtype=int )
     for idx1, unit_id1 in enumerate(sorted_unit_list):
         overlap_summary[idx1,0] = unit_id1
-        overlap_summary[idx1,1] = np.sum(spike_clusters == unit_id1)
+        overlap_summary[idx1,1] = spike_counts[unit_id1]
         overlap_summary[idx1,2] = overlap_matrix[idx1,idx1]
         overlap_summary[idx1,3] = np.sum(overlap_matrix[idx1,:]) - overlap_matrix[idx1,idx1]
         overlap_summary[idx1,4] = sorted_unit_list[np.argmax(overlap_matrix[idx1,:])]     
@@ -168,6 +193,15 @@ def remove_double_counted_spikes(spike_times, spike_clusters, spike_templates,
 
     return spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features, overlap_matrix, overlap_summary
 
+
+def deduplicated_filename(filename):
+
+    """ Name of the file that receives the rows of filename that were kept """
+
+    root, ext = os.path.splitext(filename)
+
+    return root + '_deduplicated' + ext
+
                 
 def find_within_unit_overlap(spike_train, overlap_window = 5):
 
@@ -351,53 +385,72 @@ def remove_spikes(spike_times, spike_clusters, spike_templates, amplitudes, pc_f
 
     return spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features
 
-def align_spike_times(spike_times, spike_clusters, spikeglx_bin, output_dir, cWaves_path):
+def align_spike_times(spike_times, spike_clusters, spikeglx_bin, output_dir, cWaves_path,
+                      engine = 'external', num_channels = 385, bit_volts = 2.34375):
     
-    print('Calculating mean waveforms for aligh_spike_times using C_waves.')
+    # engine = 'python' computes the mean waveforms in-process instead of
+    # running C_Waves; num_channels and bit_volts are only used in that case
+
+    if engine == 'python':
+
+        print('Calculating mean waveforms for align_spike_times in-process.')
+
+        clus_table = sortResultsTable(output_dir)[0]
+        data, num_ap_channels = open_spikeglx_bin(spikeglx_bin, num_channels)
+
+        mean_waveforms, snr_array = calculate_c_waves(data, spike_times, spike_clusters, clus_table, bit_volts,
+                                                      samples_per_spike = 82, pre_samples = 20, num_spikes = 5000,
+                                                      snr_radius = 8, num_channels = num_ap_channels)
 
-    # assume cluster table version = 0;
-    getSortResults(output_dir, 0)
+    else:
+
+        print('Calculating mean waveforms for aligh_spike_times using C_waves.')
+
+        # assume cluster table version = 0;
+        getSortResults(output_dir, 0)
      
-    # build paths to cluster and times tables, which are generated by
-    # kilosort_helper module
-    clus_table_npy = os.path.join(output_dir, 'clus_Table.npy' )
-    clus_time_npy = os.path.join(output_dir, 'spike_times.npy' )
-    clus_lbl_npy = os.path.join(output_dir, 'spike_clusters.npy' )
+        # build paths to cluster and times tables, which are generated by
+        # kilosort_helper module
+        clus_table_npy = os.path.join(output_dir, 'clus_Table.npy' )
+        clus_time_npy = os.path.join(output_dir, 'spike_times.npy' )
+        clus_lbl_npy = os.path.join(output_dir, 'spike_clusters.npy' )
     
-    # path to the 'runit.bat' executable that calls C_Waves.
-    # Essential in linux where C_Waves executable is only callable through runit
-    if sys.platform.startswith('win'):
-        exe_path = os.path.join(cWaves_path, 'runit.bat')
-    elif sys.platform.startswith('linux'):
-        exe_path = os.path.join(cWaves_path, 'runit.sh')
-    else:
-        print('unknown system, cannot run C_Waves')
+        # path to the 'runit.bat' executable that calls C_Waves.
+        # Essential in linux where C_Waves executable is only callable through runit
+        if sys.platform.startswith('win'):
+            exe_path = os.path.join(cWaves_path, 'runit.bat')
+        elif sys.platform.startswith('linux'):
+            exe_path = os.path.join(cWaves_path, 'runit.sh')
+        else:
+            print('unknown system, cannot run C_Waves')
     
-    cwaves_cmd = exe_path + ' -spikeglx_bin=' + spikeglx_bin + \
-                            ' -clus_table_npy=' + clus_table_npy + \
-                            ' -clus_time_npy=' + clus_time_npy + \
-                            ' -clus_lbl_npy=' + clus_lbl_npy + \
-                            ' -dest=' + output_dir + \
-                            ' -samples_per_spike=82' + \
-                            ' -pre_samples=20' + \
-                            ' -num_spikes=5000' + \
-                            ' -snr_radius=8' + \
-                            ' -prefix=preprocess'
+        cwaves_cmd = exe_path + ' -spikeglx_bin=' + spikeglx_bin + \
+                                ' -clus_table_npy=' + clus_table_npy + \
+                                ' -clus_time_npy=' + clus_time_npy + \
+                                ' -clus_lbl_npy=' + clus_lbl_npy + \
+                                ' -dest=' + output_dir + \
+                                ' -samples_per_spike=82' + \
+                                ' -pre_samples=20' + \
+                                ' -num_spikes=5000' + \
+                                ' -snr_radius=8' + \
+                                ' -prefix=preprocess'
                             
-    print(cwaves_cmd)
+        print(cwaves_cmd)
     
-    # make the C_Waves call
-    subprocess.call(cwaves_cmd)
+        # make the C_Waves call
+        subprocess.call(cwaves_cmd)
     
-    # load snr and waveform arrays
-    mean_waveform_fullpath = os.path.join(output_dir, 'preprocess_mean_waveforms.npy')
-    snr_fullpath = os.path.join(output_dir, 'preprocess_cluster_snr.npy')
+        # load snr and waveform arrays
+        mean_waveform_fullpath = os.path.join(output_dir, 'preprocess_mean_waveforms.npy')
+        snr_fullpath = os.path.join(output_dir, 'preprocess_cluster_snr.npy')
     
-    mean_waveforms = np.load(mean_waveform_fullpath)
-    snr_array = np.load(snr_fullpath)
+        mean_waveforms = np.load(mean_waveform_fullpath)
+        snr_array = np.load(snr_fullpath)
     (nClu, nChan, nt) = mean_waveforms.shape
     
     peak_t = 19   #because pre_samples in C_Waves set to 20
+
+    spike_index = SpikeIndex(spike_clusters, max(nClu, int(np.max(spike_clusters)) + 1))
     
     # Loop over units
     for i in range(nClu):
@@ -429,7 +482,7 @@ def align_spike_times(spike_times, spike_clusters, spikeglx_bin, output_dir, cWa
                
             deltat = peak_t - mean_peak_time
             # print('nClu, deltat: ' + repr(i) + ', ' +  repr(deltat) )
-            clu_ind = (spike_clusters == i)
+            clu_ind = spike_index.spikes_for(i)
             spike_times[clu_ind] = spike_times[clu_ind] - deltat
             
                 
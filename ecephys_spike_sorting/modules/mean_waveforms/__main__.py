@@ -6,16 +6,17 @@ import time
 import pathlib
 
 import numpy as np
-import pandas as pd
 from scipy.io import loadmat
 
 from ...common.utils import load_kilosort_data, write_cluster_group_tsv, read_cluster_group_tsv
 from ...common.utils import getSortResults
-from ...common.utils import getFileVersion
+from ...common.utils import getFileVersion, read_metrics, write_metrics, metrics_feather_file, open_binary
+from ...common.result_cache import run_cached, kilosort_files, versioned_files
 
 from .extract_waveforms import extract_waveforms, writeDataAsNpy
 from .waveform_metrics import calculate_waveform_metrics
 from .metrics_from_file import metrics_from_file
+from ...common.c_waves import calculate_c_waves, open_spikeglx_bin, write_c_waves_output
 
 def calculate_mean_waveforms(args):
 
@@ -71,30 +72,68 @@ def calculate_mean_waveforms(args):
             np.save(clus_lbl_npy,sc)
         
         
-        # path to the 'runit.bat' executable that calls C_Waves.
-        # Essential in linux where C_Waves executable is only callable through runit
-        if sys.platform.startswith('win'):
-            exe_path = os.path.join(args['mean_waveform_params']['cWaves_path'], 'runit.bat')
-        elif sys.platform.startswith('linux'):
-            exe_path = os.path.join(args['mean_waveform_params']['cWaves_path'], 'runit.sh')
+        # the channel_pos loaded from the phy output omits any sites excluded
+        # as noise by the kilosort_helper module, or excluded fow low spike rete
+        # by kilosort itself. The waveform metrics are calculated on ALL sites
+        # based on the mean waveforms calculated for each unit; therefore
+        # we need the site locations for all sites.
+        # load the channel map associated with this kilosort run; in kilosort_helper
+        # a copy is made next to the data file
+        input_file = args['ephys_params']['ap_band_file']
+        dat_dir, dat_fname = os.path.split(input_file)
+        dat_name, dat_ext = os.path.splitext(dat_fname)
+        chanMapMat = os.path.join(dat_dir, (dat_name +'_chanMap.mat'))
+        site_x = np.squeeze(loadmat(chanMapMat)['xcoords'])
+        site_y = np.squeeze(loadmat(chanMapMat)['ycoords'])
+
+        if args['mean_waveform_params']['cWaves_engine'] == 'python':
+
+            print('Calculating C_Waves outputs in-process.')
+
+            data, num_ap_channels = open_spikeglx_bin(spikeglx_bin, args['ephys_params']['num_channels'])
+
+            mean_waveforms, cluster_snr = calculate_c_waves(data,
+                                                            np.load(clus_time_npy),
+                                                            sc,
+                                                            np.load(clus_table_npy),
+                                                            args['ephys_params']['bit_volts'],
+                                                            args['mean_waveform_params']['samples_per_spike'],
+                                                            args['mean_waveform_params']['pre_samples'],
+                                                            args['mean_waveform_params']['spikes_per_epoch'],
+                                                            args['mean_waveform_params']['snr_radius'],
+                                                            args['mean_waveform_params']['snr_radius_um'],
+                                                            site_x, site_y,
+                                                            num_channels = num_ap_channels,
+                                                            chunk_bytes = args['mean_waveform_params']['chunk_size_mb'] * 2**20)
+
+            write_c_waves_output(dest, mean_waveforms, cluster_snr)
+
         else:
-            print('unknown system, cannot run C_Waves')
-        
-        cwaves_cmd = exe_path + ' -spikeglx_bin=' + spikeglx_bin + \
-                                ' -clus_table_npy=' + clus_table_npy + \
-                                ' -clus_time_npy=' + clus_time_npy + \
-                                ' -clus_lbl_npy=' + clus_lbl_npy + \
-                                ' -dest=' + dest + \
-                                ' -samples_per_spike=' + repr(args['mean_waveform_params']['samples_per_spike']) + \
-                                ' -pre_samples=' + repr(args['mean_waveform_params']['pre_samples']) + \
-                                ' -num_spikes=' + repr(args['mean_waveform_params']['spikes_per_epoch']) + \
-                                ' -snr_radius=' + repr(args['mean_waveform_params']['snr_radius']) + \
-                                ' -snr_radius_um=' + repr(args['mean_waveform_params']['snr_radius_um'])
+
+            # path to the 'runit.bat' executable that calls C_Waves.
+            # Essential in linux where C_Waves executable is only callable through runit
+            if sys.platform.startswith('win'):
+                exe_path = os.path.join(args['mean_waveform_params']['cWaves_path'], 'runit.bat')
+            elif sys.platform.startswith('linux'):
+                exe_path = os.path.join(args['mean_waveform_params']['cWaves_path'], 'runit.sh')
+            else:
+                print('unknown system, cannot run C_Waves')
+        
+            cwaves_cmd = exe_path + ' -spikeglx_bin=' + spikeglx_bin + \
+                                    ' -clus_table_npy=' + clus_table_npy + \
+                                    ' -clus_time_npy=' + clus_time_npy + \
+                                    ' -clus_lbl_npy=' + clus_lbl_npy + \
+                                    ' -dest=' + dest + \
+                                    ' -samples_per_spike=' + repr(args['mean_waveform_params']['samples_per_spike']) + \
+                                    ' -pre_samples=' + repr(args['mean_waveform_params']['pre_samples']) + \
+                                    ' -num_spikes=' + repr(args['mean_waveform_params']['spikes_per_epoch']) + \
+                                    ' -snr_radius=' + repr(args['mean_waveform_params']['snr_radius']) + \
+                                    ' -snr_radius_um=' + repr(args['mean_waveform_params']['snr_radius_um'])
                                 
-        print(cwaves_cmd)
+            print(cwaves_cmd)
         
-        # make the C_Waves call
-        subprocess.Popen(cwaves_cmd,shell='False').wait()
+            # make the C_Waves call
+            subprocess.Popen(cwaves_cmd,shell='False').wait()
         
         # for first version, retain original names
         if clu_version == 0:
@@ -122,19 +161,6 @@ def calculate_mean_waveforms(args):
         # read in inverse of whitening matrix
         w_inv = np.load((os.path.join(args['directories']['kilosort_output_directory'], 'whitening_mat_inv.npy')))
         
-        # the channel_pos loaded from the phy output omits any sites excluded
-        # as noise by the kilosort_helper module, or excluded fow low spike rete
-        # by kilosort itself. The waveform metrics are calculated on ALL sites
-        # based on the mean waveforms calculated for each unit; therefore
-        # we need the site locations for all sites.
-        # load the channel map associated with this kilosort run; in kilosort_helper
-        # a copy is made next to the data file
-        input_file = args['ephys_params']['ap_band_file']
-        dat_dir, dat_fname = os.path.split(input_file)
-        dat_name, dat_ext = os.path.splitext(dat_fname)
-        chanMapMat = os.path.join(dat_dir, (dat_name +'_chanMap.mat'))
-        site_x = np.squeeze(loadmat(chanMapMat)['xcoords'])
-        site_y = np.squeeze(loadmat(chanMapMat)['ycoords'])
         
                 
 
@@ -157,7 +183,7 @@ def calculate_mean_waveforms(args):
            # save new metrics as _version number
            wm_fullpath = os.path.join(pathlib.Path(wm_fullpath).parent, pathlib.Path(wm_fullpath).stem + '_' + repr(clu_version) + '.csv')
     
-        metrics.to_csv(wm_fullpath, index=False)
+        write_metrics(metrics, wm_fullpath, args['waveform_metrics']['write_feather'])
         
     else:
         
@@ -176,8 +202,7 @@ def calculate_mean_waveforms(args):
         site_x = np.squeeze(loadmat(chanMapMat)['xcoords'])
         site_y = np.squeeze(loadmat(chanMapMat)['ycoords'])
     
-        rawData = np.memmap(args['ephys_params']['ap_band_file'], dtype='int16', mode='r')
-        data = np.reshape(rawData, (int(rawData.size/args['ephys_params']['num_channels']), args['ephys_params']['num_channels']))
+        data = open_binary(args['ephys_params']['ap_band_file'], args['ephys_params']['num_channels'])
     
         spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
         channel_pos, clusterIDs, cluster_quality, cluster_amplitude = \
@@ -199,7 +224,7 @@ def calculate_mean_waveforms(args):
                     args['mean_waveform_params'])
     
         writeDataAsNpy(waveforms, args['mean_waveform_params']['mean_waveforms_file'])
-        metrics.to_csv(args['waveform_metrics']['waveform_metrics_file'], index=False)
+        write_metrics(metrics, args['waveform_metrics']['waveform_metrics_file'], args['waveform_metrics']['write_feather'])
 
 
     # if the cluster metrics have already been run, merge the waveform metrics into that file
@@ -208,13 +233,13 @@ def calculate_mean_waveforms(args):
     metrics_curr = os.path.join(pathlib.Path(metrics_args).parent, pathlib.Path(metrics_args).stem + '_' + repr(clu_version) + '.csv')
 
     if os.path.exists(metrics_curr):
-        qmetrics = pd.read_csv(metrics_curr)
+        qmetrics = read_metrics(metrics_curr)
         qmetrics = qmetrics.drop(qmetrics.columns[0], axis='columns')
-        qmetrics = qmetrics.merge(pd.read_csv(wm_fullpath, index_col=0),
+        qmetrics = qmetrics.merge(read_metrics(wm_fullpath),
                      on='cluster_id',
                      suffixes=('_quality_metrics','_waveform_metrics'))  
         print("Saving merged quality metrics ...")
-        qmetrics.to_csv(metrics_curr, index=False)
+        write_metrics(qmetrics, metrics_curr, args['cluster_metrics']['write_feather'])
         
     execution_time = time.time() - start
 
@@ -224,6 +249,29 @@ def calculate_mean_waveforms(args):
     return {"execution_time" : execution_time} # output manifest
 
 
+def cache_files(args):
+
+    """ Files read and written by this module, for the result cache """
+
+    output_dir = args['directories']['kilosort_output_directory']
+    ap_band_file = args['ephys_params']['ap_band_file']
+    mean_waveforms_file = args['mean_waveform_params']['mean_waveforms_file']
+    waveform_metrics_file = args['waveform_metrics']['waveform_metrics_file']
+
+    # the cluster metrics it merges into are written by quality_metrics, which
+    # runs later and merges in the waveform metrics itself, so they are neither
+    input_files = kilosort_files(output_dir) + [ap_band_file, os.path.splitext(ap_band_file)[0] + '_chanMap.mat']
+    output_files = [versioned_files(mean_waveforms_file),
+                    versioned_files(waveform_metrics_file),
+                    versioned_files(metrics_feather_file(waveform_metrics_file))]
+
+    if args['mean_waveform_params']['use_C_Waves']:
+        output_files += [versioned_files(os.path.join(os.path.dirname(mean_waveforms_file), 'cluster_snr.npy')),
+                         versioned_files(os.path.join(output_dir, 'clus_Table.npy'))]
+
+    return input_files, output_files
+
+
 def main():
 
     from ._schemas import InputParameters, OutputParameters
@@ -231,7 +279,7 @@ def main():
     mod = ArgSchemaParser(schema_type=InputParameters,
                           output_schema_type=OutputParameters)
 
-    output = calculate_mean_waveforms(mod.args)
+    output = run_cached('mean_waveforms', mod.args, calculate_mean_waveforms, *cache_files(mod.args))
 
     output.update({"input_parameters": mod.args})
     if "output_json" in mod.args:
@@ -1,7 +1,8 @@
 from argschema import ArgSchema, ArgSchemaParser 
 from argschema.schemas import DefaultSchema
+from marshmallow.validate import OneOf
 from argschema.fields import Nested, InputDir, String, Float, Dict, Int, Bool
-from ...common.schemas import EphysParams, Directories, WaveformMetricsFile, ClusterMetricsFile
+from ...common.schemas import EphysParams, Directories, WaveformMetricsFile, ClusterMetricsFile, CacheParams
 
 class MeanWaveformParams(DefaultSchema):
     samples_per_spike = Int(required=True, default=82, help='Number of samples to extract for each spike')
@@ -11,8 +12,12 @@ class MeanWaveformParams(DefaultSchema):
     upsampling_factor = Float(require=False, default=200/82, help='Upsampling factor for calculating waveform metrics')
     spread_threshold = Float(require=False, default=0.12, help='Threshold for computing channel spread of 2D waveform')
     site_range = Int(require=False, default=16, help='Number of sites to use for 2D waveform metrics')
+    chunk_size_mb = Int(require=False, default=64, help='Size (MB) of the blocks of the AP band file read at once when extracting waveforms')
+    multiprocessing_worker_count = Int(require=False, default=1, help='Number of worker processes for extracting waveforms and computing their metrics (1 = no multiprocessing)')
+    accumulator_dtype = String(require=False, default='float64', validate=OneOf(['float32', 'float64']), help="Precision of the running mean and std of each unit's waveforms ('float32' or 'float64')")
     cWaves_path = InputDir(require=False, help='directory containing the TPrime executable.')
     use_C_Waves = Bool(require=False, default=False, help='Use faster C routine to calculate mean waveforms')
+    cWaves_engine = String(require=False, default='external', validate=OneOf(['external', 'python']), help="With use_C_Waves, 'external' runs the C_Waves executable in cWaves_path; 'python' computes the same output files in-process")
     snr_radius = Int(require=False, default=8, help='disk radius (chans) about pk-chan for snr calculation in C_waves')
     snr_radius_um = Int(require=False, default=8, help='disk radius (um) about pk-chan for snr calculation in C_waves')
     mean_waveforms_file = String(required=True, help='Path to mean waveforms file (.npy)')
@@ -25,6 +30,7 @@ class InputParameters(ArgSchema):
     cluster_metrics = Nested(ClusterMetricsFile)
     ephys_params = Nested(EphysParams)
     directories = Nested(Directories)
+    cache_params = Nested(CacheParams, required=False, default={})
 
 class OutputSchema(DefaultSchema): 
     input_parameters = Nested(InputParameters, 
@@ -1,15 +1,16 @@
 import numpy as np
 import os
 import glob
+import multiprocessing
 
 import xarray as xr
 import pandas as pd
 
-import warnings
-
-from .waveform_metrics import calculate_waveform_metrics
+from .waveform_metrics import snr_from_moments, calculate_waveform_metrics_batch
 from ...common.epoch import Epoch
-from ...common.utils import printProgressBar
+from ...common.utils import printProgressBar, SpikeIndex, channel_distances, CHUNK_BYTES
+from ...common.utils import snippet_batches, WaveformAccumulator
+from ...common.utils import share_array, shared_zeros, attach_shared_array
 
 def extract_waveforms(raw_data, 
                       spike_times, 
@@ -27,6 +28,10 @@ def extract_waveforms(raw_data,
     """
     Calculate mean waveforms for sorted units.
 
+    The spikes to average are chosen for every unit first, then read in time
+    order in a single pass through raw_data, so the file is streamed in large
+    sequential blocks instead of being read one spike at a time.
+
     Inputs:
     -------
     raw_data : continuous data as numpy array (samples x channels)
@@ -58,6 +63,9 @@ def extract_waveforms(raw_data,
     pre_samples : number of samples prior to peak
     num_epochs : number of epochs to calculate mean waveforms
     spikes_per_epoch : max number of spikes to generate average for epoch
+    chunk_size_mb : size of the blocks of raw_data read at once (optional)
+    accumulator_dtype : 'float32' or 'float64', precision of the running mean and std (optional)
+    multiprocessing_worker_count : number of worker processes (optional, 1 = no multiprocessing)
 
     """
 
@@ -70,96 +78,349 @@ def extract_waveforms(raw_data,
     upsampling_factor = params['upsampling_factor']
     spread_threshold = params['spread_threshold']
     site_range = params['site_range']
+    chunk_bytes = int(params.get('chunk_size_mb', CHUNK_BYTES / 2**20) * 2**20)
+    accumulator_dtype = params.get('accumulator_dtype', 'float64')
 
     # #############################################
 
-    metrics = pd.DataFrame()
-
     if epochs is None:
         epochs = [Epoch('complete_session', 0, np.inf)]
 
     cluster_ids = np.arange(np.max(spike_clusters) + 1)
     total_units = len(cluster_ids)
     total_epochs = len(epochs)
+    num_channels = raw_data.shape[1]
 
     # allocate array for waveforms, datatype = default, double
     mean_waveforms = np.zeros(
-        (total_units, total_epochs, 2, raw_data.shape[1], samples_per_spike))
-    spike_count = np.zeros((total_units, total_epochs + 1), dtype = 'int')
+        (total_units, total_epochs, 2, num_channels, samples_per_spike))
 
     peak_channels = np.squeeze(channel_map[np.argmax(np.max(templates,1) - np.min(templates,1),1)])
 
+    distances = channel_distances(np.column_stack((site_x, site_y)))
+
+    times, groups, spike_count = select_spikes(spike_times, spike_clusters, epochs, total_units,
+                                               sample_rate, spikes_per_epoch)
+
+    # spikes at the start or end of the dataset are left out of the average
+    starts = times - pre_samples
+    complete = (starts >= 0) * (starts + samples_per_spike <= raw_data.shape[0])
+
+    starts = starts[complete]
+    groups = groups[complete]
+
+    # one row of metrics per unit and epoch with spikes, in epoch order
+    units = [(cluster_idx * total_epochs + epoch_idx, cluster_id, peak_channels[cluster_idx], epoch.name)
+             for epoch_idx, epoch in enumerate(epochs)
+             for cluster_idx, cluster_id in enumerate(cluster_ids)
+             if spike_count[cluster_idx, epoch_idx] > 0]
+
+    metric_args = (sample_rate, upsampling_factor, spread_threshold, site_range, site_x, site_y, distances)
+
+    num_workers = int(np.min([params.get('multiprocessing_worker_count', 1), multiprocessing.cpu_count()]))
+
+    print("Reading " + str(starts.size) + " spikes")
+
+    if num_workers > 1:
+
+        mean, std, metrics = extract_waveforms_parallel(raw_data, starts, groups, total_units * total_epochs,
+                                                     samples_per_spike, chunk_bytes, accumulator_dtype,
+                                                     bit_volts, units, metric_args, num_workers)
+
+    else:
+
+        accumulator = accumulate_waveforms(raw_data, starts, groups, total_units * total_epochs,
+                                           samples_per_spike, chunk_bytes, accumulator_dtype, progress = True)
+
+        mean, std = accumulator.mean_std(bit_volts)
+
+        metrics = unit_metrics(unit_metrics_task(mean, std, units), metric_args)
+
+    # remove offset
+    has_spikes = spike_count[:, :total_epochs].flatten() > 0
+    waveforms = mean_waveforms.reshape((total_units * total_epochs, 2, num_channels, samples_per_spike))
+
+    waveforms[has_spikes, 0] = mean[has_spikes] - mean[has_spikes, :, :1]
+    waveforms[has_spikes, 1] = std[has_spikes]
+
+    dimCoords, dimLabels = generateDimLabels(
+        cluster_ids, total_epochs, pre_samples, samples_per_spike, num_channels, sample_rate)
+
+    return mean_waveforms, spike_count, dimCoords, dimLabels, metrics
+
+
+def accumulate_waveforms(raw_data, starts, groups, num_groups, samples_per_spike,
+                         chunk_bytes = CHUNK_BYTES, dtype = 'float64', out = None, progress = False):
+
+    """
+    Reads the snippets at starts and accumulates them by group
+
+    Inputs:
+    -------
+    raw_data : numpy.ndarray or numpy.memmap (samples x channels)
+    starts : numpy.ndarray
+        First sample of each snippet, sorted
+    groups : numpy.ndarray
+        Group of each snippet
+    num_groups : int
+    samples_per_spike : int
+    chunk_bytes : int (optional)
+    dtype : str (optional)
+        Precision of the accumulator
+    out : tuple of numpy.ndarray (optional)
+        Arrays to accumulate into (see WaveformAccumulator)
+    progress : bool (optional)
+        Print a progress bar
+
+    Outputs:
+    --------
+    accumulator : WaveformAccumulator
+
+    """
+
+    accumulator = WaveformAccumulator(num_groups, samples_per_spike, raw_data.shape[1], dtype, out)
+
+    for index, snippets in snippet_batches(raw_data, starts, samples_per_spike, chunk_bytes):
+
+        accumulator.add(groups[index], snippets)
+
+        if progress:
+            printProgressBar(index[-1] + 1, starts.size)
+
+    return accumulator
+
+
+def extract_waveforms_parallel(raw_data, starts, groups, num_groups, samples_per_spike, chunk_bytes, dtype,
+                               scale, units, metric_args, num_workers):
+
+    """
+    Accumulates waveforms and computes their metrics in a pool of worker processes
+
+    The groups are split into ranges of consecutive groups with about the
+    same number of spikes (a few per worker, to balance the load). Each 
+    task reads the spikes of one range in time order, accumulates them 
+    into its slice of a single accumulator in shared memory, and computes
+    the metrics of the units in the range. As each group is accumulated by
+    one task, in time order, the result doesn't depend on which worker 
+    finishes first.
+
+    A memory-mapped raw_data is re-opened by each worker, which only reads
+    the pages around its own spikes; in-memory data are copied once into 
+    shared memory. Memory is bounded independently of the number of units
+    per worker: besides the shared accumulator (count, mean and M2 of every
+    group), each running task holds the float64 mean and std of its own 
+    range and a few batches of up to chunk_bytes, and only the metrics 
+    tables are sent back.
+
+    Inputs:
+    -------
+    raw_data, starts, groups, num_groups, samples_per_spike, chunk_bytes, dtype :
+        as for accumulate_waveforms
+    scale : float
+        Scale factor of the mean and std (e.g. bit_volts)
+    units : list of (group, cluster_id, peak_channel, epoch_name)
+        Units to compute metrics for
+    metric_args : tuple
+        (sample_rate, upsampling_factor, spread_threshold, site_range, site_x, site_y, distances)
+    num_workers : int
+
+    Outputs:
+    --------
+    mean, std : numpy.ndarray (groups x channels x samples)
+    metrics : pandas.DataFrame
+        One row of metrics for each entry in units
+
+    """
+
+    num_channels = raw_data.shape[1]
+
+    ranges = group_ranges(groups, num_groups, 4 * num_workers)
+
+    unit_groups = np.array([unit[0] for unit in units], dtype = 'int')
+    positions = [np.flatnonzero((unit_groups >= first) & (unit_groups < last)) for first, last in ranges]
+
+    tasks = [(first, last, [units[idx] for idx in in_range]) for (first, last), in_range in zip(ranges, positions)]
+
+    shared = [shared_zeros((num_groups,), 'int64'),
+              shared_zeros((num_groups, samples_per_spike, num_channels), dtype),
+              shared_zeros((num_groups, samples_per_spike, num_channels), dtype)]
+
+    shm, spec = share_array(raw_data)
+
+    try:
+        with multiprocessing.Pool(num_workers,
+                                  initializer = _init_waveform_worker,
+                                  initargs = (spec, [block_spec for block, block_spec, array in shared], 
+                                              starts, groups, samples_per_spike, chunk_bytes, dtype, scale,
+                                              metric_args)) as pool:
+
+            results = []
+
+            for idx, result in enumerate(pool.imap(_waveform_worker_task, tasks)):
+                results.append(result)
+                printProgressBar(idx + 1, len(tasks))
+
+        accumulator = WaveformAccumulator(num_groups, samples_per_spike, num_channels, dtype,
+                                          out = [array for block, block_spec, array in shared])
+
+        mean, std = accumulator.mean_std(scale)
+
+    finally:
+        for block in [shm] + [block for block, block_spec, array in shared]:
+            if block is not None:
+                block.close()
+                block.unlink()
+
+    # back in the order of units
+    order = np.argsort(np.concatenate(positions + [np.zeros(0, dtype = 'int')]), kind = 'stable')
+    metrics = pd.concat(results, ignore_index = True).iloc[order].reset_index(drop = True)
+
+    return mean, std, metrics
+
+
+def group_ranges(groups, num_groups, num_ranges):
+
+    """ Ranges [first, last) of consecutive groups with about the same number of snippets each """
+
+    cumulative = np.cumsum(np.bincount(groups, minlength = num_groups))
+
+    if cumulative.size == 0:
+        return []
+
+    bounds = np.searchsorted(cumulative, np.arange(1, num_ranges) * cumulative[-1] / num_ranges) + 1
+    bounds = np.unique(np.concatenate(([0], np.minimum(bounds, num_groups), [num_groups])))
+
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def unit_metrics_task(mean, std, units):
+
+    """ Arguments of unit_metrics for a list of units, from the accumulated mean and std """
+
+    groups = np.array([unit[0] for unit in units], dtype = 'int')
+    peak_channels = np.array([unit[2] for unit in units], dtype = 'int')
+
+    snr = np.array([snr_from_moments(mean[group, peak_channel], std[group, peak_channel])
+                    for group, peak_channel in zip(groups, peak_channels)], dtype = 'float64')
+
+    return (mean[groups], snr, np.array([unit[1] for unit in units], dtype = 'int'),
+            peak_channels, [unit[3] for unit in units])
+
+
+def unit_metrics(task, metric_args):
+
+    """ Waveform metrics table for a list of units and epochs (see unit_metrics_task) """
+
+    mean_waveforms, snr, cluster_ids, peak_channels, epoch_names = task
+
+    return calculate_waveform_metrics_batch(mean_waveforms, peak_channels, snr, cluster_ids, epoch_names, *metric_args)
+
+
+# state attached once per worker process by _init_waveform_worker
+_waveform_worker = {}
+
+def _init_waveform_worker(spec, accumulator_specs, starts, groups, samples_per_spike, chunk_bytes, dtype, scale, metric_args):
+
+    shm, raw_data = attach_shared_array(spec)
+    accumulator = [attach_shared_array(block_spec, writeable = True) for block_spec in accumulator_specs]
+
+    _waveform_worker['handles'] = [shm] + [block for block, array in accumulator]
+    _waveform_worker['raw_data'] = raw_data
+    _waveform_worker['accumulator'] = [array for block, array in accumulator]
+    _waveform_worker['args'] = (starts, groups, samples_per_spike, chunk_bytes, dtype, scale)
+    _waveform_worker['metric_args'] = metric_args
+
+
+def _waveform_worker_task(task):
+
+    """ Accumulates the groups in [first, last) into the shared accumulator and returns the metrics of their units """
+
+    first, last, units = task
+    starts, groups, samples_per_spike, chunk_bytes, dtype, scale = _waveform_worker['args']
+
+    in_range = (groups >= first) & (groups < last)
+
+    accumulator = accumulate_waveforms(_waveform_worker['raw_data'], starts[in_range], groups[in_range] - first, 
+                                       last - first, samples_per_spike, chunk_bytes, dtype,
+                                       out = [array[first:last] for array in _waveform_worker['accumulator']])
+
+    mean, std = accumulator.mean_std(scale)
+
+    units = [(group - first, cluster_id, peak_channel, epoch_name) for group, cluster_id, peak_channel, epoch_name in units]
+
+    return unit_metrics(unit_metrics_task(mean, std, units), _waveform_worker['metric_args'])
+
+
+def select_spikes(spike_times, spike_clusters, epochs, total_units, sample_rate, spikes_per_epoch):
+
+    """
+    Chooses the spikes to average for each unit and epoch
+
+    Each unit's spikes in an epoch are shuffled with np.random.shuffle, one
+    unit at a time in cluster order, and the first spikes_per_epoch are kept,
+    so a seeded run selects the same spikes as reading the units one by one.
+
+    Inputs:
+    -------
+    spike_times : spike times (in samples)
+    spike_clusters : cluster IDs for each spike time
+    epochs : list of Epoch objects
+    total_units : number of cluster IDs
+    sample_rate : Hz
+    spikes_per_epoch : max number of spikes per unit and epoch
+
+    Outputs:
+    --------
+    times : numpy.ndarray
+        Selected spike times (in samples), sorted
+    groups : numpy.ndarray
+        cluster_idx * len(epochs) + epoch_idx for each selected spike
+    spike_count : numpy.ndarray (units x epochs + 1)
+        Number of spikes selected for each unit and epoch
+
+    """
+
+    total_epochs = len(epochs)
+
+    spike_count = np.zeros((total_units, total_epochs + 1), dtype = 'int')
+
+    times = []
+    groups = []
+
     for epoch_idx, epoch in enumerate(epochs):
 
         print("Epoch: " + epoch.name)
 
         in_epoch = ((spike_times / sample_rate) > epoch.start_time) * ((spike_times / sample_rate) < epoch.end_time)
 
-        spike_times_in_epoch = spike_times[in_epoch]
+        spike_times_in_epoch = spike_times[in_epoch].astype('int64')
 
-        for cluster_idx, cluster_id in enumerate(cluster_ids):
+        spike_index = SpikeIndex(spike_clusters[in_epoch], total_units)
 
-            printProgressBar(cluster_idx+1, total_units)
+        for cluster_idx in range(total_units):
 
-            in_cluster = (spike_clusters[in_epoch] == cluster_id)
+            in_cluster = spike_index.spikes_for(cluster_idx)
 
-            if np.sum(in_cluster) > 0:
+            if in_cluster.size > 0:
 
                 times_for_cluster = spike_times_in_epoch[in_cluster]
 
-                waveforms = np.empty(
-                    (spikes_per_epoch, raw_data.shape[1], samples_per_spike))
-                waveforms[:] = np.nan
-
                 np.random.shuffle(times_for_cluster)
 
                 total_waveforms = np.min(
                     [times_for_cluster.size, spikes_per_epoch])
 
-                for wv_idx, peak_time in enumerate(times_for_cluster[:total_waveforms]):
-                    start = int(peak_time-pre_samples)
-                    end = start + samples_per_spike
-                    rawWaveform = raw_data[start:end, :].T
-
-                    # in case spike was at start or end of dataset
-                    if rawWaveform.shape[1] == samples_per_spike:
-                        waveforms[wv_idx, :, :] = rawWaveform * bit_volts
-
-                # concatenate to existing dataframe
-                metrics = pd.concat([metrics, calculate_waveform_metrics(waveforms[:total_waveforms, :, :],
-                                                                         cluster_id, 
-                                                                         peak_channels[cluster_idx], 
-                                                                         channel_map,
-                                                                         sample_rate, 
-                                                                         upsampling_factor,
-                                                                         spread_threshold,
-                                                                         site_range,
-                                                                         site_spacing,
-                                                                         site_x,
-                                                                         site_y,
-                                                                         epoch.name
-                                                                         )])
-
-                with warnings.catch_warnings():
-
-                    warnings.simplefilter("ignore", category=RuntimeWarning)
-                    mean_waveforms[cluster_idx, epoch_idx,
-                                   0, :, :] = np.nanmean(waveforms, 0)
-                    mean_waveforms[cluster_idx, epoch_idx,
-                                   1, :, :] = np.nanstd(waveforms, 0)
-
-                    # remove offset
-                    for channel in range(0, mean_waveforms.shape[3]):
-                        mean_waveforms[cluster_idx, epoch_idx, 0, channel, :] = \
-                            mean_waveforms[cluster_idx, epoch_idx, 0, channel, :] - \
-                            mean_waveforms[cluster_idx, epoch_idx, 0, channel, 0]
+                times.append(times_for_cluster[:total_waveforms])
+                groups.append(np.full(total_waveforms, cluster_idx * total_epochs + epoch_idx))
 
                 spike_count[cluster_idx, epoch_idx] = total_waveforms
 
-    dimCoords, dimLabels = generateDimLabels(
-        cluster_ids, total_epochs, pre_samples, samples_per_spike, raw_data.shape[1], sample_rate)
+    times = np.concatenate(times + [np.zeros(0, dtype = 'int64')])
+    groups = np.concatenate(groups + [np.zeros(0, dtype = 'int')])
 
-    return mean_waveforms, spike_count, dimCoords, dimLabels, metrics
+    order = np.argsort(times, kind = 'stable')
+
+    return times[order], groups[order], spike_count
 
 
 def generateDimLabels(good_clusters, num_epochs, pre_samples, total_samples, num_channels, sample_rate):
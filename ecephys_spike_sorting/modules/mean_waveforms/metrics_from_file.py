@@ -3,13 +3,12 @@ import os
 import glob
 
 import xarray as xr
-import pandas as pd
 
 import warnings
 
-from .waveform_metrics import calculate_waveform_metrics_from_avg
+from .waveform_metrics import calculate_waveform_metrics_batch
 from ...common.epoch import Epoch
-from ...common.utils import printProgressBar
+from ...common.utils import channel_distances
 
 def metrics_from_file(mean_waveform_fullpath,
                       snr_fullpath,
@@ -80,16 +79,16 @@ def metrics_from_file(mean_waveform_fullpath,
 
     # #############################################
 
-    metrics = pd.DataFrame()
-
     cluster_ids = np.arange(np.max(spike_clusters) + 1)
     total_units = len(cluster_ids)
-    
+
     mean_waveforms = np.load(mean_waveform_fullpath)
     snr_array = np.load(snr_fullpath)
     clus_table = np.load(clus_fullpath)
     peak_channels = clus_table[:,1]
 
+    distances = channel_distances(np.column_stack((site_x, site_y)))
+
 #    channel_map = np.squeeze(channel_map)
 #    
 #    nTemplate = templates.shape[0]
@@ -105,27 +104,20 @@ def metrics_from_file(mean_waveform_fullpath,
 #        currdiff = np.max(curr_unwh,1) - np.min(curr_unwh,1)
 #        peak_channels[i] = channel_map[np.argmax(currdiff)]
     
-    for cluster_idx, cluster_id in enumerate(cluster_ids):
-
-        printProgressBar(cluster_idx+1, total_units)
-
-        snr = snr_array[cluster_idx,0]
-        nSpike = snr_array[cluster_idx,1]
-        # if at least one spike, calculate metrics and concatenate to existing dataframe
-        if nSpike > 0:
-            metrics = pd.concat([metrics, calculate_waveform_metrics_from_avg(mean_waveforms[cluster_idx,:],
-                                                                     snr,
-                                                                     cluster_id, 
-                                                                     peak_channels[cluster_idx], 
-                                                                     channel_map,
-                                                                     sample_rate, 
-                                                                     upsampling_factor,
-                                                                     spread_threshold,
-                                                                     site_range,
-                                                                     site_x, site_y                                                                    
-                                                                     )])
-
-
+    # metrics for every cluster with at least one spike
+    has_spikes = np.flatnonzero(snr_array[:total_units,1] > 0)
+
+    metrics = calculate_waveform_metrics_batch(mean_waveforms[has_spikes],
+                                               peak_channels[has_spikes],
+                                               snr_array[has_spikes,0],
+                                               cluster_ids[has_spikes],
+                                               'complete_session',
+                                               sample_rate,
+                                               upsampling_factor,
+                                               spread_threshold,
+                                               site_range,
+                                               site_x, site_y,
+                                               distances)
 
     return metrics
 
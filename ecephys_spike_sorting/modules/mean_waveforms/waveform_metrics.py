@@ -1,10 +1,15 @@
 import numpy as np
 import random
+import warnings
 import pandas as pd
 
 from scipy.stats import linregress
 from scipy.signal import resample
 
+METRIC_COLUMNS = ['cluster_id', 'epoch_name', 'peak_channel', 'snr', 'duration', 'halfwidth',
+                  'PT_ratio', 'repolarization_slope', 'recovery_slope', 'amplitude',
+                  'spread', 'velocity_above', 'velocity_below']
+
 def calculate_waveform_metrics(waveforms, 
                                cluster_id, 
                                peak_channel, 
@@ -16,7 +21,8 @@ def calculate_waveform_metrics(waveforms,
                                site_spacing,
                                site_x,
                                site_y,
-                               epoch_name):
+                               epoch_name,
+                               distances = None):
     
     """
     Calculate metrics for an array of waveforms.
@@ -49,6 +55,9 @@ def calculate_waveform_metrics(waveforms,
         Average vertical distance between sites (m)
     site_x, site_y : float
         Channel positions (um)
+    epoch_name : str
+    distances : numpy.ndarray (num_channels x num_channels) (optional)
+        Distances between channels (see channel_distances)
 
     Outputs:
     -------
@@ -68,36 +77,11 @@ def calculate_waveform_metrics(waveforms,
     # mean_2D_waveform = np.squeeze(avg_waveform[channel_map, :])
     # local_peak = np.argmin(np.abs(channel_map - peak_channel))
     mean_2D_waveform = np.squeeze(np.nanmean(waveforms, 0))
-    local_peak = peak_channel
-
-    num_samples = waveforms.shape[2]
-    new_sample_count = int(num_samples * upsampling_factor)
 
-    mean_1D_waveform = resample(
-        mean_2D_waveform[local_peak, :], new_sample_count)
+    row = waveform_metric_row(mean_2D_waveform, snr, cluster_id, peak_channel, epoch_name, sample_rate, 
+                              upsampling_factor, spread_threshold, site_range, site_x, site_y, distances)
 
-    timestamps = np.linspace(0, num_samples / sample_rate, new_sample_count)
-
-    duration = calculate_waveform_duration(mean_1D_waveform, timestamps)
-    halfwidth = calculate_waveform_halfwidth(mean_1D_waveform, timestamps)
-    PT_ratio = calculate_waveform_PT_ratio(mean_1D_waveform)
-    repolarization_slope = calculate_waveform_repolarization_slope(
-        mean_1D_waveform, timestamps)
-    recovery_slope = calculate_waveform_recovery_slope(
-        mean_1D_waveform, timestamps)
-
-    amplitude, spread, velocity_above, velocity_below = calculate_2D_features(
-        mean_2D_waveform, timestamps, local_peak, site_x, site_y, spread_threshold, site_range, site_spacing)
-
-    data = [[cluster_id, epoch_name, peak_channel, snr, duration, halfwidth, PT_ratio, repolarization_slope,
-              recovery_slope, amplitude, spread, velocity_above, velocity_below]]
-
-    metrics = pd.DataFrame(data,
-                           columns=['cluster_id', 'epoch_name', 'peak_channel', 'snr', 'duration', 'halfwidth',
-                                     'PT_ratio', 'repolarization_slope', 'recovery_slope', 'amplitude',
-                                     'spread', 'velocity_above', 'velocity_below'])
-
-    return metrics
+    return pd.DataFrame([row], columns=METRIC_COLUMNS)
 
 def calculate_waveform_metrics_from_avg(avg_waveform,
                                         snr,
@@ -108,7 +92,8 @@ def calculate_waveform_metrics_from_avg(avg_waveform,
                                         upsampling_factor, 
                                         spread_threshold,
                                         site_range,
-                                        site_x, site_y):
+                                        site_x, site_y,
+                                        distances = None):
 
     """
     Calculate metrics for an array of waveforms for a single cluster.
@@ -139,6 +124,8 @@ def calculate_waveform_metrics_from_avg(avg_waveform,
     site_range : float
         Number of sites to use for 2D waveform metrics
     site_x, site_y : channel positions in um
+    distances : numpy.ndarray (num_channels x num_channels) (optional)
+        Distances between channels (see channel_distances)
 
     Outputs:
     -------
@@ -158,6 +145,45 @@ def calculate_waveform_metrics_from_avg(avg_waveform,
     # mean_2D_waveform = np.squeeze(avg_waveform[channel_map, :])
     # local_peak = np.argmin(np.abs(channel_map - peak_channel))
     mean_2D_waveform = avg_waveform
+
+    row = waveform_metric_row(mean_2D_waveform, snr, cluster_id, peak_channel, epoch_name, sample_rate, 
+                              upsampling_factor, spread_threshold, site_range, site_x, site_y, distances)
+
+    return pd.DataFrame([row], columns=METRIC_COLUMNS)
+
+
+def waveform_metric_row(mean_2D_waveform,
+                        snr,
+                        cluster_id,
+                        peak_channel,
+                        epoch_name,
+                        sample_rate,
+                        upsampling_factor,
+                        spread_threshold,
+                        site_range,
+                        site_x, site_y,
+                        distances = None):
+
+    """
+    Metrics of one mean waveform, as a row of METRIC_COLUMNS
+
+    Inputs:
+    -------
+    mean_2D_waveform : numpy.ndarray (num_channels x num_samples)
+    snr : float
+    cluster_id : int
+    peak_channel : int
+        Location of waveform peak
+    epoch_name : str
+    sample_rate, upsampling_factor, spread_threshold, site_range, site_x, site_y, distances :
+        As for calculate_waveform_metrics
+
+    Outputs:
+    -------
+    row : list
+
+    """
+
     local_peak = peak_channel
 
     num_samples = mean_2D_waveform.shape[1]
@@ -177,17 +203,295 @@ def calculate_waveform_metrics_from_avg(avg_waveform,
         mean_1D_waveform, timestamps)
 
     amplitude, spread, velocity_above, velocity_below = calculate_2D_features(
-        mean_2D_waveform, timestamps, local_peak, site_x, site_y, spread_threshold, site_range)
+        mean_2D_waveform, timestamps, local_peak, site_x, site_y, spread_threshold, site_range, distances)
+
+    return [cluster_id, epoch_name, peak_channel, snr, duration, halfwidth, PT_ratio, repolarization_slope,
+            recovery_slope, amplitude, spread, velocity_above, velocity_below]
+
+
+def calculate_waveform_metrics_batch(mean_waveforms,
+                                     peak_channels,
+                                     snr,
+                                     cluster_ids,
+                                     epoch_names,
+                                     sample_rate,
+                                     upsampling_factor,
+                                     spread_threshold,
+                                     site_range,
+                                     site_x,
+                                     site_y,
+                                     distances = None):
+
+    """
+    Metrics of many mean waveforms at once, as one table
+
+    Computes the same features as waveform_metric_row, for all units
+    together: the peak-channel waveforms are upsampled with a single FFT
+    resample, slopes are closed-form least-squares fits over masked
+    windows, and the 2D features are computed on a (units x sites x
+    samples) array of the sites sampled for each unit.
+
+    Inputs:
+    -------
+    mean_waveforms : numpy.ndarray (num_units x num_channels x num_samples)
+    peak_channels : numpy.ndarray (num_units)
+    snr : numpy.ndarray (num_units)
+    cluster_ids : numpy.ndarray (num_units)
+    epoch_names : str or list of str (num_units)
+    sample_rate, upsampling_factor, spread_threshold, site_range, site_x, site_y, distances :
+        As for calculate_waveform_metrics
+
+    Outputs:
+    -------
+    metrics : pandas.DataFrame
+        One row per unit, with columns METRIC_COLUMNS
+
+    """
+
+    num_units, num_channels, num_samples = mean_waveforms.shape
+    new_sample_count = int(num_samples * upsampling_factor)
+
+    if isinstance(epoch_names, str):
+        epoch_names = [epoch_names] * num_units
+
+    columns = {'cluster_id' : np.asarray(cluster_ids),
+               'epoch_name' : list(epoch_names),
+               'peak_channel' : np.asarray(peak_channels),
+               'snr' : np.asarray(snr)}
+
+    peak_channels = np.asarray(peak_channels, dtype='int')
+
+    if num_units > 0:
+
+        timestamps = np.linspace(0, num_samples / sample_rate, new_sample_count)
+
+        mean_1D_waveforms = resample(mean_waveforms[np.arange(num_units), peak_channels, :], new_sample_count, axis=1)
+
+        columns['duration'], columns['halfwidth'], columns['PT_ratio'], \
+        columns['repolarization_slope'], columns['recovery_slope'] = \
+            calculate_1D_features_batch(mean_1D_waveforms, timestamps)
+
+        columns['amplitude'], columns['spread'], columns['velocity_above'], columns['velocity_below'] = \
+            calculate_2D_features_batch(mean_waveforms, timestamps, peak_channels, site_x, site_y,
+                                        spread_threshold, site_range, distances)
+
+    else:
+
+        for column in METRIC_COLUMNS[4:]:
+            columns[column] = np.zeros(0)
+
+    return pd.DataFrame(columns, columns=METRIC_COLUMNS)
+
+
+def calculate_1D_features_batch(waveforms, timestamps, window=20):
+
+    """
+    Duration, halfwidth, PT ratio, repolarization slope and recovery slope
+    of many 1D waveforms (see the functions for each feature)
+
+    Inputs:
+    ------
+    waveforms : numpy.ndarray (num_units x N samples)
+    timestamps : numpy.ndarray (N samples)
+    window : int
+        Window (in samples) for the slopes
+
+    Outputs:
+    --------
+    duration, halfwidth, PT_ratio, repolarization_slope, recovery_slope : numpy.ndarray (num_units)
+
+    """
+
+    units = np.arange(waveforms.shape[0])
+    samples = np.arange(waveforms.shape[1])
+
+    trough_idx = np.argmin(waveforms, 1)
+    peak_idx = np.argmax(waveforms, 1)
+
+    # measure from the peak if it is larger than the trough, else from the trough
+    from_peak = waveforms[units, peak_idx] > np.abs(waveforms[units, trough_idx])
+    start = np.where(from_peak, peak_idx, trough_idx)
+    after_start = samples >= start[:, np.newaxis]
+
+    end = np.where(from_peak,
+                   np.argmin(np.where(after_start, waveforms, np.inf), 1),
+                   np.argmax(np.where(after_start, waveforms, -np.inf), 1))
+
+    duration = (timestamps[end] - timestamps[start]) * 1e3
+
+    sign = np.where(from_peak, 1, -1)[:, np.newaxis]
+    threshold = sign * waveforms[units, start][:, np.newaxis] * 0.5
+
+    crossing_1 = (sign * waveforms > threshold) & ~after_start
+    crossing_2 = (sign * waveforms < threshold) & after_start
+
+    halfwidth = np.where(np.any(crossing_1, 1) & np.any(crossing_2, 1),
+                         timestamps[np.argmax(crossing_2, 1)] - timestamps[np.argmax(crossing_1, 1)], np.nan) * 1e3
 
-    data = [[cluster_id, epoch_name, peak_channel, snr, duration, halfwidth, PT_ratio, repolarization_slope,
-              recovery_slope, amplitude, spread, velocity_above, velocity_below]]
+    PT_ratio = np.abs(waveforms[units, peak_idx] / waveforms[units, trough_idx])
 
-    metrics = pd.DataFrame(data,
-                           columns=['cluster_id', 'epoch_name', 'peak_channel', 'snr', 'duration', 'halfwidth',
-                                     'PT_ratio', 'repolarization_slope', 'recovery_slope', 'amplitude',
-                                     'spread', 'velocity_above', 'velocity_below'])
+    # invert if we're using the peak
+    max_point = np.argmax(np.abs(waveforms), 1)
+    waveforms = - waveforms * np.sign(waveforms[units, max_point])[:, np.newaxis]
 
-    return metrics
+    repolarization = (samples >= max_point[:, np.newaxis]) & (samples < max_point[:, np.newaxis] + window)
+    repolarization_slope = masked_slopes(timestamps, waveforms, repolarization) * 1e-6
+
+    recovery_idx = np.argmax(np.where(samples >= max_point[:, np.newaxis], waveforms, -np.inf), 1)
+    recovery = (samples >= recovery_idx[:, np.newaxis]) & (samples < recovery_idx[:, np.newaxis] + window)
+    recovery_slope = masked_slopes(timestamps, waveforms, recovery) * 1e-6
+
+    return duration, halfwidth, PT_ratio, repolarization_slope, recovery_slope
+
+
+def calculate_2D_features_batch(waveforms, timestamps, peak_channels, site_x, site_y, spread_threshold = 0.12, site_range=16, distances = None):
+
+    """
+    Amplitude, spread and velocities of many 2D waveforms (see calculate_2D_features)
+
+    Inputs:
+    ------
+    waveforms : numpy.ndarray (num_units x N channels x M samples)
+    timestamps : numpy.ndarray (M samples)
+    peak_channels : numpy.ndarray (num_units)
+    site_x, site_y, spread_threshold, site_range, distances :
+        As for calculate_2D_features
+
+    Outputs:
+    --------
+    amplitude, spread, velocity_above, velocity_below : numpy.ndarray (num_units)
+
+    """
+
+    assert site_range % 2 == 0 # must be even
+
+    num_units, n_channel = waveforms.shape[:2]
+    units = np.arange(num_units)[:, np.newaxis]
+
+    if distances is None:
+        dist = np.sqrt(( pow((site_x - site_x[peak_channels][:, np.newaxis]),2) + pow((site_y - site_y[peak_channels][:, np.newaxis]),2)))
+    else:
+        dist = distances[peak_channels]
+
+    # nearest site at a different y; as in calculate_2D_features, the last
+    # site (in channel order) that is at least as close as every site
+    # before it is taken, among those with nonzero amplitude
+    ydiff = site_y != site_y[peak_channels][:, np.newaxis]
+    dist_nn = np.where(ydiff, dist, np.inf)
+    is_nn = ydiff & (dist_nn == np.minimum.accumulate(dist_nn, 1)) & (dist_nn <= 1e6) & \
+        (np.max(waveforms, 2) - np.min(waveforms, 2) > 0)
+
+    x_nn = np.where(np.any(is_nn, 1), site_x[n_channel - 1 - np.argmax(is_nn[:, ::-1], 1)], -1)
+
+    # the site_range sites nearest the peak channel with x = x_peak or x_nn
+    inCol = (site_x == site_x[peak_channels][:, np.newaxis]) | (site_x == x_nn[:, np.newaxis])
+    sort_dist_ind = np.argsort(dist, 1)
+    inCol = np.take_along_axis(inCol, sort_dist_ind, 1)
+    to_sample = inCol & (np.cumsum(inCol, 1) <= site_range)
+
+    nfound = np.sum(to_sample, 1)
+    found = np.arange(site_range) < nfound[:, np.newaxis]
+
+    sites_to_sample = np.zeros((num_units, site_range), dtype='int')
+    sites_to_sample[found] = sort_dist_ind[to_sample]
+
+    wv = waveforms[units, sites_to_sample, :]
+
+    trough_idx = np.argmin(wv, 2)
+    overall_amplitude = np.where(found, np.max(wv, 2) - np.min(wv, 2), -np.inf)
+
+    amplitude = np.max(overall_amplitude, 1)
+    max_chan = np.argmax(overall_amplitude, 1)
+
+    above_thresh = found & (overall_amplitude > (amplitude * spread_threshold)[:, np.newaxis])
+
+    # outliers among the positions (in sites_to_sample) above threshold, as in isnot_outlier
+    with warnings.catch_warnings(), np.errstate(invalid='ignore', divide='ignore'):
+
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+
+        points = np.where(above_thresh, np.arange(site_range, dtype='float64'), np.nan)
+        diff = np.abs(points - np.nanmedian(points, 1)[:, np.newaxis])
+        modified_z_score = 0.6745 * diff / np.nanmedian(diff, 1)[:, np.newaxis]
+
+    above_thresh &= (np.sum(above_thresh, 1) <= 1)[:, np.newaxis] | (modified_z_score <= 1.5)
+
+    yDist = site_y[sites_to_sample] - site_y[peak_channels][:, np.newaxis]
+
+    spread = np.where(np.any(above_thresh, 1),
+                      np.max(np.where(above_thresh, yDist, -np.inf), 1) - np.min(np.where(above_thresh, yDist, np.inf), 1), 0)
+
+    if np.issubdtype(np.asarray(site_y).dtype, np.integer):
+        spread = spread.astype(np.asarray(site_y).dtype)
+
+    trough_times = timestamps[trough_idx] - timestamps[trough_idx[units[:, 0], max_chan]][:, np.newaxis]
+
+    velocity_above = masked_slopes(yDist, trough_times, above_thresh & (yDist >= 0)) * 1e6
+    velocity_below = masked_slopes(yDist, trough_times, above_thresh & (yDist <= 0)) * 1e6
+
+    return amplitude, spread, velocity_above, velocity_below
+
+
+def masked_slopes(x, y, mask):
+
+    """
+    Least-squares slope of y against x over the masked points of each row
+
+    Inputs:
+    -------
+    x : numpy.ndarray (N) or (num_rows x N)
+    y : numpy.ndarray (num_rows x N)
+    mask : numpy.ndarray of bools (num_rows x N)
+
+    Outputs:
+    --------
+    slopes : numpy.ndarray (num_rows)
+        NaN for rows with fewer than two distinct masked x values
+
+    """
+
+    x = np.broadcast_to(x, y.shape)
+    count = np.sum(mask, 1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+
+        x_mean = np.sum(np.where(mask, x, 0), 1) / count
+        y_mean = np.sum(np.where(mask, y, 0), 1) / count
+
+        dx = np.where(mask, x - x_mean[:, np.newaxis], 0)
+        dy = np.where(mask, y - y_mean[:, np.newaxis], 0)
+
+        sxx = np.sum(np.square(dx), 1)
+
+        return np.where(sxx > 0, np.sum(dx * dy, 1) / sxx, np.nan)
+
+
+class WaveformMetricsTable():
+
+    """
+    Rows of waveform metrics collected into a preallocated array, so that the
+    table is built as one DataFrame instead of one pd.concat per unit
+
+    Column types are inferred once at the end, as pd.concat would have done
+    (e.g. spread stays integer if every unit's spread is an integer).
+
+    """
+
+    def __init__(self, max_rows):
+
+        self.rows = np.empty((max_rows, len(METRIC_COLUMNS)), dtype=object)
+        self.num_rows = 0
+
+    def append(self, row):
+
+        """ Adds a row returned by waveform_metric_row """
+
+        self.rows[self.num_rows, :] = row
+        self.num_rows += 1
+
+    def to_dataframe(self):
+
+        return pd.DataFrame(self.rows[:self.num_rows], columns=METRIC_COLUMNS).infer_objects()
 
 # ==========================================================
 
@@ -222,6 +526,31 @@ def calculate_snr(W):
     return snr
 
 
+def snr_from_moments(mean_waveform, std_waveform):
+
+    """
+    Calculate SNR from the mean and standard deviation of spike waveforms.
+
+    Equivalent to calculate_snr: the residuals about the mean waveform have
+    zero mean, so their standard deviation is the root of the mean variance
+    across samples.
+
+    Input:
+    -------
+    mean_waveform : mean of N waveforms (samples)
+    std_waveform : standard deviation (ddof = 0) of the same N waveforms (samples)
+
+    Output:
+    snr : signal-to-noise ratio for unit (scalar)
+
+    """
+
+    A = np.max(mean_waveform) - np.min(mean_waveform)
+    snr = A/(2*np.sqrt(np.mean(np.square(std_waveform))))
+
+    return snr
+
+
 def calculate_waveform_duration(waveform, timestamps):
     
     """ 
@@ -380,7 +709,7 @@ def calculate_waveform_recovery_slope(waveform, timestamps, window=20):
 # ==========================================================
 
 
-def calculate_2D_features(waveform, timestamps, peak_channel, site_x, site_y, spread_threshold = 0.12, site_range=16):
+def calculate_2D_features(waveform, timestamps, peak_channel, site_x, site_y, spread_threshold = 0.12, site_range=16, distances = None):
     
     """ 
     Compute features of 2D waveform (channels x samples)
@@ -393,6 +722,8 @@ def calculate_2D_features(waveform, timestamps, peak_channel, site_x, site_y, sp
     spread_threshold : float
     site_range: int
     site_x, site_y : float
+    distances : numpy.ndarray (N channels x N channels) (optional)
+        Distances between channels, computed once per probe (see channel_distances)
 
     Outputs:
     --------
@@ -410,7 +741,10 @@ def calculate_2D_features(waveform, timestamps, peak_channel, site_x, site_y, sp
     # x = x_peak or x_nn. For NP 1.0, this will select either the 
     # two left or two right hand columns.
     
-    dist = np.sqrt(( pow((site_x - site_x[peak_channel]),2) + pow((site_y - site_y[peak_channel]),2)))
+    if distances is None:
+        dist = np.sqrt(( pow((site_x - site_x[peak_channel]),2) + pow((site_y - site_y[peak_channel]),2)))
+    else:
+        dist = distances[peak_channel]
     ydiff = ( site_y != site_y[peak_channel])
     n_channel = site_x.size
     min_dist = 1e6   # a value larger than the  distance to nn
@@ -8,6 +8,7 @@ import numpy as np
 from .id_noise_templates import id_noise_templates, id_noise_templates_rf
 
 from ...common.utils import write_cluster_group_tsv, load_kilosort_data, read_cluster_group_tsv
+from ...common.result_cache import run_cached, kilosort_files
 
 
 def classify_noise_templates(args):
@@ -75,6 +76,21 @@ def classify_noise_templates(args):
     return {"execution_time" : execution_time} # output manifest
 
 
+def cache_files(args):
+
+    """ Files read and written by this module, for the result cache """
+
+    output_dir = args['directories']['kilosort_output_directory']
+
+    input_files = kilosort_files(output_dir) + kilosort_files(output_dir, ('cluster_KSLabel.tsv',))
+    if args['noise_waveform_params']['use_random_forest']:
+        input_files.append(args['noise_waveform_params']['classifier_path'])
+
+    output_files = kilosort_files(output_dir, (args['ephys_params']['cluster_group_file_name'],))
+
+    return input_files, output_files
+
+
 def main():
 
     from ._schemas import InputParameters, OutputParameters
@@ -82,7 +98,7 @@ def main():
     mod = ArgSchemaParser(schema_type=InputParameters,
                           output_schema_type=OutputParameters)
 
-    output = classify_noise_templates(mod.args)
+    output = run_cached('noise_templates', mod.args, classify_noise_templates, *cache_files(mod.args))
 
     output.update({"input_parameters": mod.args})
     if "output_json" in mod.args:
@@ -1,7 +1,7 @@
 from argschema import ArgSchema, ArgSchemaParser 
 from argschema.schemas import DefaultSchema
 from argschema.fields import Nested, InputDir, String, Float, Dict, Int, Boolean, NumpyArray
-from ...common.schemas import EphysParams, Directories
+from ...common.schemas import EphysParams, Directories, CacheParams
 
 class NoiseWaveformParams(DefaultSchema):
     classifier_path = String(required=True, help='Path to pre-trained waveform classifier')
@@ -37,6 +37,7 @@ class InputParameters(ArgSchema):
     noise_waveform_params = Nested(NoiseWaveformParams)
     ephys_params = Nested(EphysParams)
     directories = Nested(Directories)
+    cache_params = Nested(CacheParams, required=False, default={})
     
 class OutputSchema(DefaultSchema): 
 
@@ -7,7 +7,7 @@ import time
 import numpy as np
 import pandas as pd
 
-from ...common.utils import write_cluster_group_tsv, getFileVersion
+from ...common.utils import write_cluster_group_tsv, getFileVersion, read_metrics
 
 
 def filter_by_metrics(args):
@@ -24,9 +24,9 @@ def filter_by_metrics(args):
     waveform_metrics_file, version = getFileVersion(waveform_metrics_file_args)
     
     # read the metrics files and join with waveforms if previous module failed to
-    metrics = pd.read_csv(metrics_file)
+    metrics = read_metrics(metrics_file)
     if 'snr' not in metrics.columns:
-        waveform_metrics = pd.read_csv(waveform_metrics_file)
+        waveform_metrics = read_metrics(waveform_metrics_file)
         metrics = metrics.merge(waveform_metrics, left_on='cluster_id', right_on='cluster_id')
     
     # read cluster assignments
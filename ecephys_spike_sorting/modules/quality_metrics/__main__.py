@@ -1,18 +1,81 @@
 from argschema import ArgSchemaParser
 import os
+import glob
 import logging
 import time
 import pathlib
 
 
 import numpy as np
-import pandas as pd
 
 from ...common.utils import load_kilosort_data, write_cluster_group_tsv, read_cluster_group_tsv
-from ...common.utils import getFileVersion
+from ...common.utils import getFileVersion, read_metrics, write_metrics, metrics_feather_file
 from ...common.epoch import get_epochs_from_nwb_file
+from ...common.result_cache import run_cached, kilosort_files, versioned_files, KILOSORT_PC_FILES
 
-from .metrics import calculate_metrics
+from .metrics import calculate_metrics, cluster_fingerprints, changed_clusters, required_inputs
+from .streaming import load_streaming_data, calculate_metrics_streaming
+
+
+# parameters that don't change the values of the metrics
+RESULT_INDEPENDENT_PARAMS = ('multiprocessing_worker_count', 'mmap_features', 'incremental')
+
+
+def fingerprint_file_for(metrics_file):
+
+    return os.path.splitext(metrics_file)[0] + '_fingerprints.npz'
+
+
+def params_key(qm_params):
+
+    return repr(sorted((k, v) for k, v in qm_params.items() if k not in RESULT_INDEPENDENT_PARAMS))
+
+
+def load_previous_metrics(metrics_file, qm_params, cluster_ids, fingerprints):
+
+    """ Metrics of the last run and the clusters changed since, if reusable
+
+    Outputs:
+    --------
+    previous_metrics : pandas.DataFrame or None
+        Quality metrics columns of metrics_file (None if there is no usable
+        previous run, e.g. different parameters)
+    changed_cluster_ids : numpy.ndarray or None
+    previous_pc_layout : dict or None
+        Template and peak channel of each unit in the last run, for each
+        epoch (see calculate_metrics)
+
+    """
+
+    fingerprint_file = fingerprint_file_for(metrics_file)
+
+    if not (os.path.exists(metrics_file) and os.path.exists(fingerprint_file)):
+        print("No previous metrics to reuse; computing all units")
+        return None, None, None
+
+    previous = np.load(fingerprint_file)
+
+    if str(previous['params']) != params_key(qm_params):
+        print("Quality metrics parameters have changed; computing all units")
+        return None, None, None
+
+    if 'layout_epochs' not in previous:
+        print("No PC neighbourhoods saved with the previous run; computing all units")
+        return None, None, None
+
+    previous_pc_layout = {str(epoch_name) : (template_ids, peak_channels) for epoch_name, template_ids, peak_channels 
+                          in zip(previous['layout_epochs'], previous['layout_template_ids'], previous['layout_peak_channels'])}
+
+    previous_metrics = read_metrics(metrics_file)
+
+    # columns shared with the waveform metrics were suffixed by the merge
+    previous_metrics.columns = [c[:-len('_quality_metrics')] if c.endswith('_quality_metrics') else c 
+                                for c in previous_metrics.columns]
+
+    changed_cluster_ids = changed_clusters(previous['cluster_ids'], previous['fingerprints'], cluster_ids, fingerprints)
+    print(repr(len(changed_cluster_ids)) + " clusters changed since the previous run")
+
+    return previous_metrics, changed_cluster_ids, previous_pc_layout
 
 
 def calculate_quality_metrics(args):
@@ -21,7 +84,9 @@ def calculate_quality_metrics(args):
 
     start = time.time()
     
-    include_pcs = args['quality_metrics_params']['include_pcs']
+    # PCs are only loaded if one of the requested metrics uses them
+    include_pcs = args['quality_metrics_params']['include_pcs'] and \
+        'pcs' in required_inputs(args['quality_metrics_params'].get('metrics_to_compute'))
     
     # make usre we can write an output file
     
@@ -35,13 +100,19 @@ def calculate_quality_metrics(args):
 
 
     try:
+        if args['quality_metrics_params']['streaming']:
+            if args['quality_metrics_params']['incremental']:
+                print('WARNING: incremental is not supported with streaming; computing all units without saving fingerprints')
+            return calculate_streaming_quality_metrics(args, include_pcs, output_file, metrics_version, start)
+
         if include_pcs:
             spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
             channel_pos, clusterIDs, cluster_quality, cluster_amplitude, pc_features, pc_feature_ind, template_features = \
                     load_kilosort_data(args['directories']['kilosort_output_directory'], \
                         args['ephys_params']['sample_rate'], \
                         use_master_clock = False,
-                        include_pcs = include_pcs)
+                        include_pcs = include_pcs,
+                        mmap_features = args['quality_metrics_params']['mmap_features'])
         else:
             spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
             channel_pos, clusterIDs, cluster_quality, cluster_amplitude = \
@@ -51,8 +122,23 @@ def calculate_quality_metrics(args):
                         include_pcs = include_pcs)
             pc_features = []
             pc_feature_ind = []
+
+        previous_metrics = None
+        changed_cluster_ids = None
+        previous_pc_layout = None
+        pc_layout = None
+
+        if args['quality_metrics_params']['incremental']:
+            fingerprinted_ids, fingerprints = cluster_fingerprints(spike_times, spike_clusters)
+            previous_metrics, changed_cluster_ids, previous_pc_layout = load_previous_metrics(output_file, 
+                                                                                              args['quality_metrics_params'],
+                                                                                              fingerprinted_ids, 
+                                                                                              fingerprints)
+            pc_layout = {}
                     
-        metrics = calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes, channel_map, channel_pos, templates, pc_features, pc_feature_ind, args['quality_metrics_params'])
+        metrics = calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes, channel_map, channel_pos, templates, pc_features, pc_feature_ind, args['quality_metrics_params'],
+                                    previous_metrics = previous_metrics, changed_cluster_ids = changed_cluster_ids,
+                                    previous_pc_layout = previous_pc_layout, pc_layout = pc_layout)
 
     except FileNotFoundError:
         
@@ -64,6 +150,54 @@ def calculate_quality_metrics(args):
             "quality_metrics_output_file" : None} 
 
     
+    save_metrics(args, metrics, output_file, metrics_version)
+
+    if args['quality_metrics_params']['incremental']:
+        # without PC metrics there are no neighbourhoods to save
+        layout = {}
+        if pc_layout:
+            layout = {'layout_epochs' : np.array(list(pc_layout.keys())),
+                      'layout_template_ids' : np.array([pc_layout[epoch_name][0] for epoch_name in pc_layout]),
+                      'layout_peak_channels' : np.array([pc_layout[epoch_name][1] for epoch_name in pc_layout])}
+
+        np.savez(fingerprint_file_for(output_file), 
+                 cluster_ids = fingerprinted_ids, 
+                 fingerprints = fingerprints,
+                 params = params_key(args['quality_metrics_params']),
+                 **layout)
+    
+    execution_time = time.time() - start
+    print('total time: ' + str(np.around(execution_time,2)) + ' seconds')
+    print()
+    
+    return {"execution_time" : execution_time,
+            "quality_metrics_output_file" : output_file} # output manifest
+
+
+def calculate_streaming_quality_metrics(args, include_pcs, output_file, metrics_version, start):
+
+    """ Quality metrics for the complete session, reading the spike data in blocks """
+
+    spike_times, spike_clusters, spike_templates, amplitudes, channel_pos, pc_features, pc_feature_ind = \
+        load_streaming_data(args['directories']['kilosort_output_directory'], include_pcs)
+
+    metrics = calculate_metrics_streaming(spike_times, spike_clusters, spike_templates, amplitudes, channel_pos, 
+                                          pc_features, pc_feature_ind, args['quality_metrics_params'],
+                                          sample_rate = args['ephys_params']['sample_rate'],
+                                          memory_budget_mb = args['quality_metrics_params']['streaming_memory_mb'])
+
+    save_metrics(args, metrics, output_file, metrics_version)
+
+    execution_time = time.time() - start
+    print('total time: ' + str(np.around(execution_time,2)) + ' seconds')
+    print()
+
+    return {"execution_time" : execution_time,
+            "quality_metrics_output_file" : output_file} # output manifest
+
+
+def save_metrics(args, metrics, output_file, metrics_version):
+
     # build name for waveform_metrics file with matched version
     wm_args = args['waveform_metrics']['waveform_metrics_file']
     if metrics_version == 0:
@@ -72,20 +206,35 @@ def calculate_quality_metrics(args):
         # buld name for waveform metrics file with matched version
         wm = os.path.join( pathlib.Path(wm_args).parent, pathlib.Path(wm_args).stem + '_' + repr(metrics_version) + '.csv' )
     if os.path.exists(wm):
-        metrics = metrics.merge(pd.read_csv(wm, index_col=0),
+        metrics = metrics.merge(read_metrics(wm),
                      on='cluster_id',
                      suffixes=('_quality_metrics','_waveform_metrics'))
 
     print("Saving data...")
    
-    metrics.to_csv(output_file, index=False )
-    
-    execution_time = time.time() - start
-    print('total time: ' + str(np.around(execution_time,2)) + ' seconds')
-    print()
-    
-    return {"execution_time" : execution_time,
-            "quality_metrics_output_file" : output_file} # output manifest
+    write_metrics(metrics, output_file, args['cluster_metrics']['write_feather'])
+
+
+def cache_files(args):
+
+    """ Files read and written by this module, for the result cache """
+
+    waveform_metrics_file = args['waveform_metrics']['waveform_metrics_file']
+    cluster_metrics_file = args['cluster_metrics']['cluster_metrics_file']
+
+    output_dir = args['directories']['kilosort_output_directory']
+
+    input_files = kilosort_files(output_dir) + \
+        glob.glob(versioned_files(waveform_metrics_file)) + \
+        glob.glob(versioned_files(metrics_feather_file(waveform_metrics_file)))
+    if args['quality_metrics_params']['include_pcs']:
+        input_files += kilosort_files(output_dir, KILOSORT_PC_FILES)
+
+    output_files = [versioned_files(cluster_metrics_file),
+                    versioned_files(metrics_feather_file(cluster_metrics_file)),
+                    os.path.splitext(cluster_metrics_file)[0] + '*_fingerprints.npz']
+
+    return input_files, output_files
 
 
 def main():
@@ -95,7 +244,7 @@ def main():
     mod = ArgSchemaParser(schema_type=InputParameters,
                           output_schema_type=OutputParameters)
 
-    output = calculate_quality_metrics(mod.args)
+    output = run_cached('quality_metrics', mod.args, calculate_quality_metrics, *cache_files(mod.args))
 
     output.update({"input_parameters": mod.args})
     if "output_json" in mod.args:
@@ -1,7 +1,8 @@
 from argschema import ArgSchema, ArgSchemaParser 
 from argschema.schemas import DefaultSchema
-from argschema.fields import Nested, InputDir, String, Float, Dict, Int, Boolean
-from ...common.schemas import EphysParams, Directories, WaveformMetricsFile, ClusterMetricsFile
+from marshmallow.validate import OneOf
+from argschema.fields import Nested, InputDir, String, Float, Dict, Int, Boolean, List
+from ...common.schemas import EphysParams, Directories, WaveformMetricsFile, ClusterMetricsFile, CacheParams
 
 
 class QualityMetricsParams(DefaultSchema):
@@ -13,10 +14,19 @@ class QualityMetricsParams(DefaultSchema):
     max_spikes_for_nn = Int(required=False, default=10000, help='Further subsampling for NearestNeighbor calculation')
     n_neighbors = Int(required=False, default=4, help='Number of neighbors to use for NearestNeighbor calculation')
     n_silhouette = Int(required=False, default=10000, help='Number of spikes to use for calculating silhouette score')
+    multiprocessing_worker_count = Int(required=False, default=1, help='Number of worker processes for computing PC metrics (1 = no multiprocessing)')
+    pc_metrics_seed = Int(required=False, default=None, allow_none=True, help='Seed for the per-unit spike subsamples used by PC metrics; serial and parallel runs match for the same seed')
+    nn_mode = String(required=False, default='unit', validate=OneOf(['unit', 'neighbourhood']), help="'unit' builds a nearest-neighbor graph per unit; 'neighbourhood' shares one graph among units with the same peak channel (faster, rates differ slightly)")
+    nn_algorithm = String(required=False, default='ball_tree', validate=OneOf(['ball_tree', 'kd_tree', 'brute', 'auto', 'approximate']), help="Nearest-neighbor backend: 'ball_tree', 'kd_tree', 'brute', 'auto' (exact) or 'approximate' (pynndescent; faster, slightly lower recall)")
 
     drift_metrics_min_spikes_per_interval = Int(required=False, default=10, help='Minimum number of spikes for computing depth')
     drift_metrics_interval_s = Float(required=False, default=100, help='Interval length is seconds for computing spike depth')
     include_pcs = Boolean(required=False, default=True, help='Set to false if features were not saved with Phy output')
+    mmap_features = Boolean(required=False, default=False, help='Set to true to memory-map pc_features.npy instead of loading it into RAM (for long recordings)')
+    metrics_to_compute = List(String, required=False, default=None, allow_none=True, cli_as_single_argument=True, help="Metric columns to compute, e.g. ['firing_rate', 'isi_viol', 'amplitude_cutoff'] (default: all); pc_features.npy is only loaded if a PC-based metric is requested")
+    incremental = Boolean(required=False, default=False, help='Set to true to reuse PC-based metrics from the previous metrics file for clusters unaffected by curation since the last run (ignored with streaming)')
+    streaming = Boolean(required=False, default=False, help='Set to true to read the spike data from disk in blocks, for recordings too large to load (complete session only; PC-based metrics and silhouette score are computed on a sample of spikes)')
+    streaming_memory_mb = Int(required=False, default=2048, help='Approximate memory budget (in MB) for streaming quality metrics')
 
 class InputParameters(ArgSchema):
     
@@ -25,6 +35,7 @@ class InputParameters(ArgSchema):
     directories = Nested(Directories)
     waveform_metrics = Nested(WaveformMetricsFile)
     cluster_metrics = Nested(ClusterMetricsFile)
+    cache_params = Nested(CacheParams, required=False, default={})
     
 class OutputSchema(DefaultSchema): 
     input_parameters = Nested(InputParameters, 
@@ -1,24 +1,28 @@
 import numpy as np
 import pandas as pd
 import psutil
-from collections import OrderedDict
+import multiprocessing
+from collections import OrderedDict, namedtuple
 
 import warnings
 
 from sklearn.discriminant_analysis import LinearDiscriminantAnalysis as LDA
 from sklearn.neighbors import NearestNeighbors
-from sklearn.metrics import silhouette_score
+from sklearn.metrics import pairwise_distances_chunked
+from sklearn.covariance import ledoit_wolf
 
-from scipy.spatial.distance import cdist
 from scipy.stats import chi2
+from scipy.linalg import cholesky, solve_triangular, LinAlgError
 from scipy.ndimage.filters import gaussian_filter1d
 from scipy import special
 
 from ...common.epoch import Epoch
-from ...common.utils import printProgressBar, get_spike_depths
+from ...common.utils import printProgressBar, get_spike_depths, SpikeIndex, share_array, attach_shared_array
+from ...common.utils import select_rows, memmap_rows, gather_rows, scatter_pcs_to_channels, ChannelIndex, ClusterTemplateCounts
 
 
-def calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes, channel_map, channel_pos, templates, pc_features, pc_feature_ind, params, epochs = None):
+def calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes, channel_map, channel_pos, templates, pc_features, pc_feature_ind, params, epochs = None,
+                      previous_metrics = None, changed_cluster_ids = None, previous_pc_layout = None, pc_layout = None):
 
     """ Calculate metrics for all units on one probe
 
@@ -40,13 +44,31 @@ def calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes,
         Templates to which the spikes are assigned
     pc_features : numpy.ndarray (num_spikes x num_pcs x num_channels)
         Pre-computed PCs for blocks of channels around each spike
+        (may be a read-only numpy.memmap; only the rows in use are read)
     pc_feature_ind : numpy.ndarray (num_units x num_channels)
         Channel indices of PCs for each unit
     params : dict of parameters
         'isi_threshold' : minimum time for isi violations
         'tbin_sec' : time bin for ccg for contam_rate
+        'metrics_to_compute' : optional list of metric columns (see 
+            METRIC_COLUMNS); only the groups of metrics that produce them
+            are computed, and only these columns are returned
     epochs : list of Epoch objects
         contains information on Epoch start and stop times
+    previous_metrics : pandas.DataFrame (optional)
+        Metrics from an earlier run on the same spikes (e.g. before a round
+        of manual curation)
+    changed_cluster_ids : numpy.ndarray (optional)
+        Clusters whose spikes differ from that earlier run; with 
+        previous_metrics and previous_pc_layout, PC-based metrics are only 
+        recomputed for these clusters and those that share a PC 
+        neighbourhood with them (now or in the earlier run), and the rest 
+        are copied from previous_metrics
+    previous_pc_layout : dict (optional)
+        pc_layout of the earlier run
+    pc_layout : dict (optional)
+        If given, filled with the template and peak channel of each unit,
+        as (template_ids, peak_channels) for each epoch name
 
     
     Outputs:
@@ -57,7 +79,7 @@ def calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes,
 
     """
 
-    metrics = pd.DataFrame()
+    epoch_metrics = []
 
     if epochs is None:
         epochs = [Epoch('complete_session', 0, np.inf)]
@@ -66,6 +88,10 @@ def calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes,
     # epochs = [Epoch('test',0,10)]
     
     include_pcs = params['include_pcs']
+
+    # only the groups of metrics that were asked for are computed
+    columns = metric_columns(params.get('metrics_to_compute'))
+    groups = [group for group in METRIC_GROUPS if set(METRIC_GROUPS[group].columns) & set(columns)]
     
     
 #   after any curation, the number of templates may not match the number of templates  
@@ -83,107 +109,259 @@ def calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes,
     
     total_epochs = len(epochs)
 
-    for epoch in epochs:
+    # spike times are normally sorted, so each epoch is one contiguous block of
+    # spikes: slices give views instead of copies, and the cluster index is 
+    # built once for the session and cut down per epoch
+    times_sorted = np.all(np.diff(spike_times) >= 0)
 
-        in_epoch = (spike_times > epoch.start_time) * (spike_times < epoch.end_time)
+    if times_sorted:
+        session_index = SpikeIndex(spike_clusters, total_units)
 
-        print("Calculating isi violations")
-        isi_viol, num_viol = calculate_isi_violations(spike_times[in_epoch], spike_clusters[in_epoch], total_units, params['isi_threshold'], params['min_isi'])
-        
-        print("Calculating contamination rate")
-        contam_rate = calculate_contam_rate(spike_times[in_epoch], spike_clusters[in_epoch], total_units, params['tbin_sec'], params['isi_threshold'])
-
-        print("Calculating presence ratio")
-        presence_ratio = calculate_presence_ratio(spike_times[in_epoch], spike_clusters[in_epoch], total_units)
+    for epoch in epochs:
 
-        print("Calculating firing rate")
-        firing_rate = calculate_firing_rate(spike_times[in_epoch], spike_clusters[in_epoch], total_units)
-        
-        print("Calculating amplitude cutoff")
-        amplitude_cutoff = calculate_amplitude_cutoff(spike_clusters[in_epoch], amplitudes[in_epoch], total_units)
-        
-        if include_pcs:
+        if times_sorted:
+            first = np.searchsorted(spike_times, epoch.start_time, side='right')
+            last = max(first, np.searchsorted(spike_times, epoch.end_time, side='left'))
+            in_epoch = slice(first, last)
+            spike_index = session_index.restrict(first, last)
+        else:
+            in_epoch = (spike_times > epoch.start_time) * (spike_times < epoch.end_time)
+            # sort spikes by cluster once; every helper reads per-unit slices from this index
+            spike_index = SpikeIndex(spike_clusters[in_epoch], total_units)
+
+        epoch_data = {'epoch' : epoch,
+                      'spike_times' : spike_times[in_epoch],
+                      'spike_clusters' : spike_clusters[in_epoch],
+                      'spike_templates' : spike_templates[in_epoch],
+                      'amplitudes' : amplitudes[in_epoch],
+                      'spike_index' : spike_index,
+                      'total_units' : total_units,
+                      'pc_feature_ind' : pc_feature_ind,
+                      'channel_pos' : channel_pos,
+                      'params' : params,
+                      'previous_metrics' : previous_metrics,
+                      'changed_cluster_ids' : changed_cluster_ids,
+                      'previous_pc_layout' : previous_pc_layout,
+                      'pc_layout' : pc_layout}
+
+        if include_pcs and any('pcs' in METRIC_GROUPS[group].inputs for group in groups):
+
+            # a view (not a copy) when the epoch is a contiguous block of spikes
+            if times_sorted:
+                epoch_data['pc_features'] = memmap_rows(pc_features, first, last)
+            else:
+                epoch_data['pc_features'] = select_rows(pc_features, in_epoch)
             
             # determine template this is the best match for each cluster id
             # initialize template ids
             template_ids = template_ids + total_units + 10  # unassinged template_ids out of range
-            curr_spike_clusters = spike_clusters[in_epoch]
-            curr_spike_templates = spike_templates[in_epoch]
-            curr_cluster_ids = np.unique(curr_spike_clusters)
-            for cid in curr_cluster_ids:
-                cluster_templates = curr_spike_templates[np.where(curr_spike_clusters==cid)]
-                template_ids[cid] = np.argmax(np.bincount(cluster_templates)) 
-
-            print("Calculating PC-based metrics")
-            isolation_distance, l_ratio, d_prime, nn_hit_rate, nn_miss_rate = calculate_pc_metrics(spike_clusters[in_epoch],
-                                                                                                spike_templates[in_epoch],
-                                                                                                total_units,
-                                                                                                curr_cluster_ids,
-                                                                                                template_ids,
-                                                                                                pc_features[in_epoch,:,:],
-                                                                                                pc_feature_ind,
-                                                                                                channel_pos,
-                                                                                                params['max_radius_um'],
-                                                                                                params['max_spikes_for_unit'],
-                                                                                                params['max_spikes_for_nn'],
-                                                                                                params['n_neighbors'])
-  
-            print("Calculating silhouette score")
-            nSpikes = spike_times[in_epoch].size
-            the_silhouette_score = calculate_silhouette_score(spike_clusters[in_epoch], 
-                                                       spike_templates[in_epoch],
-                                                       total_units,                                                      
-                                                       pc_features[in_epoch,:,:],
-                                                       pc_feature_ind,
-                                                       min(nSpikes, params['n_silhouette']))
-
-
-            print("Calculating drift metrics")
-            max_drift, cumulative_drift = calculate_drift_metrics(spike_times[in_epoch],
-                                                       spike_clusters[in_epoch], 
-                                                       spike_templates,
-                                                       template_ids,
-                                                       total_units,
-                                                       pc_features[in_epoch,:,:],
-                                                       pc_feature_ind,
-                                                       channel_pos,
-                                                       params['drift_metrics_interval_s'],
-                                                       params['drift_metrics_min_spikes_per_interval'])
-        else:
-            # fill in empty arrays for dataframe            
-            isolation_distance = np.zeros((total_units,))
-            l_ratio = np.zeros((total_units,))
-            d_prime = np.zeros((total_units,))
-            nn_hit_rate = np.zeros((total_units,))
-            nn_miss_rate = np.zeros((total_units,))
-            the_silhouette_score = np.zeros((total_units,))
-            max_drift = np.zeros((total_units,))
-            cumulative_drift = np.zeros((total_units,))
-            
+            template_counts = ClusterTemplateCounts(epoch_data['spike_clusters'], epoch_data['spike_templates'], total_units)
+            template_ids[spike_index.cluster_ids] = template_counts.majority_templates()[spike_index.cluster_ids]
+
+            epoch_data['template_ids'] = template_ids
+
+        values = OrderedDict()
+
+        for group in groups:
+
+            metric_group = METRIC_GROUPS[group]
+
+            if 'pcs' in metric_group.inputs and not include_pcs:
+                # fill in empty arrays for dataframe
+                values.update((column, np.zeros((total_units,))) for column in metric_group.columns)
+            else:
+                print("Calculating " + metric_group.description)
+                values.update(zip(metric_group.columns, metric_group.compute(epoch_data)))
             
         cluster_ids = np.arange(total_units)
 
         epoch_name = [epoch.name] * len(cluster_ids)
 
-        metrics = pd.concat((metrics, pd.DataFrame(data= OrderedDict((('cluster_id', cluster_ids),
-                                ('firing_rate' , firing_rate),
-                                ('presence_ratio' , presence_ratio),
-                                ('isi_viol' , isi_viol),
-                                ('num_viol', num_viol),
-                                ('amplitude_cutoff' , amplitude_cutoff),
-                                ('isolation_distance' , isolation_distance),
-                                ('contam_rate', contam_rate),
-                                ('l_ratio' , l_ratio),
-                                ('d_prime' , d_prime),
-                                ('nn_hit_rate' , nn_hit_rate),
-                                ('nn_miss_rate' , nn_miss_rate),
-                                ('silhouette_score', the_silhouette_score),
-                                ('max_drift', max_drift),
-                                ('cumulative_drift', cumulative_drift),
-                                ('epoch_name' , epoch_name),
-                                )))))
-
-    return metrics 
+        epoch_metrics.append(pd.DataFrame(data= OrderedDict([('cluster_id', cluster_ids)] +
+                                                            [(column, values[column]) for column in columns] +
+                                                            [('epoch_name' , epoch_name)])))
+
+    return pd.concat(epoch_metrics)
+
+# ===============================================================
+
+# METRIC REGISTRY:
+
+# ===============================================================
+
+# Each group of metrics is computed by one call, from one epoch's data (see 
+# calculate_metrics). inputs are the data it needs beyond spike times and
+# clusters ('times', 'amplitudes', 'pcs'); cost is a rough guide for 
+# choosing metrics_to_compute ('cheap': one vectorized pass over the spikes,
+# 'moderate': subsampled or per-interval work, 'expensive': per-unit
+# fitting and nearest-neighbor searches)
+
+MetricGroup = namedtuple('MetricGroup', ['columns', 'inputs', 'cost', 'description', 'compute'])
+
+
+def _spike_train_metrics(data):
+
+    params = data['params']
+
+    return calculate_spike_train_metrics(data['spike_times'], 
+                                         data['spike_clusters'], 
+                                         data['total_units'], 
+                                         params['isi_threshold'], 
+                                         params['min_isi'], 
+                                         spike_index = data['spike_index'])
+
+
+def _contam_rate(data):
+
+    params = data['params']
+
+    contam_rate = calculate_contam_rate(data['spike_times'], data['spike_clusters'], data['total_units'], 
+                                        params['tbin_sec'], params['isi_threshold'], data['spike_index'])
+
+    return (contam_rate,)
+
+
+def _amplitude_cutoff(data):
+
+    return (calculate_amplitude_cutoff(data['spike_clusters'], data['amplitudes'], data['total_units'], data['spike_index']),)
+
+
+def _pc_metrics(data):
+
+    params = data['params']
+    spike_index = data['spike_index']
+    template_ids = data['template_ids']
+    curr_cluster_ids = spike_index.cluster_ids
+    previous_metrics = data['previous_metrics']
+
+    epoch_name = data['epoch'].name
+    previous_layout = (data['previous_pc_layout'] or {}).get(epoch_name)
+
+    peak_channels = None
+    units_to_compute = None
+
+    reuse = previous_metrics is not None and data['changed_cluster_ids'] is not None and previous_layout is not None
+
+    if reuse or data['pc_layout'] is not None:
+        peak_channels = unit_peak_channels(curr_cluster_ids, template_ids, data['total_units'], data['pc_features'], 
+                                           data['pc_feature_ind'], spike_index)
+
+    if data['pc_layout'] is not None:
+        data['pc_layout'][epoch_name] = (template_ids.copy(), peak_channels.copy())
+
+    if reuse:
+        previous = previous_metrics[previous_metrics.epoch_name == epoch_name].set_index('cluster_id')
+        changed = np.union1d(data['changed_cluster_ids'], np.setdiff1d(curr_cluster_ids, previous.index))
+        units_to_compute = units_to_recompute(changed, curr_cluster_ids, template_ids, peak_channels, 
+                                              data['pc_feature_ind'], data['channel_pos'], params['max_radius_um'],
+                                              *previous_layout)
+        print("Recomputing PC-based metrics for " + repr(len(units_to_compute)) + " of " + repr(len(curr_cluster_ids)) + " units")
+
+    pc_metrics = calculate_pc_metrics(data['spike_clusters'],
+                                      data['spike_templates'],
+                                      data['total_units'],
+                                      curr_cluster_ids,
+                                      template_ids,
+                                      data['pc_features'],
+                                      data['pc_feature_ind'],
+                                      data['channel_pos'],
+                                      params['max_radius_um'],
+                                      params['max_spikes_for_unit'],
+                                      params['max_spikes_for_nn'],
+                                      params['n_neighbors'],
+                                      spike_index,
+                                      params.get('multiprocessing_worker_count', 1),
+                                      params.get('pc_metrics_seed', None),
+                                      params.get('nn_mode', 'unit'),
+                                      params.get('nn_algorithm', 'ball_tree'),
+                                      peak_channels,
+                                      units_to_compute)
+
+    if units_to_compute is not None:
+        reused = np.setdiff1d(curr_cluster_ids, units_to_compute)
+        for column, values in zip(METRIC_GROUPS['pc_metrics'].columns, pc_metrics):
+            values[reused] = previous.loc[reused, column].values
+
+    return pc_metrics
+
+
+def _silhouette_score(data):
+
+    nSpikes = data['spike_times'].size
+
+    the_silhouette_score = calculate_silhouette_score(data['spike_clusters'], 
+                                                      data['spike_templates'],
+                                                      data['total_units'],
+                                                      data['pc_features'],
+                                                      data['pc_feature_ind'],
+                                                      min(nSpikes, data['params']['n_silhouette']))
+
+    return (the_silhouette_score,)
+
+
+def _drift_metrics(data):
+
+    params = data['params']
+
+    return calculate_drift_metrics(data['spike_times'],
+                                   data['spike_clusters'], 
+                                   data['spike_templates'],
+                                   data['template_ids'],
+                                   data['total_units'],
+                                   data['pc_features'],
+                                   data['pc_feature_ind'],
+                                   data['channel_pos'],
+                                   params['drift_metrics_interval_s'],
+                                   params['drift_metrics_min_spikes_per_interval'])
+
+
+# in order of computation
+METRIC_GROUPS = OrderedDict((
+    ('spike_train', MetricGroup(('firing_rate', 'presence_ratio', 'isi_viol', 'num_viol'), 
+                                ('times',), 'cheap', 'firing rate, presence ratio and isi violations', _spike_train_metrics)),
+    ('contam_rate', MetricGroup(('contam_rate',), 
+                                ('times',), 'cheap', 'contamination rate', _contam_rate)),
+    ('amplitude_cutoff', MetricGroup(('amplitude_cutoff',), 
+                                     ('amplitudes',), 'cheap', 'amplitude cutoff', _amplitude_cutoff)),
+    ('pc_metrics', MetricGroup(('isolation_distance', 'l_ratio', 'd_prime', 'nn_hit_rate', 'nn_miss_rate'), 
+                               ('pcs',), 'expensive', 'PC-based metrics', _pc_metrics)),
+    ('silhouette_score', MetricGroup(('silhouette_score',), 
+                                     ('pcs',), 'moderate', 'silhouette score', _silhouette_score)),
+    ('drift', MetricGroup(('max_drift', 'cumulative_drift'), 
+                          ('times', 'pcs'), 'moderate', 'drift metrics', _drift_metrics)),
+    ))
+
+# column order of the metrics table
+METRIC_COLUMNS = ('firing_rate', 'presence_ratio', 'isi_viol', 'num_viol', 'amplitude_cutoff', 
+                  'isolation_distance', 'contam_rate', 'l_ratio', 'd_prime', 'nn_hit_rate', 'nn_miss_rate', 
+                  'silhouette_score', 'max_drift', 'cumulative_drift')
+
+
+def metric_columns(metrics_to_compute = None):
+
+    """ Requested metrics in table order (all of them if metrics_to_compute is None) """
+
+    if metrics_to_compute is None:
+        return list(METRIC_COLUMNS)
+
+    unknown = set(metrics_to_compute) - set(METRIC_COLUMNS)
+
+    if unknown:
+        raise ValueError('unrecognized metrics: {}'.format(', '.join(sorted(unknown))))
+
+    return [column for column in METRIC_COLUMNS if column in metrics_to_compute]
+
+
+def required_inputs(metrics_to_compute = None):
+
+    """ Inputs ('times', 'amplitudes', 'pcs') needed for the requested metrics """
+
+    columns = metric_columns(metrics_to_compute)
+
+    return set(input_name for metric_group in METRIC_GROUPS.values() 
+               if set(metric_group.columns) & set(columns) 
+               for input_name in metric_group.inputs)
+
 
 # ===============================================================
 
@@ -191,49 +369,155 @@ def calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes,
 
 # ===============================================================
 
-def calculate_isi_violations(spike_times, spike_clusters, total_units, isi_threshold, min_isi):
+def calculate_spike_train_metrics(spike_times, spike_clusters, total_units, isi_threshold, min_isi, num_bins = 100, spike_index = None):
+
+    """ Firing rate, presence ratio and ISI violations for all units in one pass
+
+    Vectorized equivalent of calculate_firing_rate, calculate_presence_ratio and 
+    calculate_isi_violations: spike times are grouped by unit with the SpikeIndex
+    and every per-unit quantity is a bincount over the cluster-sorted arrays.
+
+    Inputs:
+    -------
+    spike_times : numpy.ndarray (num_spikes x 0)
+        Spike times in seconds
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster IDs for each spike time
+    total_units : Int
+        Number of cluster IDs (size of the output arrays)
+    isi_threshold : float
+        Threshold for isi violation
+    min_isi : float
+        Threshold for duplicate spikes
+    num_bins : Int
+        Number of bins for presence ratio
+    spike_index : SpikeIndex (optional)
+        Precomputed cluster to spike index
+
+    Outputs:
+    --------
+    firing_rates : numpy.ndarray (total_units x 0)
+    presence_ratios : numpy.ndarray (total_units x 0)
+    viol_rates : numpy.ndarray (total_units x 0)
+    num_viol : numpy.ndarray (total_units x 0)
+
+    """
+
+    if spike_index is None:
+        spike_index = SpikeIndex(spike_clusters, total_units)
+
+    firing_rates = np.zeros((total_units,))
+    presence_ratios = np.zeros((total_units,))
+    viol_rates = np.zeros((total_units,))
+    num_viol = np.zeros((total_units,))
+
+    cluster_ids = spike_index.cluster_ids
+
+    if cluster_ids.size == 0:
+        return firing_rates, presence_ratios, viol_rates, num_viol
+
+    min_time = np.min(spike_times)
+    max_time = np.max(spike_times)
+    duration = max_time - min_time
+
+    # spike times grouped by unit; within a unit they stay in time order
+    times = spike_index.sort(spike_times)
+    clusters = spike_index.sorted_clusters()
+    same_unit = clusters[1:] == clusters[:-1]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+
+        # firing rate
+        firing_rates[cluster_ids] = spike_index.counts[cluster_ids] / duration
+
+        # presence ratio -- same bins as np.histogram(spike_train, np.linspace(min_time, max_time, num_bins))
+        bin_edges = np.linspace(min_time, max_time, num_bins)
+        bins = np.searchsorted(bin_edges, times, side='right') - 1
+        bins = np.clip(bins, 0, num_bins - 2)  # last bin includes its right edge
+        occupied = np.zeros((total_units, num_bins - 1), dtype='bool')
+        occupied[clusters, bins] = True
+        presence_ratios[cluster_ids] = np.sum(occupied[cluster_ids, :], 1) / num_bins
+
+        # isi violations -- remove duplicate spikes, then count short isis in what remains
+        duplicate_spikes = same_unit & (np.diff(times) <= min_isi)
+        keep = np.ones((times.size,), dtype='bool')
+        keep[1:][duplicate_spikes] = False
+
+        kept_times = times[keep]
+        kept_clusters = clusters[keep]
+        violations = (kept_clusters[1:] == kept_clusters[:-1]) & (np.diff(kept_times) < isi_threshold)
+
+        num_spikes = np.bincount(kept_clusters, minlength = total_units)[cluster_ids]
+        num_violations = np.bincount(kept_clusters[1:][violations], minlength = total_units)[cluster_ids]
+        violation_time = 2 * num_spikes * (isi_threshold - min_isi)
+        total_rate = num_spikes / duration
+        c = num_violations / (violation_time * total_rate)
+
+        # valid solution to quadratic eq. for fpRate if c < 0.25, otherwise fpRate = 1
+        viol_rates[cluster_ids] = np.where(c < 0.25, (1 - np.sqrt(1 - 4 * c)) / 2, 1.0)
+        num_viol[cluster_ids] = num_violations
+
+    return firing_rates, presence_ratios, viol_rates, num_viol
+
+
+def calculate_isi_violations(spike_times, spike_clusters, total_units, isi_threshold, min_isi, spike_index = None):
+
+    if spike_index is None:
+        spike_index = SpikeIndex(spike_clusters, total_units)
 
-    cluster_ids = np.unique(spike_clusters)
+    cluster_ids = spike_index.cluster_ids
 
     viol_rates = np.zeros((total_units,))
     
     num_viol =np.zeros((total_units,))
 
+    min_time = np.min(spike_times)
+    max_time = np.max(spike_times)
+
     for idx, cluster_id in enumerate(cluster_ids):
 
         printProgressBar(idx+1, len(cluster_ids))
 
-        for_this_cluster = (spike_clusters == cluster_id)
+        for_this_cluster = spike_index.spikes_for(cluster_id)
         viol_rates[cluster_id], num_viol[cluster_id] = isi_violations(spike_times[for_this_cluster], 
-                                                               min_time = np.min(spike_times), 
-                                                               max_time = np.max(spike_times), 
+                                                               min_time = min_time, 
+                                                               max_time = max_time, 
                                                                isi_threshold=isi_threshold, 
                                                                min_isi = min_isi)
 
     return viol_rates, num_viol
 
-def calculate_presence_ratio(spike_times, spike_clusters, total_units):
+def calculate_presence_ratio(spike_times, spike_clusters, total_units, spike_index = None):
 
-    cluster_ids = np.unique(spike_clusters)
+    if spike_index is None:
+        spike_index = SpikeIndex(spike_clusters, total_units)
+
+    cluster_ids = spike_index.cluster_ids
 
     ratios = np.zeros((total_units,))
 
+    min_time = np.min(spike_times)
+    max_time = np.max(spike_times)
+
     for idx, cluster_id in enumerate(cluster_ids):
 
         printProgressBar(idx + 1, len(cluster_ids))
 
-        for_this_cluster = (spike_clusters == cluster_id)
+        for_this_cluster = spike_index.spikes_for(cluster_id)
         ratios[cluster_id] = presence_ratio(spike_times[for_this_cluster], 
-                                                       min_time = np.min(spike_times), 
-                                                       max_time = np.max(spike_times))
+                                                       min_time = min_time, 
+                                                       max_time = max_time)
 
     return ratios
 
 
 
-def calculate_firing_rate(spike_times, spike_clusters, total_units):
+def calculate_firing_rate(spike_times, spike_clusters, total_units, spike_index = None):
 
-    cluster_ids = np.unique(spike_clusters)
+    if spike_index is None:
+        spike_index = SpikeIndex(spike_clusters, total_units)
+
+    cluster_ids = spike_index.cluster_ids
 
     firing_rates = np.zeros((total_units,))
 
@@ -244,45 +528,82 @@ def calculate_firing_rate(spike_times, spike_clusters, total_units):
 
         printProgressBar(idx + 1, len(cluster_ids))
 
-        for_this_cluster = (spike_clusters == cluster_id)
+        for_this_cluster = spike_index.spikes_for(cluster_id)
         firing_rates[cluster_id] = firing_rate(spike_times[for_this_cluster], 
-                                        min_time = np.min(spike_times),
-                                        max_time = np.max(spike_times))
+                                        min_time = min_time,
+                                        max_time = max_time)
 
     return firing_rates
 
 
-def calculate_amplitude_cutoff(spike_clusters, amplitudes, total_units):
+def calculate_amplitude_cutoff(spike_clusters, amplitudes, total_units, spike_index = None, num_histogram_bins = 500):
+
+    """ Amplitude cutoff for all units at once
 
-    cluster_ids = np.unique(spike_clusters)
+    Same values as amplitude_cutoff for each unit: every unit's amplitudes are
+    binned into its own num_histogram_bins bins (as np.histogram would), 
+    giving one units x bins matrix that is smoothed and searched row-wise 
+    (see amplitude_cutoffs_from_histograms).
+
+    """
+
+    if spike_index is None:
+        spike_index = SpikeIndex(spike_clusters, total_units)
+
+    cluster_ids = spike_index.cluster_ids
 
     amplitude_cutoffs = np.zeros((total_units,))
 
-    for idx, cluster_id in enumerate(cluster_ids):
+    if cluster_ids.size == 0:
+        return amplitude_cutoffs
 
-        printProgressBar(idx + 1, len(cluster_ids))
+    # amplitudes grouped by unit
+    unit_amplitudes = spike_index.sort(np.ravel(amplitudes))
+    clusters = spike_index.sorted_clusters()
+    unit_starts = spike_index.offsets[cluster_ids]
+
+    first_edge = np.zeros((total_units,), dtype = unit_amplitudes.dtype)
+    last_edge = np.zeros((total_units,), dtype = unit_amplitudes.dtype)
+    first_edge[cluster_ids] = np.minimum.reduceat(unit_amplitudes, unit_starts)
+    last_edge[cluster_ids] = np.maximum.reduceat(unit_amplitudes, unit_starts)
+
+    edges = unit_histogram_edges(first_edge, last_edge, num_histogram_bins)
+    bins = unit_histogram_bins(unit_amplitudes, clusters, edges)
+
+    counts = np.reshape(np.bincount(clusters * num_histogram_bins + bins, minlength = total_units * num_histogram_bins),
+                        (total_units, num_histogram_bins))
 
+    # density, as np.histogram(density = True)
+    h = counts[cluster_ids] / np.diff(edges[cluster_ids], axis = 1) / spike_index.counts[cluster_ids, np.newaxis]
 
-        for_this_cluster = (spike_clusters == cluster_id)
-        amplitude_cutoffs[cluster_id] = amplitude_cutoff(amplitudes[for_this_cluster])
+    amplitude_cutoffs[cluster_ids] = amplitude_cutoffs_from_histograms(h, edges[cluster_ids])
 
     return amplitude_cutoffs
 
 
-def calculate_contam_rate(spike_times, spike_clusters, total_units, tbin_sec, refPer_sec):
+def calculate_contam_rate(spike_times, spike_clusters, total_units, tbin_sec, refPer_sec, spike_index = None):
 
-    cluster_ids = np.unique(spike_clusters)
+    if spike_index is None:
+        spike_index = SpikeIndex(spike_clusters, total_units)
+
+    cluster_ids = spike_index.cluster_ids
 
     contam_rate = np.ones((total_units,))
 
+    nbins = 500  # 500 bins on each side of zero lag, as in contamination_rate
+
+    acgs = calculate_acgs(spike_times, spike_clusters, total_units, nbins, tbin_sec, min_spikes = 11, spike_index = spike_index)
+
     for idx, cluster_id in enumerate(cluster_ids):
 
         printProgressBar(idx + 1, len(cluster_ids))
 
-        curr_st_sec = spike_times[spike_clusters == cluster_id]
+        curr_st_sec = spike_times[spike_index.spikes_for(cluster_id)]
         
         if len(curr_st_sec) > 10: 
-            contam_rate[cluster_id] = contamination_rate(curr_st_sec, tbin_sec, refPer_sec)           
+            T = np.max(curr_st_sec) - np.min(curr_st_sec)
+            Qi, Q00, Q01, Ri = ccg_refractory_stats(acgs[cluster_id, :], len(curr_st_sec), len(curr_st_sec), T, nbins, tbin_sec)
+            contam_rate[cluster_id] = contamination_from_stats(Qi, Q00, Q01, tbin_sec, refPer_sec)
 
     return contam_rate
 
@@ -298,107 +619,307 @@ def calculate_pc_metrics(spike_clusters,
                          max_radius_um, 
                          max_spikes_for_cluster, 
                          max_spikes_for_nn, 
-                         n_neighbors):
+                         n_neighbors,
+                         spike_index = None,
+                         num_workers = 1,
+                         seed = None,
+                         nn_mode = 'unit',
+                         nn_algorithm = 'ball_tree',
+                         peak_channels = None,
+                         units_to_compute = None):
 
 # OLDER calculatioon assuming linear array and using a number of channels instead of max_radius
 #    assert(num_channels_to_compare % 2 == 1)
 #    half_spread = int((num_channels_to_compare - 1) / 2)
 
 
-    peak_channels = np.zeros((total_units,), dtype='uint16')
     isolation_distances = np.zeros((total_units,))
     l_ratios = np.zeros((total_units,))
     d_primes = np.zeros((total_units,))
     nn_hit_rates = np.zeros((total_units,))
     nn_miss_rates = np.zeros((total_units,))
     
+    if spike_index is None:
+        spike_index = SpikeIndex(spike_clusters, total_units)
+
+    if peak_channels is None:
+        peak_channels = unit_peak_channels(cluster_ids, template_ids, total_units, pc_features, pc_feature_ind, spike_index)
+
+    # units with PCs on each channel, shared by every unit's neighbourhood
+    channel_index = ChannelIndex(pc_feature_ind, channel_pos, template_ids)
+
+    # peak channels (and so neighbourhoods) cover every unit, but the 
+    # metrics themselves may be limited to a subset
+    if units_to_compute is not None:
+        cluster_ids = units_to_compute
+
+    if num_workers > 1 and seed is None:
+        # workers can't share the global random state; draw one seed from it
+        # so that np.random.seed still makes parallel runs reproducible
+        seed = np.random.randint(2**31)
+
+    if num_workers > 1 and len(cluster_ids) > 1:
+
+        unit_metrics = calculate_pc_metrics_parallel(spike_templates,
+                                                     cluster_ids,
+                                                     template_ids,
+                                                     peak_channels,
+                                                     pc_features,
+                                                     pc_feature_ind,
+                                                     channel_pos,
+                                                     max_radius_um,
+                                                     max_spikes_for_cluster,
+                                                     max_spikes_for_nn,
+                                                     n_neighbors,
+                                                     spike_index,
+                                                     num_workers,
+                                                     seed,
+                                                     nn_mode,
+                                                     nn_algorithm,
+                                                     channel_index)
+
+    else:
+
+        unit_metrics = []
+        nn_cache = {}
+
+        for idx, cluster_id in enumerate(cluster_ids):
+
+            printProgressBar(idx + 1, len(cluster_ids))
+
+            unit_metrics.append(pc_metrics_for_unit(cluster_id,
+                                                    spike_templates,
+                                                    template_ids,
+                                                    peak_channels,
+                                                    pc_features,
+                                                    pc_feature_ind,
+                                                    channel_pos,
+                                                    max_radius_um,
+                                                    max_spikes_for_cluster,
+                                                    max_spikes_for_nn,
+                                                    n_neighbors,
+                                                    spike_index,
+                                                    unit_random_state(seed, cluster_id),
+                                                    nn_mode,
+                                                    nn_algorithm,
+                                                    nn_cache,
+                                                    channel_index))
+
+    for cluster_id, (isolation_distance, l_ratio, d_prime, hit_rate, miss_rate) in zip(cluster_ids, unit_metrics):
+
+        isolation_distances[cluster_id] = isolation_distance
+        l_ratios[cluster_id] = l_ratio
+        d_primes[cluster_id] = d_prime
+        nn_hit_rates[cluster_id] = hit_rate
+        nn_miss_rates[cluster_id] = miss_rate
+
+    return isolation_distances, l_ratios, d_primes, nn_hit_rates, nn_miss_rates 
+
+
+def unit_peak_channels(cluster_ids, template_ids, total_units, pc_features, pc_feature_ind, spike_index):
+
+    """ Channel with the largest mean first PC for each unit """
+
+    peak_channels = np.zeros((total_units,), dtype='uint16')
 
 # pc_feature_ind is NOT updated by phy during manual clustering
 
     for idx, cluster_id in enumerate(cluster_ids):
             
         # individual pcs are stored for each spike, independent of cluster id
-        for_unit = np.squeeze(spike_clusters == cluster_id)
+        for_unit = spike_index.spikes_for(cluster_id)
         pc_max = np.argmax(np.mean(pc_features[for_unit, 0, :],0))
         
         # pc_feature_ind are stored according to template, using the 
         # most common template for spikes in this cluster in this epoch
         peak_channels[cluster_id] = pc_feature_ind[template_ids[cluster_id], pc_max]
 
-    for idx, cluster_id in enumerate(cluster_ids):
+    return peak_channels
 
-        
-        printProgressBar(idx + 1, len(cluster_ids))
 
-            
-        peak_channel = peak_channels[cluster_id]
-        
-        # calculate distances from all channels to peak channel
-        chan_dist = np.sqrt(np.square(channel_pos[:,0] - channel_pos[peak_channel,0]) + \
-                            np.square(channel_pos[:,1] - channel_pos[peak_channel,1]) )
-
-# OLDER calculatioon assuming linear array
-#        half_spread_down = peak_channel \
-#            if peak_channel < half_spread \
-#            else half_spread
-#
-#        half_spread_up = np.max(pc_feature_ind) - peak_channel \
-#            if peak_channel + half_spread > np.max(pc_feature_ind) \
-#            else half_spread
-
-        # which templates have pcs on the peak channel of the current unit?
-        # channel index -- which of the channel swithin the set for a single template -- i snot used
-        templates_for_channel, channel_index = np.unravel_index(np.where(pc_feature_ind.flatten() == peak_channel)[0], pc_feature_ind.shape)
-
-
-        # which units have these templates?       
-        units_for_channel = np.zeros((0,),dtype='uint16')
-        for j in templates_for_channel:
-            units_for_channel = np.append(units_for_channel, np.where(template_ids==j))
-                  
-               
-# OLDER calculatioon assuming linear array        
-#        units_in_range = (peak_channels[units_for_channel] >= peak_channel - half_spread_down) * \
-#                       (peak_channels[units_for_channel] <= peak_channel + half_spread_up)
-                        
-        
-        # of those units that have pc overlap, which have their peak channel 
-        # within range of the current unit?              
-        units_in_range = np.where( chan_dist[peak_channels[units_for_channel]] < max_radius_um )[0]
-           
-            
-        # If there is at least one neighbor unit in range, compare pcs across 
-        # units for channels that overlap AND lie within maximum radius
+def units_to_recompute(changed_cluster_ids, cluster_ids, template_ids, peak_channels, pc_feature_ind, channel_pos, max_radius_um,
+                       previous_template_ids, previous_peak_channels):
+
+    """ Units whose PC-based metrics can depend on any of the changed clusters
+
+    A unit is compared only against the units in its PC neighbourhood (see 
+    pc_neighbourhood), so it needs recomputing if it changed itself or if a 
+    changed cluster is one of those neighbours. Both the current 
+    neighbourhood and the one of the earlier run are checked: a removed or 
+    merged cluster may have left the neighbourhood, which changes the 
+    comparison set even if no current neighbour changed.
+
+    Inputs:
+    -------
+    previous_template_ids, previous_peak_channels : numpy.ndarray
+        Template and peak channel of each unit in the earlier run (see the
+        pc_layout argument of calculate_metrics)
+
+    Outputs:
+    --------
+    units : numpy.ndarray
+        Sorted subset of cluster_ids
+
+    """
+
+    cluster_ids = np.asarray(cluster_ids)
+    changed = np.isin(cluster_ids, changed_cluster_ids)
+
+    for layout_template_ids, layout_peak_channels in ((template_ids, peak_channels), 
+                                                      (previous_template_ids, previous_peak_channels)):
+
+        neighbourhoods = {}
+        channel_index = ChannelIndex(pc_feature_ind, channel_pos, layout_template_ids)
+
+        for idx, cluster_id in enumerate(cluster_ids):
+
+            # a cluster missing from the layout is new, and so already changed
+            if changed[idx] or cluster_id >= len(layout_peak_channels):
+                continue
+
+            peak_channel = layout_peak_channels[cluster_id]
+
+            if peak_channel not in neighbourhoods:
+                units_for_channel, channels_to_use = pc_neighbourhood(peak_channel, layout_template_ids, layout_peak_channels, 
+                                                                      pc_feature_ind, channel_pos, max_radius_um,
+                                                                      channel_index)
+                neighbourhoods[peak_channel] = np.any(np.isin(units_for_channel, changed_cluster_ids))
+
+            changed[idx] = neighbourhoods[peak_channel]
+
+    return np.sort(cluster_ids[changed])
+
+
+def cluster_fingerprints(spike_times, spike_clusters, total_units = None, spike_index = None):
+
+    """ Order-independent 64-bit hash of the spikes in each cluster
+
+    Two runs give a cluster the same fingerprint if (and, up to hash 
+    collisions, only if) it holds the same spikes, so the fingerprints of 
+    an earlier run show which clusters were changed by curation.
+
+    Outputs:
+    --------
+    cluster_ids : numpy.ndarray
+        Clusters with at least one spike
+    fingerprints : numpy.ndarray (uint64)
+        One fingerprint per cluster in cluster_ids
+
+    """
+
+    if spike_index is None:
+        spike_index = SpikeIndex(spike_clusters, total_units)
+
+    # splitmix64 of each spike's position and time; wraparound is intended
+    with np.errstate(over='ignore'):
+        h = np.arange(len(spike_times), dtype='uint64') * np.uint64(0x9E3779B97F4A7C15)
+        h ^= np.asarray(spike_times, dtype='float64').view('uint64')
+        h ^= h >> np.uint64(30)
+        h *= np.uint64(0xBF58476D1CE4E5B9)
+        h ^= h >> np.uint64(27)
+        h *= np.uint64(0x94D049BB133111EB)
+        h ^= h >> np.uint64(31)
+
+        summed = np.zeros((h.size + 1,), dtype='uint64')
+        np.cumsum(h[spike_index.order], out = summed[1:])
+
+        bounds = spike_index.offsets
+        fingerprints = summed[bounds[1:]] - summed[bounds[:-1]]
+
+    return spike_index.cluster_ids, fingerprints[spike_index.cluster_ids]
+
+
+def changed_clusters(previous_ids, previous_fingerprints, cluster_ids, fingerprints):
+
+    """ Clusters that are new, gone, or hold different spikes than before """
+
+    previous = dict(zip(previous_ids.tolist(), previous_fingerprints.tolist()))
+    current = dict(zip(cluster_ids.tolist(), fingerprints.tolist()))
+
+    changed = [cluster_id for cluster_id in current if previous.get(cluster_id) != current[cluster_id]]
+    changed += [cluster_id for cluster_id in previous if cluster_id not in current]
+
+    return np.array(sorted(changed), dtype='int64')
+
+
+def pc_metrics_for_unit(cluster_id,
+                        spike_templates,
+                        template_ids,
+                        peak_channels,
+                        pc_features,
+                        pc_feature_ind,
+                        channel_pos,
+                        max_radius_um,
+                        max_spikes_for_cluster,
+                        max_spikes_for_nn,
+                        n_neighbors,
+                        spike_index,
+                        random_state = np.random,
+                        nn_mode = 'unit',
+                        nn_algorithm = 'ball_tree',
+                        nn_cache = None,
+                        channel_index = None):
+
+    """ PC-based metrics for one unit, compared against its neighbors
+
+    Inputs:
+    -------
+    cluster_id : Int
+        ID of the unit to compare against its neighbors
+    peak_channels : numpy.ndarray (num_units x 0)
+        Peak channel for every unit, from calculate_pc_metrics
+    spike_index : SpikeIndex
+        Cluster to spike index for all spikes in pc_features array
+    random_state : numpy.random.RandomState (or the numpy.random module)
+        Source of the random spike subsample for each unit
+    nn_mode : String
+        'unit' builds a nearest-neighbor graph for this unit's own sample;
+        'neighbourhood' reads hit/miss rates from one graph shared by all 
+        units with the same peak channel (see neighbourhood_nn_metrics)
+    nn_algorithm : String
+        Neighbor search backend (see nearest_neighbor_indices)
+    nn_cache : dict
+        Shared graphs from previous units, keyed by peak channel ('neighbourhood' mode)
+    channel_index : ChannelIndex
+        Units with PCs on each channel (see pc_neighbourhood)
+
+    Outputs:
+    --------
+    (isolation_distance, l_ratio, d_prime, nn_hit_rate, nn_miss_rate)
+
+    """
+
+    isolation_distance = np.nan
+    l_ratio = 0.0
+    d_prime = np.nan
+    nn_hit_rate = np.nan
+    nn_miss_rate = np.nan
         
-        if len(units_in_range) > 1 :
+    peak_channel = peak_channels[cluster_id]
 
-            units_for_channel = np.asarray(units_for_channel[units_in_range])
-                    
+    units_for_channel, channels_to_use = pc_neighbourhood(peak_channel, template_ids, peak_channels, pc_feature_ind, 
+                                                          channel_pos, max_radius_um, channel_index)
+    
+    # If there is at least one neighbor unit in range, compare pcs across 
+    # units for channels that overlap AND lie within maximum radius
     
-# OLDER calculatioon assuming linear array
-#           channels_to_use = np.arange(peak_channel - half_spread_down, peak_channel + half_spread_up + 1)
+    if len(units_for_channel) > 1 :
+
+        spike_counts = spike_index.counts[units_for_channel].astype('int')
             
-            channels_to_use = np.where(chan_dist < max_radius_um)[0]
+        this_unit_idx = np.where(units_for_channel == cluster_id)[0]
 
-    
-            spike_counts = np.zeros(units_for_channel.shape, dtype = 'int')
-    
-            for idx2, cluster_id2 in enumerate(units_for_channel):
-                spike_counts[idx2] = np.sum(spike_clusters == cluster_id2)
-                
-            this_unit_idx = np.where(units_for_channel == cluster_id)[0]
-    
-            # calculate how many spikes from this unit will be used
-            if spike_counts[this_unit_idx] > max_spikes_for_cluster:
-                relative_counts = spike_counts / spike_counts[this_unit_idx] * max_spikes_for_cluster
-            else:
-                relative_counts = spike_counts
+        # calculate how many spikes from this unit will be used
+        if spike_counts[this_unit_idx] > max_spikes_for_cluster:
+            relative_counts = spike_counts / spike_counts[this_unit_idx] * max_spikes_for_cluster
+        else:
+            relative_counts = spike_counts
+        
+        all_pcs = np.zeros((0, pc_features.shape[1], channels_to_use.size))     #dtype = default, double
+        all_labels = np.zeros((0,), dtype = 'int')
             
-            all_pcs = np.zeros((0, pc_features.shape[1], channels_to_use.size))     #dtype = default, double
-            all_labels = np.zeros((0,), dtype = 'int')
-                
-            for idx2, cluster_id2 in enumerate(units_for_channel):
-    
+        for idx2, cluster_id2 in enumerate(units_for_channel):
+
 # if any manual curation as been done, the cluster ids are no longer identical to the template ids
 # That means we can't use a universal channelmask. Rather, we have to check for each spike what
 # channels are there (recorded in pc_feature_ind) and take those that are included in 
@@ -418,49 +939,241 @@ def calculate_pc_metrics(spike_clusters,
 #                    
 #                    all_pcs = np.concatenate((all_pcs, pcs),0)
 #                    all_labels = np.concatenate((all_labels, labels),0)
-                
-                subsample = int(relative_counts[idx2]) # how many spikes to use from this unit
-                index_mask = make_index_mask(spike_clusters, cluster_id2, min_num = 0, max_num = subsample)
-                
-                pcs = get_unit_pcs(pc_features, index_mask, spike_templates, channels_to_use, pc_feature_ind)
-                labels = np.ones((pcs.shape[0],), dtype = 'int') * cluster_id2
-
-                all_pcs = np.concatenate((all_pcs, pcs),0)
-                all_labels = np.concatenate((all_labels, labels),0) 
-                
-            all_pcs = np.reshape(all_pcs, (all_pcs.shape[0], pc_features.shape[1]*channels_to_use.size))
             
-            num_pcs = all_pcs.shape[0];
-#            num_pcs_str = 'cluster_id: ' + repr(cluster_id) + '; num pcs: ' + repr(num_pcs)
-#            print(num_pcs_str)
+            subsample = int(relative_counts[idx2]) # how many spikes to use from this unit
+            index_mask = make_index_subset(spike_index, cluster_id2, min_num = 0, max_num = subsample, random_state = random_state)
             
-            pcs_for_this_unit = all_pcs[all_labels == cluster_id,:].shape[0]   
-            pcs_for_other_units = all_pcs[all_labels != cluster_id, :].shape[0]
-        
-        else:
-            # no near neighbor units to compare
-            num_pcs = 0
-            pcs_for_this_unit = 0
-            pcs_for_other_units = 0
+            pcs = get_unit_pcs(pc_features, index_mask, spike_templates, channels_to_use, pc_feature_ind)
+            labels = np.ones((pcs.shape[0],), dtype = 'int') * cluster_id2
+
+            all_pcs = np.concatenate((all_pcs, pcs),0)
+            all_labels = np.concatenate((all_labels, labels),0) 
+            
+        all_pcs = np.reshape(all_pcs, (all_pcs.shape[0], pc_features.shape[1]*channels_to_use.size))
         
+        num_pcs = all_pcs.shape[0];
+#            num_pcs_str = 'cluster_id: ' + repr(cluster_id) + '; num pcs: ' + repr(num_pcs)
+#            print(num_pcs_str)
         
-        if num_pcs > 10 and pcs_for_this_unit > 5 and pcs_for_other_units > 5 :
+        pcs_for_this_unit = all_pcs[all_labels == cluster_id,:].shape[0]   
+        pcs_for_other_units = all_pcs[all_labels != cluster_id, :].shape[0]
+    
+    else:
+        # no near neighbor units to compare
+        num_pcs = 0
+        pcs_for_this_unit = 0
+        pcs_for_other_units = 0
+    
+    
+    if num_pcs > 10 and pcs_for_this_unit > 5 and pcs_for_other_units > 5 :
 
-            isolation_distances[cluster_id], l_ratios[cluster_id] = mahalanobis_metrics(all_pcs, all_labels, cluster_id)
+        isolation_distance, l_ratio = mahalanobis_metrics(all_pcs, all_labels, cluster_id)
 
-            d_primes[cluster_id] = lda_metrics(all_pcs, all_labels, cluster_id)
+        d_prime = lda_metrics(all_pcs, all_labels, cluster_id)
 
-            nn_hit_rates[cluster_id], nn_miss_rates[cluster_id] = nearest_neighbors_metrics(all_pcs, all_labels, cluster_id, max_spikes_for_nn, n_neighbors)
+        if nn_mode == 'neighbourhood':
+
+            if nn_cache is None:
+                nn_cache = {}
+
+            if peak_channel not in nn_cache:
+                nn_cache[peak_channel] = neighbourhood_nn_metrics(units_for_channel, channels_to_use, spike_templates, 
+                                                                  pc_features, pc_feature_ind, spike_index, 
+                                                                  max_spikes_for_cluster, max_spikes_for_nn, 
+                                                                  n_neighbors, nn_algorithm)
+
+            nn_hit_rate, nn_miss_rate = nn_cache[peak_channel].get(cluster_id, (np.nan, np.nan))
 
         else:
 
-            isolation_distances[cluster_id] = np.nan
-            d_primes[cluster_id] = np.nan
-            nn_hit_rates[cluster_id] = np.nan
-            nn_miss_rates[cluster_id] = np.nan
+            nn_hit_rate, nn_miss_rate = nearest_neighbors_metrics(all_pcs, all_labels, cluster_id, max_spikes_for_nn, n_neighbors, nn_algorithm)
 
+    return isolation_distance, l_ratio, d_prime, nn_hit_rate, nn_miss_rate
 
-    return isolation_distances, l_ratios, d_primes, nn_hit_rates, nn_miss_rates 
+
+def pc_neighbourhood(peak_channel, template_ids, peak_channels, pc_feature_ind, channel_pos, max_radius_um, channel_index = None):
+
+    """ Units and channels to compare for a unit with this peak channel
+
+    Inputs:
+    -------
+    channel_index : ChannelIndex (optional)
+        Index of the units on each channel for these template_ids, built once 
+        per call of calculate_pc_metrics; built here if not given
+
+    Outputs:
+    --------
+    units_for_channel : numpy.ndarray
+        Units with PCs on peak_channel whose own peak channel lies within 
+        max_radius_um (fewer than two means there is no neighbor to compare)
+    channels_to_use : numpy.ndarray
+        Channels within max_radius_um of peak_channel
+
+    """
+
+    if channel_index is None:
+        channel_index = ChannelIndex(pc_feature_ind, channel_pos, template_ids)
+
+    # distances from all channels to peak channel
+    chan_dist = channel_index.distances[peak_channel]
+
+    # which units have templates with pcs on the peak channel of the current unit?
+    units_for_channel = channel_index.units_for(peak_channel)
+
+    # of those units that have pc overlap, which have their peak channel 
+    # within range of the current unit?              
+    units_for_channel = units_for_channel[chan_dist[peak_channels[units_for_channel]] < max_radius_um]
+
+    channels_to_use = channel_index.channels_within(peak_channel, max_radius_um)
+
+    return units_for_channel, channels_to_use
+
+
+def unit_random_state(seed, cluster_id):
+
+    """ Random state for one unit's spike subsample
+
+    Seeding from (seed, cluster_id) makes each unit's subsample independent 
+    of the order in which units are processed, so serial and parallel runs 
+    give identical results. With no seed, the global numpy random state is 
+    used (the original behavior).
+
+    """
+
+    if seed is None:
+        return np.random
+
+    return np.random.RandomState([int(seed), int(cluster_id)])
+
+
+# state attached once per worker process by _init_pc_metrics_worker
+_pc_worker = {}
+
+def _init_pc_metrics_worker(shared_specs, unit_args):
+
+    arrays = {}
+    handles = []
+
+    for key, spec in shared_specs.items():
+        shm, arrays[key] = attach_shared_array(spec)
+        handles.append(shm)
+
+    counts, total_units = unit_args['index_counts'], unit_args['total_units']
+
+    _pc_worker['handles'] = handles
+    _pc_worker['arrays'] = arrays
+    _pc_worker['spike_index'] = SpikeIndex.from_arrays(arrays['order'], counts, total_units)
+    _pc_worker['args'] = unit_args
+    _pc_worker['nn_cache'] = {}
+
+
+def _pc_metrics_worker(cluster_id):
+
+    arrays = _pc_worker['arrays']
+    args = _pc_worker['args']
+
+    return pc_metrics_for_unit(cluster_id,
+                               arrays['spike_templates'],
+                               args['template_ids'],
+                               args['peak_channels'],
+                               arrays['pc_features'],
+                               args['pc_feature_ind'],
+                               args['channel_pos'],
+                               args['max_radius_um'],
+                               args['max_spikes_for_cluster'],
+                               args['max_spikes_for_nn'],
+                               args['n_neighbors'],
+                               _pc_worker['spike_index'],
+                               unit_random_state(args['seed'], cluster_id),
+                               args['nn_mode'],
+                               args['nn_algorithm'],
+                               _pc_worker['nn_cache'],
+                               args['channel_index'])
+
+
+def calculate_pc_metrics_parallel(spike_templates,
+                                  cluster_ids,
+                                  template_ids,
+                                  peak_channels,
+                                  pc_features,
+                                  pc_feature_ind,
+                                  channel_pos,
+                                  max_radius_um,
+                                  max_spikes_for_cluster,
+                                  max_spikes_for_nn,
+                                  n_neighbors,
+                                  spike_index,
+                                  num_workers,
+                                  seed,
+                                  nn_mode = 'unit',
+                                  nn_algorithm = 'ball_tree',
+                                  channel_index = None):
+
+    """ Runs pc_metrics_for_unit for each unit in a pool of worker processes
+
+    pc_features, spike_templates and the spike index order are copied once 
+    into shared memory; the workers attach to those blocks instead of 
+    receiving pickled copies. A memory-mapped pc_features is not copied; 
+    the workers re-open the file. Each unit draws its subsample from 
+    unit_random_state(seed, cluster_id), so the results are identical to 
+    the serial path with the same seed.
+
+    Outputs:
+    --------
+    unit_metrics : list of (isolation_distance, l_ratio, d_prime, nn_hit_rate, nn_miss_rate)
+        One entry per cluster in cluster_ids
+
+    """
+
+    shared_arrays = {'pc_features' : pc_features,
+                     'spike_templates' : spike_templates,
+                     'order' : spike_index.order}
+
+    unit_args = {'template_ids' : template_ids,
+                 'peak_channels' : peak_channels,
+                 'pc_feature_ind' : pc_feature_ind,
+                 'channel_pos' : channel_pos,
+                 'max_radius_um' : max_radius_um,
+                 'max_spikes_for_cluster' : max_spikes_for_cluster,
+                 'max_spikes_for_nn' : max_spikes_for_nn,
+                 'n_neighbors' : n_neighbors,
+                 'index_counts' : spike_index.counts,
+                 'total_units' : spike_index.total_units,
+                 'seed' : seed,
+                 'nn_mode' : nn_mode,
+                 'nn_algorithm' : nn_algorithm,
+                 'channel_index' : channel_index}
+
+    handles = []
+    shared_specs = {}
+
+    try:
+        for key, array in shared_arrays.items():
+            shm, shared_specs[key] = share_array(array)
+            handles.append(shm)
+
+        num_workers = int(np.min([num_workers, multiprocessing.cpu_count(), len(cluster_ids)]))
+
+        # units that share a peak channel are sent together, so that in 
+        # 'neighbourhood' mode they usually reuse one worker's cached graph
+        order = np.argsort(peak_channels[cluster_ids], kind = 'stable')
+        unit_metrics = [None] * len(cluster_ids)
+
+        with multiprocessing.Pool(num_workers, 
+                                  initializer = _init_pc_metrics_worker, 
+                                  initargs = (shared_specs, unit_args)) as pool:
+
+            for idx, result in enumerate(pool.imap(_pc_metrics_worker, np.asarray(cluster_ids)[order])):
+                printProgressBar(idx + 1, len(cluster_ids))
+                unit_metrics[order[idx]] = result
+
+    finally:
+        for shm in handles:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+
+    return unit_metrics
 
 
 def calculate_silhouette_score(spike_clusters,
@@ -472,53 +1185,91 @@ def calculate_silhouette_score(spike_clusters,
     
     # total_spikes = number of spikes to sample, given in the metrics params
 
-    random_spike_inds = np.random.permutation(spike_clusters.size)
-    random_spike_inds = random_spike_inds[:total_spikes]
-    num_pc_features = pc_features.shape[1]
+    random_spike_inds = np.random.permutation(spike_clusters.size)
+    random_spike_inds = random_spike_inds[:total_spikes]
+
+    # pcs for each sampled spike, in the columns of the channels they were computed on:
+    # number of spikes X (number of channels x number of pc features)
+    all_pcs = scatter_pcs_to_channels(pc_features, spike_templates, pc_feature_ind, random_spike_inds)
+
+    cluster_labels = spike_clusters[random_spike_inds]
+
+    cluster_ids, label_index, label_counts = np.unique(cluster_labels, return_inverse = True, return_counts = True)
+
+    SS = np.empty((total_units, total_units))
+    SS[:] = np.nan
+
+    # silhouette score for every pair of units (i < j) with more than two spikes between them
+    pair_scores = pairwise_silhouette_scores(all_pcs, label_index, label_counts)
+
+    idx1, idx2 = np.triu_indices(cluster_ids.size, 1)
+    has_spikes = label_counts[idx1] + label_counts[idx2] > 2
+
+    SS[cluster_ids[idx1[has_spikes]], cluster_ids[idx2[has_spikes]]] = pair_scores[idx1[has_spikes], idx2[has_spikes]]
+
+    with warnings.catch_warnings():
+      warnings.simplefilter("ignore")
+      a = np.nanmin(SS, 0)
+      b = np.nanmin(SS, 1)
+
+    return np.array([np.nanmin([a,b]) for a, b in zip(a,b)])
+
+
+def pairwise_silhouette_scores(X, labels, counts):
+
+    """ Silhouette score of every pair of clusters, from one distance computation
+
+    Equivalent to calling sklearn's silhouette_score on the samples of each 
+    pair of clusters, but the pairwise distances are computed only once 
+    (blockwise, with pairwise_distances_chunked) and reduced to the sum of 
+    distances from each sample to each cluster. Within a pair (i, j), a 
+    sample in i has a = mean distance to the rest of i and b = mean distance 
+    to j; as in sklearn, samples with a = b = 0 or in a cluster of size 1 
+    score 0.
+
+    Inputs:
+    -------
+    X : numpy.ndarray (num_samples x num_features)
+        Features for each sample
+    labels : numpy.ndarray (num_samples x 0)
+        Cluster index (0 to num_clusters - 1) for each sample
+    counts : numpy.ndarray (num_clusters x 0)
+        Number of samples in each cluster; every cluster must be non-empty
+
+    Outputs:
+    --------
+    pair_scores : numpy.ndarray (num_clusters x num_clusters)
+        Silhouette score for each pair of clusters (the diagonal is meaningless)
 
-    # initialize array to hold pcs: number of spikes X number of channeles x number of pc features
-    all_pcs = np.zeros((total_spikes, np.max(pc_feature_ind) * num_pc_features + 1))
+    """
 
-    for idx, i in enumerate(random_spike_inds):
-        
-        # unit_id = spike_clusters[i]
-        
-        # look up channel using the template id for this spike
-        template_id = spike_templates[i]       
-        channels = pc_feature_ind[template_id,:]
-        
-        # fill pcs into the correct channels for this spike
-        for j in range(0,num_pc_features):
-            all_pcs[idx, channels + np.max(pc_feature_ind) * j] = pc_features[i,j,:]
+    order = np.argsort(labels, kind = 'stable')
+    X = X[order, :]
+    labels = labels[order]
 
-    cluster_labels = spike_clusters[random_spike_inds]
+    starts = np.zeros((counts.size,), dtype = 'int64')
+    starts[1:] = np.cumsum(counts)[:-1]
 
-    cluster_ids = np.unique(cluster_labels)
+    # sum of distances from each sample to all samples in each cluster
+    def reduce_func(D_chunk, start):
+        return np.add.reduceat(D_chunk, starts, axis = 1)
 
-    SS = np.empty((total_units, total_units))
-    SS[:] = np.nan
+    cluster_dist_sums = np.concatenate(list(pairwise_distances_chunked(X, reduce_func = reduce_func)), 0)
 
-    for idx1, i in enumerate(cluster_ids):
+    own_counts = counts[labels]
 
-        printProgressBar(idx1+1, len(cluster_ids))
-        
-        for idx2, j in enumerate(cluster_ids):
-            
-            if j > i:
-                # positions of cluster labels = i or j
-                inds = np.in1d(cluster_labels, np.array([i,j]))
-                X = all_pcs[inds,:]
-                labels = cluster_labels[inds]
-                
-                if len(labels) > 2:
-                    SS[i,j] = silhouette_score(X, labels)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        a = cluster_dist_sums[np.arange(labels.size), labels] / (own_counts - 1)
+        b = cluster_dist_sums / counts[np.newaxis, :]
+        sil_samples = (b - a[:, np.newaxis]) / np.maximum(a[:, np.newaxis], b)
 
-    with warnings.catch_warnings():
-      warnings.simplefilter("ignore")
-      a = np.nanmin(SS, 0)
-      b = np.nanmin(SS, 1)
+    sil_samples = np.nan_to_num(sil_samples)
+    sil_samples[own_counts == 1, :] = 0
 
-    return np.array([np.nanmin([a,b]) for a, b in zip(a,b)])
+    # sil_sums[i, j] = sum of silhouettes of the samples in i, relative to j
+    sil_sums = np.add.reduceat(sil_samples, starts, axis = 0)
+
+    return (sil_sums + sil_sums.T) / (counts[:, np.newaxis] + counts[np.newaxis, :])
 
 
 def calculate_drift_metrics(spike_times,
@@ -530,7 +1281,27 @@ def calculate_drift_metrics(spike_times,
                             pc_feature_ind,
                             channel_pos,
                             interval_length,
-                            min_spikes_per_interval):
+                            min_spikes_per_interval,
+                            return_median_depths = False):
+
+    """ Maximum and cumulative drift of each unit's median depth over time
+
+    Spikes are grouped by (cluster, interval) in one sort, and the median depth
+    of each group is read from the sorted depths. A spike is counted in an
+    interval if start < t < start + interval_length, where the starts are 
+    np.arange(min(spike_times), max(spike_times), interval_length).
+
+    Outputs:
+    --------
+    max_drift : numpy.ndarray (num_units x 0)
+    cumulative_drift : numpy.ndarray (num_units x 0)
+    median_depths : numpy.ndarray (num_units x num_intervals)
+        Median depth of each unit in each interval (NaN if fewer than 
+        min_spikes_per_interval spikes); only if return_median_depths is True
+    interval_starts : numpy.ndarray (num_intervals x 0)
+        Start time of each interval; only if return_median_depths is True
+
+    """
 
     max_drift = np.zeros((total_units,))
     cumulative_drift = np.zeros((total_units,))
@@ -560,7 +1331,8 @@ def calculate_drift_metrics(spike_times,
     
     # same for pc_features, but we only need the first pc for each
     # this operation makes a copy of pc_features so original is not altered
-    m_pc_features_sq = np.squeeze(pc_features[match_maj,0,:]);
+    # (read in bounded blocks, so a memory-mapped pc_features is never loaded whole)
+    m_pc_features_sq = np.squeeze(gather_rows(pc_features[:,0,:], match_maj));
     # set negative pc_features to zero before taking square
     m_pc_features_sq[m_pc_features_sq < 0] = 0
     # elementwise square
@@ -576,33 +1348,71 @@ def calculate_drift_metrics(spike_times,
     interval_starts = np.arange(np.min(spike_times), np.max(spike_times), interval_length)
     interval_ends = interval_starts + interval_length
 
+    median_depths = grouped_median_depths(m_spike_times, m_spike_clusters, depths, total_units, 
+                                          interval_starts, interval_ends, min_spikes_per_interval)
+
     cluster_ids = np.unique(m_spike_clusters)
 
-    for idx, cluster_id in enumerate(cluster_ids):
+    with warnings.catch_warnings():
+        # units with no interval above min_spikes_per_interval get NaN drift
+        warnings.simplefilter("ignore", category = RuntimeWarning)
+        unit_depths = median_depths[cluster_ids, :]
+        max_drift[cluster_ids] = np.around(np.nanmax(unit_depths, 1) - np.nanmin(unit_depths, 1), 2)
 
-        printProgressBar(idx+1, len(cluster_ids))
+    cumulative_drift[cluster_ids] = np.around(np.nansum(np.abs(np.diff(unit_depths, axis = 1)), 1), 2)
 
-        in_cluster = m_spike_clusters == cluster_id
-        times_for_cluster = m_spike_times[in_cluster]
-        depths_for_cluster = depths[in_cluster]
+    if return_median_depths:
+        return max_drift, cumulative_drift, median_depths, interval_starts
 
-        median_depths = []
+    return max_drift, cumulative_drift
 
-        for t1, t2 in zip(interval_starts, interval_ends):
 
-            in_range = (times_for_cluster > t1) * (times_for_cluster < t2)
-            
-            if np.sum(in_range) >= min_spikes_per_interval:
-                median_depths.append(np.median(depths_for_cluster[in_range]))
-            else:
-                median_depths.append(np.nan)
-            
-        median_depths = np.array(median_depths)
-            
-        max_drift[cluster_id] = np.around(np.nanmax(median_depths) - np.nanmin(median_depths),2)
-        cumulative_drift[cluster_id] = np.around(np.nansum(np.abs(np.diff(median_depths))),2)
+def grouped_median_depths(spike_times, spike_clusters, depths, total_units, 
+                          interval_starts, interval_ends, min_spikes_per_interval):
 
-    return max_drift, cumulative_drift
+    """ Median depth of every unit in every time interval, in one pass
+
+    Each spike is assigned to the interval whose start it follows (keeping
+    only start < t < end), the spikes are sorted by (unit, interval, depth),
+    and each group's median is taken from the middle of its sorted block.
+
+    Outputs:
+    --------
+    median_depths : numpy.ndarray (total_units x num_intervals)
+        NaN where a unit has fewer than min_spikes_per_interval spikes in an
+        interval, or where any of its depths in that interval is NaN
+
+    """
+
+    num_intervals = interval_starts.size
+
+    interval = np.searchsorted(interval_starts, spike_times, side = 'right') - 1
+    valid = interval >= 0
+    valid[valid] = (spike_times[valid] > interval_starts[interval[valid]]) * \
+                   (spike_times[valid] < interval_ends[interval[valid]])
+
+    groups = spike_clusters[valid].astype('int64') * num_intervals + interval[valid]
+    group_depths = depths[valid]
+
+    num_groups = total_units * num_intervals
+    counts = np.bincount(groups, minlength = num_groups)
+    has_nan = np.bincount(groups, weights = np.isnan(group_depths), minlength = num_groups) > 0
+
+    order = np.lexsort((group_depths, groups))
+    sorted_depths = group_depths[order]
+
+    group_starts = np.zeros((num_groups,), dtype = 'int64')
+    group_starts[1:] = np.cumsum(counts)[:-1]
+
+    median_depths = np.empty((num_groups,))
+    median_depths[:] = np.nan
+
+    use = (counts >= max(min_spikes_per_interval, 1)) * np.invert(has_nan)
+    lower = group_starts[use] + (counts[use] - 1) // 2
+    upper = group_starts[use] + counts[use] // 2
+    median_depths[use] = (sorted_depths[lower] + sorted_depths[upper]) / 2
+
+    return np.reshape(median_depths, (total_units, num_intervals))
 
 
 # ==========================================================
@@ -736,6 +1546,13 @@ def amplitude_cutoff(amplitudes, num_histogram_bins = 500, histogram_smoothing_v
 
 
     h,b = np.histogram(amplitudes, num_histogram_bins, density=True)
+
+    return amplitude_cutoff_from_histogram(h, b, histogram_smoothing_value)
+
+
+def amplitude_cutoff_from_histogram(h, b, histogram_smoothing_value = 3):
+
+    """ amplitude_cutoff for an amplitude histogram (density h, bin edges b) """
     
     pdf = gaussian_filter1d(h,histogram_smoothing_value)
     support = b[:-1]
@@ -751,12 +1568,114 @@ def amplitude_cutoff(amplitudes, num_histogram_bins = 500, histogram_smoothing_v
     return fraction_missing
 
 
+def amplitude_cutoffs_from_histograms(h, b, histogram_smoothing_value = 3):
+
+    """ amplitude_cutoff_from_histogram for many histograms at once
+
+    Inputs:
+    -------
+    h : numpy.ndarray (num_units x num_bins)
+        Amplitude density of each unit
+    b : numpy.ndarray (num_units x num_bins + 1)
+        Bin edges of each unit
+
+    Outputs:
+    --------
+    fraction_missing : numpy.ndarray (num_units x 0)
+
+    """
+
+    pdf = gaussian_filter1d(h, histogram_smoothing_value, axis = 1)
+    support = b[:, :-1]
+
+    # first bin after the peak where the pdf comes closest to its value in the first bin
+    peak_index = np.argmax(pdf, 1)
+    distance = np.abs(pdf - pdf[:, :1])
+    distance[np.arange(pdf.shape[1])[np.newaxis, :] < peak_index[:, np.newaxis]] = np.inf
+    G = np.argmin(distance, 1)
+
+    bin_size = np.mean(np.diff(support, axis = 1), 1)
+
+    # sum of pdf[G:] for each unit; units with the same G are summed together,
+    # so that each sum is taken over exactly the same values as in amplitude_cutoff
+    tail = np.zeros((pdf.shape[0],))
+    for g in np.unique(G):
+        units = np.where(G == g)[0]
+        tail[units] = np.sum(pdf[units, g:], 1)
+
+    return np.minimum(tail * bin_size, 0.5)
+
+
+def unit_histogram_edges(first_edge, last_edge, num_bins):
+
+    """ np.histogram's bin edges for each unit's range of values
+
+    Inputs:
+    -------
+    first_edge, last_edge : numpy.ndarray (num_units x 0)
+        Smallest and largest value of each unit (non-finite for units 
+        without values)
+    num_bins : Int
+
+    Outputs:
+    --------
+    edges : numpy.ndarray (num_units x num_bins + 1)
+        Same type as first_edge
+
+    """
+
+    first_edge = first_edge.copy()
+    last_edge = last_edge.copy()
+
+    # np.histogram expands an empty range (and unused units get a dummy range)
+    unused = np.invert(np.isfinite(first_edge))
+    first_edge[unused] = 0
+    last_edge[unused] = 0
+    empty = first_edge == last_edge
+    first_edge[empty] = first_edge[empty] - 0.5
+    last_edge[empty] = last_edge[empty] + 0.5
+
+    # np.linspace of scalars steps in float64 whatever the output type
+    return np.linspace(first_edge.astype('float64'), last_edge.astype('float64'), num_bins + 1,
+                       axis = 1).astype(first_edge.dtype)
+
+
+def unit_histogram_bins(values, clusters, edges):
+
+    """ Bin of each value in its unit's histogram, as assigned by np.histogram """
+
+    num_bins = edges.shape[1] - 1
+
+    first = edges[clusters, 0]
+    values = values.astype(edges.dtype, copy = False)
+
+    f_indices = (values - first) / (edges[clusters, -1] - first) * num_bins
+    indices = f_indices.astype(np.intp)
+    indices[indices == num_bins] -= 1
+
+    decrement = values < edges[clusters, indices]
+    indices[decrement] -= 1
+    increment = (values >= edges[clusters, indices + 1]) & (indices != num_bins - 1)
+    indices[increment] += 1
+
+    return indices
+
+
 def mahalanobis_metrics(all_pcs, all_labels, this_unit_id):
 
     """ Calculates isolation distance and L-ratio (metrics computed from Mahalanobis distance)
 
     Based on metrics described in Schmitzer-Torbert et al. (2005) Neurosci 131: 1-11
 
+    Squared distances are computed from a Cholesky factor of this unit's 
+    covariance, with one matrix product for all other spikes (no inverse of
+    the covariance itself). Features that are constant for this unit (e.g.
+    zero-filled channels at the edge of the probe) are left out, and the 
+    degrees of freedom reduced to match. If the covariance of the remaining
+    features is still near-singular (collinear features, or no more spikes 
+    than features), it is replaced by its Ledoit-Wolf shrinkage estimate. 
+    The metrics are NaN only if all spikes of this unit are identical.
+
     Inputs:
     -------
     all_pcs : numpy.ndarray (num_spikes x PCs)
@@ -779,16 +1698,46 @@ def mahalanobis_metrics(all_pcs, all_labels, this_unit_id):
      
     pcs_for_other_units = all_pcs[all_labels != this_unit_id, :]   
     
-    mean_value = np.expand_dims(np.mean(pcs_for_this_unit,0),0)
-    
-    try:
-        VI = np.linalg.inv(np.cov(pcs_for_this_unit.T))
-    except np.linalg.linalg.LinAlgError: # case of singular matrix
+    # relative to each feature's spread over all spikes
+    varying = np.var(pcs_for_this_unit, 0) > 1e-10 * np.var(all_pcs, 0)
+
+    if not np.any(varying): # all spikes are identical (or there is only one)
         return np.nan, np.nan
 
-    mahalanobis_other = np.sort(cdist(mean_value,
-                       pcs_for_other_units,
-                       'mahalanobis', VI = VI)[0])
+    if not np.all(varying):
+        pcs_for_this_unit = pcs_for_this_unit[:, varying]
+        pcs_for_other_units = pcs_for_other_units[:, varying]
+
+    mean_value = np.mean(pcs_for_this_unit,0)
+    
+    num_spikes, num_features = pcs_for_this_unit.shape
+
+    L = None
+
+    if num_spikes > num_features:
+        cov = np.atleast_2d(np.cov(pcs_for_this_unit.T))
+        try:
+            L = cholesky(cov, lower = True, check_finite = False)
+        except LinAlgError:
+            pass
+        else:
+            # a pivot that is tiny next to its feature's variance means near-collinear features
+            if np.min(np.square(np.diag(L)) / np.diag(cov)) < 1e-10:
+                L = None
+
+    if L is None: # case of singular matrix
+        cov = np.atleast_2d(ledoit_wolf(pcs_for_this_unit)[0])
+        try:
+            L = cholesky(cov, lower = True, check_finite = False)
+        except LinAlgError:
+            # too few spikes to estimate the shrinkage; use its target, the mean variance
+            L = np.sqrt(np.trace(cov) / num_features) * np.eye(num_features)
+
+    # squared Mahalanobis distance |L^-1 (x - mean)|^2 for all other spikes,
+    # with the small triangular inverse applied in a single matrix product
+    L_inv = solve_triangular(L, np.eye(L.shape[0]), lower = True, check_finite = False)
+    z = np.dot(pcs_for_other_units - mean_value, L_inv.T)
+    mahalanobis_other_sq = np.einsum('ij,ij->i', z, z)
     
 
     
@@ -800,10 +1749,11 @@ def mahalanobis_metrics(all_pcs, all_labels, this_unit_id):
 
     if n >= 2:
         
-        dof = pcs_for_this_unit.shape[1] # number of features
+        dof = num_features # number of (varying) features
         
-        l_ratio = np.sum(1 - chi2.cdf(pow(mahalanobis_other,2), dof)) / mahalanobis_other.shape[0]
-        isolation_distance = pow(mahalanobis_other[n-1],2)
+        l_ratio = np.sum(chi2.sf(mahalanobis_other_sq, dof)) / mahalanobis_other_sq.shape[0]
+        # n-th smallest squared distance
+        isolation_distance = np.partition(mahalanobis_other_sq, n-1)[n-1]
 
     else:
         l_ratio = np.nan 
@@ -856,7 +1806,7 @@ def lda_metrics(all_pcs, all_labels, this_unit_id):
 
 
 
-def nearest_neighbors_metrics(all_pcs, all_labels, this_unit_id, max_spikes_for_nn, n_neighbors):
+def nearest_neighbors_metrics(all_pcs, all_labels, this_unit_id, max_spikes_for_nn, n_neighbors, algorithm = 'ball_tree'):
 
     """ Calculates unit contamination based on NearestNeighbors search in PCA space
 
@@ -874,6 +1824,8 @@ def nearest_neighbors_metrics(all_pcs, all_labels, this_unit_id, max_spikes_for_
         number of spikes to use (calculation can be very slow when this number is >20000)
     n_neighbors : Int
         number of neighbors to use
+    algorithm : String
+        neighbor search backend (see nearest_neighbor_indices)
 
     Outputs:
     --------
@@ -898,8 +1850,7 @@ def nearest_neighbors_metrics(all_pcs, all_labels, this_unit_id, max_spikes_for_
         n = int(n * ratio)
         
 
-    nbrs = NearestNeighbors(n_neighbors=n_neighbors, algorithm='ball_tree').fit(X)
-    distances, indices = nbrs.kneighbors(X)   
+    indices = nearest_neighbor_indices(X, n_neighbors, algorithm)
     
     this_cluster_inds = np.arange(n)
     
@@ -911,6 +1862,107 @@ def nearest_neighbors_metrics(all_pcs, all_labels, this_unit_id, max_spikes_for_
     
     return hit_rate, miss_rate
 
+def neighbourhood_nn_metrics(units_for_channel, channels_to_use, spike_templates, pc_features, pc_feature_ind, 
+                             spike_index, max_spikes_for_cluster, max_spikes_for_nn, n_neighbors, algorithm = 'ball_tree'):
+
+    """ Nearest-neighbor hit and miss rates for all units in one channel neighbourhood
+
+    Builds a single kNN graph for the spikes of every unit in the neighbourhood
+    and reads each unit's rates from it, instead of one graph per unit. Each 
+    unit contributes up to max_spikes_for_cluster spikes, evenly spaced in time
+    (so the sample does not depend on which unit asked for it), and the 
+    combined sample is thinned to max_spikes_for_nn as in nearest_neighbors_metrics.
+
+    Rates differ slightly from the per-unit graphs, whose samples are scaled
+    to the size of the unit being measured.
+
+    Outputs:
+    --------
+    rates : dict
+        (hit_rate, miss_rate) for each unit in the neighbourhood
+
+    """
+
+    all_pcs = []
+    all_labels = []
+
+    for unit_id in units_for_channel:
+
+        inds = spike_index.spikes_for(unit_id)
+
+        if inds.size > max_spikes_for_cluster:
+            inds = inds[np.linspace(0, inds.size - 1, max_spikes_for_cluster).astype('int')]
+
+        pcs = get_unit_pcs(pc_features, inds, spike_templates, channels_to_use, pc_feature_ind)
+        all_pcs.append(np.reshape(pcs, (pcs.shape[0], -1)))
+        all_labels.append(np.ones((pcs.shape[0],), dtype = 'int') * unit_id)
+
+    X = np.concatenate(all_pcs, 0)
+    labels = np.concatenate(all_labels, 0)
+
+    ratio = max_spikes_for_nn / X.shape[0]
+
+    if ratio < 1:
+        inds = np.arange(0, X.shape[0]-1, 1/ratio).astype('int')
+        X = X[inds,:]
+        labels = labels[inds]
+
+    rates = {}
+
+    if X.shape[0] <= n_neighbors:
+        return rates
+
+    neighbor_labels = labels[nearest_neighbor_indices(X, n_neighbors, algorithm)[:,1:]]
+
+    for unit_id in np.unique(labels):
+
+        this_unit = labels == unit_id
+
+        if np.all(this_unit):
+            continue
+
+        rates[unit_id] = (np.mean(neighbor_labels[this_unit,:] == unit_id), 
+                          np.mean(neighbor_labels[np.invert(this_unit),:] == unit_id))
+
+    return rates
+
+
+def nearest_neighbor_indices(X, n_neighbors, algorithm = 'ball_tree'):
+
+    """ Indices of the n_neighbors nearest samples to each sample (itself first)
+
+    Backends:
+        'ball_tree', 'kd_tree', 'brute', 'auto' : exact search with 
+            sklearn.neighbors.NearestNeighbors; all give the same neighbors 
+            (up to ties). kd_tree is usually fastest for the ~20-60 dimensional
+            PC spaces used here; brute is faster for small samples.
+        'approximate' : NN-descent graph from the optional pynndescent package.
+            Much faster for large samples, but some neighbors are missed 
+            (typically >95% recall), which biases hit rates slightly down.
+            Falls back to kd_tree if pynndescent is not installed.
+
+    Output:
+    -------
+    indices : numpy.ndarray (num_samples x n_neighbors)
+
+    """
+
+    if algorithm == 'approximate':
+
+        try:
+            from pynndescent import NNDescent
+        except ModuleNotFoundError:
+            print('pynndescent not available; using exact kd_tree search')
+            algorithm = 'kd_tree'
+        else:
+            indices, distances = NNDescent(X, n_neighbors = n_neighbors, random_state = 0).neighbor_graph
+            return indices
+
+    nbrs = NearestNeighbors(n_neighbors = n_neighbors, algorithm = algorithm).fit(X)
+    distances, indices = nbrs.kneighbors(X)
+
+    return indices
+
 # ==========================================================
 
 # HELPER FUNCTIONS:
@@ -953,6 +2005,43 @@ def make_index_mask(spike_clusters, unit_id, min_num, max_num):
     return index_mask
 
 
+def make_index_subset(spike_index, unit_id, min_num, max_num, random_state = np.random):
+
+    """ Same selection as make_index_mask, returned as sorted spike indices
+
+    Uses a SpikeIndex to find the spikes for this unit without scanning the 
+    full spike array.
+
+    Inputs:
+    -------
+    spike_index : SpikeIndex
+        Cluster to spike index for all spikes in pc_features array
+    unit_id : Int
+        ID for this unit
+    min_num : Int
+        Minimum number of spikes to return; if there are not enough spikes for this unit, return none
+    max_num : Int
+        Maximum number of spikes to return; if too many spikes for this unit, return a random subsample
+    random_state : numpy.random.RandomState (or the numpy.random module)
+        Source of the random subsample
+
+    Output:
+    -------
+    spike_inds : numpy.ndarray (int)
+        Indices of selected spikes in pc_features array, in ascending order
+
+    """
+
+    inds = spike_index.spikes_for(unit_id)
+
+    if len(inds) < min_num:
+        return np.zeros((0,), dtype = inds.dtype)
+
+    order = random_state.permutation(inds.size)
+
+    return np.sort(inds[order[:max_num]])
+
+
 def make_channel_mask(unit_id, pc_feature_ind, channels_to_use):
 
     """ Create a mask for the channel dimension of the pc_features array  
@@ -1014,10 +2103,14 @@ def get_unit_pcs(these_pc_features, index_mask, spike_templates, channels_to_use
     -------
     these_pc_features : numpy.ndarray (float)
         Array of pre-computed PC features (num_spikes x num_PCs x num_channels)
-    index_mask : numpy.ndarray (boolean)
-        Mask for spike index dimension of pc_features array
-    channel_mask : numpy.ndarray (boolean)
-        Mask for channel index dimension of pc_features array
+    index_mask : numpy.ndarray (boolean or int)
+        Mask (or ascending indices) for spike index dimension of pc_features array
+    spike_templates : numpy.ndarray (num_spikes x 0)
+        Template IDs for each spike
+    channels_to_use : numpy.ndarray
+        Channels to use for calculating metrics
+    pc_feature_ind : numpy.ndarray (num_units x num_channels)
+        Channel indices of PCs for each template
 
     Output:
     -------
@@ -1026,6 +2119,11 @@ def get_unit_pcs(these_pc_features, index_mask, spike_templates, channels_to_use
 
     """
 
+    if index_mask.dtype == bool:
+        spike_inds = np.where(index_mask)[0]
+    else:
+        spike_inds = index_mask
+
     # start with an empty 3D array
     [nspike,npcs,nchan] = these_pc_features.shape
     
@@ -1035,11 +2133,11 @@ def get_unit_pcs(these_pc_features, index_mask, spike_templates, channels_to_use
     
     # get list of templates included in this cluster
     # for data with no curation, there will just be one value   
-    template_ids = np.unique(spike_templates[index_mask])
+    template_ids = np.unique(spike_templates[spike_inds])
     
     # for each template id, create a channel mask (if possible) and extract templates
     for tid in template_ids:
-        curr_idx = index_mask & (spike_templates == tid)
+        curr_idx = spike_inds[spike_templates[spike_inds] == tid]
         try:
             channel_mask = make_channel_mask(tid, pc_feature_ind, channels_to_use)            
         except IndexError:
@@ -1077,45 +2175,109 @@ def ccg(st1, st2, nbins, tbin, auto):
     st1 = np.sort(np.squeeze(st1))
     st2 = np.sort(np.squeeze(st2))
     
-    dt = nbins*tbin  # cross correlogram spans -dt-dt
-    
     T = max(np.max(st1),np.max(st2)) - min(np.min(st1),np.min(st2))
     
-    # traverse both spike trains together, keeping track of the spikes in the first
-    # spike train that are within dt of the second spike train
-    ilow = 0
-    ihigh = 0
-    j = 0
-    
     n_st2 = len(st2)
     n_st1 = len(st1)
     
-    K = np.zeros((2*nbins+1,))
-    
-    while j < n_st2:                      # walk over all spikes in 2nd spike train
-        while (ihigh < n_st1) and (st1[ihigh] < st2[j]+dt):            
-            ihigh = ihigh + 1             # increase upper bound until its outisde the dt range
-        while (ilow < n_st1) and (st1[ilow] <= st2[j]-dt):
-            ilow = ilow + 1                # increase lower bound until it is inside the dt range
-        if ilow > n_st1:
-            break
-        if st1[ilow] > st2[j] + dt:
-            # if the lower bound is actually outside of the dt range, means
-            # there were no spikes in range of the ccg
-            # just move on to next spike st2
-            j = j + 1
-            continue
-        for k in range(ilow,ihigh):
-            # for all spikes within the plus/minus dt range
-            ibin = int(np.round((st2[j]-st1[k])/tbin))    # calculate which bin
-            K[ibin + nbins] = K[ibin + nbins] + 1    # increment corresponding bin in correlogram
-        j = j + 1   # go to next spike in st2
+    K = ccg_histogram(st1, st2, nbins, tbin)
         
     if auto:
         # print('nspikes, zero bin: ' + repr(n_st1) + ', ' + repr(K[nbins]))
         # if this is an autocorrelogram, remove the self-found spikes from the zero bin
         K[nbins] = K[nbins] - n_st1     # remove "self found" spikes from 
     
+    Qi, Q00, Q01, Ri = ccg_refractory_stats(K, n_st1, n_st2, T, nbins, tbin)
+        
+    return K, Qi, Q00, Q01, Ri
+
+
+def ccg_histogram(st1, st2, nbins, tbin, max_pairs = 4194304):
+
+    """ Count spike pairs in each ccg bin, vectorized over all spikes in st2
+
+    Replaces the Kilosort2 walk over both spike trains: for each spike in st2
+    the window of st1 spikes within plus/minus nbins*tbin is found with 
+    searchsorted, and all pairs in a block of st2 spikes are binned with one
+    bincount. Blocks are sized to hold at most max_pairs pairs, so memory
+    stays bounded for high-rate units.
+
+    Inputs:
+    -------
+    st1 : numpy.ndarray
+        Sorted spike times for set #1 in sec
+    st2 : numpy.ndarray
+        Sorted spike times for set #2 in sec
+    nbins : Int
+        ccg will be calculated for 2*nbins + 1 bins
+    tbin : float
+        bin width in seconds
+    max_pairs : Int
+        Maximum number of spike pairs to bin at once
+
+    Outputs:
+    --------
+    K : numpy.ndarray (2*nbins + 1 x 0)
+        ccg histogram (self-pairs are not removed)
+
+    """
+
+    dt = nbins*tbin  # cross correlogram spans -dt-dt
+
+    K = np.zeros((2*nbins+1,))
+
+    # st1 spikes in the open interval (st2[j] - dt, st2[j] + dt)
+    ilow = np.searchsorted(st1, st2 - dt, side='right')
+    ihigh = np.searchsorted(st1, st2 + dt, side='left')
+    pair_counts = ihigh - ilow
+    cumulative_pairs = np.cumsum(pair_counts)
+
+    start = 0
+    n_st2 = len(st2)
+
+    while start < n_st2:
+
+        done = cumulative_pairs[start - 1] if start > 0 else 0
+        end = max(np.searchsorted(cumulative_pairs, done + max_pairs, side='right'), start + 1)
+
+        counts = pair_counts[start:end]
+        total = np.sum(counts)
+
+        if total > 0:
+            # index into st2 and st1 for every pair in this block
+            j = np.repeat(np.arange(start, end), counts)
+            k = np.arange(total) + np.repeat(ilow[start:end] - (np.cumsum(counts) - counts), counts)
+            ibin = np.round((st2[j] - st1[k])/tbin).astype('int64')    # calculate which bin
+            K = K + np.bincount(ibin + nbins, minlength = 2*nbins+1)
+
+        start = end
+
+    return K
+
+
+def ccg_refractory_stats(K, n_st1, n_st2, T, nbins, tbin):
+
+    """ Refractoriness statistics of a ccg histogram (from Kilosort2)
+
+    Inputs:
+    -------
+    K : numpy.ndarray (2*nbins + 1 x 0)
+        ccg histogram
+    n_st1, n_st2 : Int
+        number of spikes in each spike train
+    T : float
+        time spanned by both spike trains, in sec
+    nbins : Int
+        number of bins on each side of zero lag
+    tbin : float
+        bin width in seconds
+
+    Outputs:
+    --------
+    Qi, Q00, Q01, Ri
+
+    """
+
     irange1 = np.concatenate((np.arange(1, int(nbins/2)), np.arange(int(3/2*nbins), 2*nbins-1)),0) # this index range corresponds to the CCG shoulders, excluding end bins
     irange2 = np.arange(nbins-50, nbins-10)  # 40 channels to negative side of peak
     irange3 = np.arange(nbins+10, nbins+50)  # 40 channels to positive side of peak
@@ -1152,7 +2314,53 @@ def ccg(st1, st2, nbins, tbin, auto):
         # lam = R00 + i
         # Ri[i] =  1/2 * (1+ special.erf((n - lam)/np.sqrt(2*lam)))
         
-    return K, Qi, Q00, Q01, Ri
+    return Qi, Q00, Q01, Ri
+
+
+def calculate_acgs(spike_times, spike_clusters, total_units, nbins, tbin, min_spikes = 0, spike_index = None):
+
+    """ Auto-correlograms for all units in a single call
+
+    Inputs:
+    -------
+    spike_times : numpy.ndarray (num_spikes x 0)
+        Spike times in seconds
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster IDs for each spike time
+    total_units : Int
+        Number of cluster IDs (rows of the output)
+    nbins : Int
+        acg will be calculated for 2*nbins + 1 bins
+    tbin : float
+        bin width in seconds
+    min_spikes : Int
+        Units with fewer spikes are left as zeros
+    spike_index : SpikeIndex (optional)
+        Precomputed cluster to spike index
+
+    Outputs:
+    --------
+    acgs : numpy.ndarray (total_units x 2*nbins + 1)
+        Auto-correlogram of each unit, with self-counted spikes removed from the zero bin
+
+    """
+
+    if spike_index is None:
+        spike_index = SpikeIndex(spike_clusters, total_units)
+
+    acgs = np.zeros((total_units, 2*nbins+1))
+
+    for cluster_id in spike_index.cluster_ids:
+
+        if spike_index.counts[cluster_id] < max(min_spikes, 1):
+            continue
+
+        st = np.sort(spike_times[spike_index.spikes_for(cluster_id)])
+        acgs[cluster_id, :] = ccg_histogram(st, st, nbins, tbin)
+        acgs[cluster_id, nbins] = acgs[cluster_id, nbins] - st.size
+
+    return acgs
+
 
 def contamination_rate(st_sec, tbin_sec, refPer_sec):
     # given a set of spike times in sec, calculate the KS2 contamination percent
@@ -1163,12 +2371,18 @@ def contamination_rate(st_sec, tbin_sec, refPer_sec):
     #      instead of just taking the range of the acg with the lowest contamination, take the range corresponding
     #      to the user specified refractory period. This will also usually give higher values for the contamination rate.
     
+    K, Qi, Q00, Q01, rir = ccg(st_sec, st_sec, 500, tbin_sec, True); # compute the auto-correlogram with 500 bins at 1ms bins
+    
+    return contamination_from_stats(Qi, Q00, Q01, tbin_sec, refPer_sec)
+
+
+def contamination_from_stats(Qi, Q00, Q01, tbin_sec, refPer_sec):
+    # contamination rate from the refractoriness statistics of an acg (see ccg_refractory_stats)
+
     refPerBin = int(refPer_sec/tbin_sec)
     if refPerBin == 0:
         refPerBin = 1   # if refractory period < bin size, take the first bin
     
-    K, Qi, Q00, Q01, rir = ccg(st_sec, st_sec, 500, tbin_sec, True); # compute the auto-correlogram with 500 bins at 1ms bins
-    
     normFactor = (max(Q00, Q01))
     
     if normFactor > 0:
@@ -1176,4 +2390,4 @@ def contamination_rate(st_sec, tbin_sec, refPer_sec):
     else:
         contam_rate = 1
     
-    return contam_rate
\ No newline at end of file
+    return contam_rate
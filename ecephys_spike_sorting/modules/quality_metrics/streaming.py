@@ -0,0 +1,543 @@
+"""
+Out-of-core quality metrics for recordings whose spike arrays don't fit in memory
+
+The spike arrays (typically read-only memory maps) are read in blocks of
+consecutive spikes, in two passes:
+
+    1. spike times, clusters, templates and amplitudes: spike counts, the
+       range of each unit's amplitudes, its majority template, and the
+       position of each drift interval in the spike arrays
+    2. everything else, feeding per-unit accumulators: presence bins,
+       ISI-violation counts (carrying each unit's last spike across blocks),
+       amplitude histograms, auto-correlograms (carrying each unit's spikes
+       from the last half second), running drift statistics, and reservoir
+       samples of spikes for the PC-based metrics and silhouette score
+
+The metrics are then computed from the accumulators. Everything except the
+PC-based metrics and the silhouette score matches calculate_metrics; those
+are computed on the reservoir samples (up to max_spikes_for_unit spikes per
+unit and n_silhouette spikes overall), which is what calculate_metrics
+subsamples to as well.
+
+Memory use is set by memory_budget_mb and the number of units, not by the
+length of the recording. Blocks in pass 2 follow the drift intervals, so
+the depths of one interval (24 bytes per spike) are held at once.
+
+"""
+
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+
+from ...common.utils import load, get_spike_depths, gather_rows, SpikeIndex, ClusterTemplateCounts
+
+from .metrics import metric_columns, METRIC_GROUPS
+from .metrics import ccg_histogram, ccg_refractory_stats, contamination_from_stats
+from .metrics import amplitude_cutoffs_from_histograms, unit_histogram_edges, unit_histogram_bins
+from .metrics import calculate_pc_metrics, calculate_silhouette_score
+from .metrics import grouped_median_depths
+
+
+NUM_PRESENCE_BINS = 100      # as in calculate_spike_train_metrics
+NUM_AMPLITUDE_BINS = 500     # as in amplitude_cutoff
+NUM_ACG_BINS = 500           # as in calculate_contam_rate
+MIN_BLOCK_SPIKES = 1000
+
+
+def load_streaming_data(folder, include_pcs, use_master_clock = False):
+
+    """
+    Opens the per-spike Kilosort arrays as read-only memory maps
+
+    Outputs:
+    --------
+    spike_times : numpy.memmap (in samples)
+    spike_clusters, spike_templates, amplitudes : numpy.memmap
+    channel_pos : numpy.ndarray
+    pc_features : numpy.memmap or None
+    pc_feature_ind : numpy.ndarray or None
+
+    """
+
+    if use_master_clock:
+        spike_times = load(folder, 'spike_times_master_clock.npy', 'r')
+    else:
+        spike_times = load(folder, 'spike_times.npy', 'r')
+
+    spike_clusters = load(folder, 'spike_clusters.npy', 'r')
+    spike_templates = load(folder, 'spike_templates.npy', 'r')
+    amplitudes = load(folder, 'amplitudes.npy', 'r')
+    channel_pos = load(folder, 'channel_positions.npy')
+
+    pc_features = None
+    pc_feature_ind = None
+
+    if include_pcs:
+        pc_features = load(folder, 'pc_features.npy', 'r')
+        pc_feature_ind = load(folder, 'pc_feature_ind.npy')
+
+    return np.squeeze(spike_times), np.squeeze(spike_clusters), np.squeeze(spike_templates), \
+        np.squeeze(amplitudes), channel_pos, pc_features, pc_feature_ind
+
+
+def calculate_metrics_streaming(spike_times,
+                                spike_clusters,
+                                spike_templates,
+                                amplitudes,
+                                channel_pos,
+                                pc_features,
+                                pc_feature_ind,
+                                params,
+                                sample_rate = None,
+                                memory_budget_mb = 2048):
+
+    """ Calculate metrics for all units on one probe, reading the spikes in blocks
+
+    Inputs:
+    ------
+    spike_times : numpy.ndarray or numpy.memmap (num_spikes x 0)
+        Spike times, sorted; in samples if sample_rate is given, else in seconds
+    spike_clusters, spike_templates, amplitudes : numpy.ndarray or numpy.memmap (num_spikes x 0)
+    channel_pos : numpy.ndarray (num_channels x 2)
+    pc_features : numpy.ndarray or numpy.memmap (num_spikes x num_pcs x num_channels)
+    pc_feature_ind : numpy.ndarray (num_units x num_channels)
+    params : dict of parameters (as for calculate_metrics)
+    sample_rate : float (optional)
+        Converts spike_times to seconds
+    memory_budget_mb : float
+        Approximate bound on the memory used
+
+    Outputs:
+    --------
+    metrics : pandas.DataFrame
+        one column for each metric, one row per unit, for the whole session
+
+    """
+
+    include_pcs = params['include_pcs'] and pc_features is not None
+
+    columns = metric_columns(params.get('metrics_to_compute'))
+    groups = [group for group in METRIC_GROUPS if set(METRIC_GROUPS[group].columns) & set(columns)]
+
+    seed = params.get('pc_metrics_seed', None)
+    random_state = np.random if seed is None else np.random.RandomState(seed)
+
+    budget = memory_budget_mb * 1024**2
+    num_spikes = spike_times.shape[0]
+
+    def seconds(rows):
+        t = np.asarray(spike_times[rows], dtype = 'float64') if sample_rate is None else spike_times[rows] / sample_rate
+        return np.atleast_1d(t)
+
+    min_time = seconds(0)[0]
+    max_time = seconds(num_spikes - 1)[0]
+    duration = max_time - min_time
+
+    use_drift = include_pcs and 'drift' in groups
+
+    if use_drift:
+        interval_starts = np.arange(min_time, max_time, params['drift_metrics_interval_s'])
+        interval_ends = interval_starts + params['drift_metrics_interval_s']
+    else:
+        interval_starts = np.zeros((0,))
+
+    # ---------------------------------------------------------------
+    # pass 1: spike counts, amplitude ranges, majority templates,
+    # and the position of each drift interval
+    # ---------------------------------------------------------------
+
+    block_spikes = max(int(budget / (4 * 32)), MIN_BLOCK_SPIKES)
+
+    template_counts = ClusterTemplateCounts()
+    amplitude_min = np.zeros((0,))
+    amplitude_max = np.zeros((0,))
+    interval_rows = np.zeros(interval_starts.shape, dtype = 'int64')
+    last_time = -np.inf
+
+    print("Pass 1 of 2: counting spikes")
+
+    for start in range(0, num_spikes, block_spikes):
+
+        rows = slice(start, min(start + block_spikes, num_spikes))
+        t = seconds(rows)
+        clusters = np.asarray(spike_clusters[rows], dtype = 'int64')
+        templates = np.asarray(spike_templates[rows], dtype = 'int64')
+        amps = np.asarray(amplitudes[rows])
+
+        if t[0] < last_time or np.any(np.diff(t) < 0):
+            raise ValueError('streaming quality metrics require spike times in ascending order')
+        last_time = t[-1]
+
+        template_counts.add(clusters, templates)
+
+        num_units = template_counts.total_units
+        amplitude_min = _grow(amplitude_min, num_units, np.inf).astype(amps.dtype)
+        amplitude_max = _grow(amplitude_max, num_units, -np.inf).astype(amps.dtype)
+
+        np.minimum.at(amplitude_min, clusters, amps)
+        np.maximum.at(amplitude_max, clusters, amps)
+
+        interval_rows += np.searchsorted(t, interval_starts, side = 'right')
+
+    total_units = template_counts.total_units
+    counts = template_counts.spike_counts()
+    cluster_ids = template_counts.cluster_ids()
+    print('total units: ' + repr(total_units))
+
+    template_ids = np.zeros((total_units,), dtype = 'uint16') + total_units + 10  # unassigned template_ids out of range
+    template_ids[cluster_ids] = template_counts.majority_templates()[cluster_ids]
+
+    # ---------------------------------------------------------------
+    # accumulators
+    # ---------------------------------------------------------------
+
+    presence_edges = np.linspace(min_time, max_time, NUM_PRESENCE_BINS)
+    occupied = np.zeros((total_units, NUM_PRESENCE_BINS - 1), dtype = 'bool')
+
+    last_raw_time = np.zeros((total_units,)) + np.nan
+    last_kept_time = np.zeros((total_units,)) + np.nan
+    num_kept = np.zeros((total_units,), dtype = 'int64')
+    num_violations = np.zeros((total_units,), dtype = 'int64')
+
+    amplitude_edges = unit_histogram_edges(amplitude_min, amplitude_max, NUM_AMPLITUDE_BINS)
+    amplitude_counts = np.zeros((total_units, NUM_AMPLITUDE_BINS), dtype = 'int64')
+
+    use_acgs = 'contam_rate' in groups
+    acgs = np.zeros((total_units, 2 * NUM_ACG_BINS + 1)) if use_acgs else None
+    acg_window = NUM_ACG_BINS * params.get('tbin_sec', 0.001)
+    acg_carry = {}
+    first_time = np.zeros((total_units,)) + np.nan
+    final_time = np.zeros((total_units,)) + np.nan
+
+    max_depth = np.zeros((total_units,)) + np.nan
+    min_depth = np.zeros((total_units,)) + np.nan
+    cumulative_drift = np.zeros((total_units,))
+    previous_depth = np.zeros((total_units,)) + np.nan
+    has_depth = np.zeros((total_units,), dtype = 'bool')
+
+    fixed_bytes = occupied.nbytes + amplitude_counts.nbytes + amplitude_edges.nbytes + 8 * 12 * total_units
+    if use_acgs:
+        fixed_bytes += acgs.nbytes
+
+    # reservoirs: the spikes with the smallest random keys form a uniform sample
+    row_bytes = pc_features[0].nbytes if include_pcs else 0
+    use_unit_reservoir = include_pcs and 'pc_metrics' in groups
+    use_silhouette_reservoir = include_pcs and 'silhouette_score' in groups
+
+    reservoir_size = params.get('max_spikes_for_unit', 500)
+    if use_unit_reservoir:
+        affordable = int(budget / 4 / (total_units * (row_bytes + 16)))
+        if affordable < reservoir_size:
+            print('Memory budget limits the PC metric samples to ' + repr(affordable) + ' spikes per unit')
+            reservoir_size = max(affordable, 1)
+        fixed_bytes += total_units * reservoir_size * (row_bytes + 16)
+
+    silhouette_size = params.get('n_silhouette', 10000)
+    if use_silhouette_reservoir:
+        fixed_bytes += silhouette_size * (row_bytes + 16)
+
+    unit_keys = np.zeros((0,))
+    unit_rows = np.zeros((0,), dtype = 'int64')
+    unit_clusters = np.zeros((0,), dtype = 'int64')
+    silhouette_keys = np.zeros((0,))
+    silhouette_rows = np.zeros((0,), dtype = 'int64')
+
+    # per spike: time, cluster, template, amplitude and keys (8 bytes each),
+    # first PCs for depths, and about as much again in temporaries
+    spike_bytes = 2 * (6 * 8 + (row_bytes if use_drift else 0))
+    block_spikes = max(int((budget - fixed_bytes) / spike_bytes), MIN_BLOCK_SPIKES)
+
+    # blocks end at drift interval boundaries (interval k holds the spikes
+    # after interval_rows[k], up to and including interval_rows[k + 1])
+    if use_drift:
+        boundaries = np.concatenate(([0], interval_rows[1:], [num_spikes]))
+    else:
+        boundaries = np.array([0, num_spikes])
+
+    # ---------------------------------------------------------------
+    # pass 2: accumulate
+    # ---------------------------------------------------------------
+
+    print("Pass 2 of 2: accumulating metrics")
+
+    for interval in range(boundaries.size - 1):
+
+        interval_times = []
+        interval_clusters = []
+        interval_depths = []
+
+        for start in range(boundaries[interval], boundaries[interval + 1], block_spikes):
+
+            rows = slice(start, min(start + block_spikes, boundaries[interval + 1]))
+            t = seconds(rows)
+            clusters = np.asarray(spike_clusters[rows], dtype = 'int64')
+
+            # spike train metrics
+            bins = np.clip(np.searchsorted(presence_edges, t, side = 'right') - 1, 0, NUM_PRESENCE_BINS - 2)
+            occupied[clusters, bins] = True
+
+            order = np.argsort(clusters, kind = 'stable')
+            unit_times = t[order]
+            units = clusters[order]
+
+            _count_isi_violations(unit_times, units, params['isi_threshold'], params['min_isi'],
+                                  last_raw_time, last_kept_time, num_kept, num_violations)
+
+            is_first = np.concatenate(([True], units[1:] != units[:-1]))
+            is_last = np.concatenate((units[1:] != units[:-1], [True]))
+            first_time[units[is_first]] = np.fmin(first_time[units[is_first]], unit_times[is_first])
+            final_time[units[is_last]] = unit_times[is_last]
+
+            # amplitude histograms
+            amps = np.asarray(amplitudes[rows])
+            amplitude_bins = unit_histogram_bins(amps, clusters, amplitude_edges)
+            amplitude_counts += np.reshape(np.bincount(clusters * NUM_AMPLITUDE_BINS + amplitude_bins,
+                                                       minlength = total_units * NUM_AMPLITUDE_BINS),
+                                           amplitude_counts.shape)
+
+            if use_acgs:
+                _accumulate_acgs(acgs, acg_carry, unit_times, units, is_first, counts,
+                                 NUM_ACG_BINS, params['tbin_sec'], acg_window, t[-1])
+
+            # reservoir samples
+            spike_rows = np.arange(rows.start, rows.stop)
+
+            if use_unit_reservoir:
+                unit_keys, unit_rows, unit_clusters = _bottom_k_by_unit(
+                    np.concatenate((unit_keys, random_state.random_sample(t.size))),
+                    np.concatenate((unit_rows, spike_rows)),
+                    np.concatenate((unit_clusters, clusters)),
+                    reservoir_size)
+
+            if use_silhouette_reservoir:
+                silhouette_keys, silhouette_rows = _bottom_k(
+                    np.concatenate((silhouette_keys, random_state.random_sample(t.size))),
+                    np.concatenate((silhouette_rows, spike_rows)),
+                    silhouette_size)
+
+            # depths of the spikes extracted with their unit's majority template
+            if use_drift:
+                templates = np.asarray(spike_templates[rows], dtype = 'int64')
+                match_maj = templates == template_ids[clusters]
+                first_pc_sq = np.squeeze(gather_rows(pc_features[rows, 0, :], match_maj))
+                first_pc_sq = np.reshape(first_pc_sq, (np.sum(match_maj), -1))
+                first_pc_sq[first_pc_sq < 0] = 0
+                first_pc_sq = pow(first_pc_sq, 2)
+
+                interval_times.append(t[match_maj])
+                interval_clusters.append(clusters[match_maj])
+                interval_depths.append(get_spike_depths(clusters[match_maj], template_ids, first_pc_sq,
+                                                        pc_feature_ind, channel_pos))
+
+        if use_drift and boundaries[interval + 1] > boundaries[interval]:
+
+            m_clusters = np.concatenate(interval_clusters)
+            has_depth[m_clusters] = True
+
+            # the next interval is included so that a spike on its start is
+            # excluded exactly as in grouped_median_depths
+            depths = grouped_median_depths(np.concatenate(interval_times), m_clusters,
+                                           np.concatenate(interval_depths), total_units,
+                                           interval_starts[interval:interval + 2],
+                                           interval_ends[interval:interval + 2],
+                                           params['drift_metrics_min_spikes_per_interval'])[:, 0]
+
+            both = np.invert(np.isnan(depths)) * np.invert(np.isnan(previous_depth))
+            cumulative_drift[both] += np.abs(depths[both] - previous_depth[both])
+            max_depth = np.fmax(max_depth, depths)
+            min_depth = np.fmin(min_depth, depths)
+            previous_depth = depths
+
+        elif use_drift:
+            previous_depth = np.zeros((total_units,)) + np.nan
+
+    # ---------------------------------------------------------------
+    # finalize
+    # ---------------------------------------------------------------
+
+    values = OrderedDict()
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+
+        firing_rate = np.zeros((total_units,))
+        presence_ratio = np.zeros((total_units,))
+        isi_viol = np.zeros((total_units,))
+        num_viol = np.zeros((total_units,))
+
+        firing_rate[cluster_ids] = counts[cluster_ids] / duration
+        presence_ratio[cluster_ids] = np.sum(occupied[cluster_ids, :], 1) / NUM_PRESENCE_BINS
+
+        violation_time = 2 * num_kept[cluster_ids] * (params['isi_threshold'] - params['min_isi'])
+        total_rate = num_kept[cluster_ids] / duration
+        c = num_violations[cluster_ids] / (violation_time * total_rate)
+        isi_viol[cluster_ids] = np.where(c < 0.25, (1 - np.sqrt(1 - 4 * c)) / 2, 1.0)
+        num_viol[cluster_ids] = num_violations[cluster_ids]
+
+    values.update(zip(METRIC_GROUPS['spike_train'].columns, (firing_rate, presence_ratio, isi_viol, num_viol)))
+
+    if use_acgs:
+        contam_rate = np.ones((total_units,))
+        for cluster_id in cluster_ids:
+            if counts[cluster_id] > 10:
+                acgs[cluster_id, NUM_ACG_BINS] -= counts[cluster_id]
+                T = final_time[cluster_id] - first_time[cluster_id]
+                Qi, Q00, Q01, Ri = ccg_refractory_stats(acgs[cluster_id, :], counts[cluster_id], counts[cluster_id],
+                                                        T, NUM_ACG_BINS, params['tbin_sec'])
+                contam_rate[cluster_id] = contamination_from_stats(Qi, Q00, Q01, params['tbin_sec'], params['isi_threshold'])
+        values['contam_rate'] = contam_rate
+
+    amplitude_cutoff = np.zeros((total_units,))
+    if cluster_ids.size > 0:
+        h = amplitude_counts[cluster_ids] / np.diff(amplitude_edges[cluster_ids], axis = 1) / counts[cluster_ids, np.newaxis]
+        amplitude_cutoff[cluster_ids] = amplitude_cutoffs_from_histograms(h, amplitude_edges[cluster_ids])
+    values['amplitude_cutoff'] = amplitude_cutoff
+
+    if not include_pcs:
+        for group in ('pc_metrics', 'silhouette_score', 'drift'):
+            values.update((column, np.zeros((total_units,))) for column in METRIC_GROUPS[group].columns)
+
+    if use_unit_reservoir:
+
+        print("Calculating PC-based metrics on " + repr(unit_rows.size) + " sampled spikes")
+        sample_rows = np.sort(unit_rows)
+        sample_clusters = np.asarray(spike_clusters[sample_rows], dtype = 'int64')
+
+        values.update(zip(METRIC_GROUPS['pc_metrics'].columns,
+                          calculate_pc_metrics(sample_clusters,
+                                               np.asarray(spike_templates[sample_rows], dtype = 'int64'),
+                                               total_units,
+                                               cluster_ids,
+                                               template_ids,
+                                               gather_rows(pc_features, sample_rows),
+                                               pc_feature_ind,
+                                               channel_pos,
+                                               params['max_radius_um'],
+                                               params['max_spikes_for_unit'],
+                                               params['max_spikes_for_nn'],
+                                               params['n_neighbors'],
+                                               SpikeIndex(sample_clusters, total_units),
+                                               params.get('multiprocessing_worker_count', 1),
+                                               seed,
+                                               params.get('nn_mode', 'unit'),
+                                               params.get('nn_algorithm', 'ball_tree'))))
+
+    if use_silhouette_reservoir:
+
+        print("Calculating silhouette score")
+        sample_rows = np.sort(silhouette_rows)
+        values['silhouette_score'] = calculate_silhouette_score(np.asarray(spike_clusters[sample_rows], dtype = 'int64'),
+                                                                np.asarray(spike_templates[sample_rows], dtype = 'int64'),
+                                                                total_units,
+                                                                gather_rows(pc_features, sample_rows),
+                                                                pc_feature_ind,
+                                                                sample_rows.size)
+
+    if use_drift:
+        max_drift = np.zeros((total_units,))
+        max_drift[has_depth] = np.around(max_depth[has_depth] - min_depth[has_depth], 2)
+        cumulative_drift[np.invert(has_depth)] = 0
+        values['max_drift'] = max_drift
+        values['cumulative_drift'] = np.around(cumulative_drift, 2)
+
+    return pd.DataFrame(data = OrderedDict([('cluster_id', np.arange(total_units))] +
+                                           [(column, values[column]) for column in columns] +
+                                           [('epoch_name', ['complete_session'] * total_units)]))
+
+
+def _grow(array, size, fill):
+
+    if array.size >= size:
+        return array
+
+    grown = np.zeros((size,), dtype = array.dtype)
+    grown[:] = fill
+    grown[:array.size] = array
+
+    return grown
+
+
+def _count_isi_violations(times, units, isi_threshold, min_isi, last_raw_time, last_kept_time, num_kept, num_violations):
+
+    """ ISI violations in a block of spikes grouped by unit, continuing from earlier blocks """
+
+    is_first = np.concatenate(([True], units[1:] != units[:-1]))
+    is_last = np.concatenate((units[1:] != units[:-1], [True]))
+
+    # duplicates follow the previous spike (of any kind) within min_isi
+    previous = np.concatenate(([np.nan], times[:-1]))
+    previous[is_first] = last_raw_time[units[is_first]]
+    keep = np.invert(times - previous <= min_isi)
+
+    last_raw_time[units[is_last]] = times[is_last]
+
+    kept_times = times[keep]
+    kept_units = units[keep]
+
+    if kept_units.size == 0:
+        return
+
+    kept_first = np.concatenate(([True], kept_units[1:] != kept_units[:-1]))
+    kept_last = np.concatenate((kept_units[1:] != kept_units[:-1], [True]))
+
+    previous = np.concatenate(([np.nan], kept_times[:-1]))
+    previous[kept_first] = last_kept_time[kept_units[kept_first]]
+    violations = kept_times - previous < isi_threshold
+
+    last_kept_time[kept_units[kept_last]] = kept_times[kept_last]
+
+    num_kept += np.bincount(kept_units, minlength = num_kept.size)
+    num_violations += np.bincount(kept_units[violations], minlength = num_violations.size)
+
+
+def _accumulate_acgs(acgs, carry, times, units, is_first, counts, nbins, tbin, window, block_end):
+
+    """ Adds the spike pairs of a block (and with the carried spikes before it) to each unit's acg """
+
+    starts = np.where(is_first)[0]
+    ends = np.concatenate((starts[1:], [units.size]))
+
+    for start, end in zip(starts, ends):
+
+        cluster_id = units[start]
+
+        if counts[cluster_id] <= 10:
+            continue
+
+        st = times[start:end]
+        previous = carry.get(cluster_id, np.zeros((0,)))
+
+        acgs[cluster_id, :] += ccg_histogram(np.concatenate((previous, st)), st, nbins, tbin)
+        if previous.size > 0:
+            acgs[cluster_id, :] += ccg_histogram(st, previous, nbins, tbin)
+
+        carry[cluster_id] = np.concatenate((previous, st))
+
+    # keep the spikes that later spikes can still pair with (with a margin;
+    # ccg_histogram applies the exact window)
+    for cluster_id in list(carry.keys()):
+        recent = carry[cluster_id][carry[cluster_id] > block_end - window - tbin]
+        if recent.size > 0:
+            carry[cluster_id] = recent
+        else:
+            del carry[cluster_id]
+
+
+def _bottom_k(keys, rows, k):
+
+    if keys.size <= k:
+        return keys, rows
+
+    keep = np.argpartition(keys, k)[:k]
+
+    return keys[keep], rows[keep]
+
+
+def _bottom_k_by_unit(keys, rows, clusters, k):
+
+    order = np.lexsort((keys, clusters))
+    clusters = clusters[order]
+
+    group_start = np.searchsorted(clusters, clusters, side = 'left')
+    keep = order[np.arange(order.size) - group_start < k]
+
+    return keys[keep], rows[keep], clusters[keep]
@@ -75,7 +75,8 @@ def createInputJson(output_file,
                     fr_min = 0.05,
                     isi_viol_max = 0.2,
                     n_viol_max = 1,
-                    ks_trange = '[0 Inf]'                    
+                    ks_trange = '[0 Inf]',
+                    use_cache = False
                     ):
                     #  ks_chanMap = 'C:/Users/Niflheim/Documents/GitHub/SpikeGLX_tools/chanMap.mat'///
 
@@ -208,6 +209,10 @@ def createInputJson(output_file,
             "kilosort_output_tmp": kilosort_output_tmp
        },
 
+        "cache_params": {
+            "use_cache" : use_cache
+        },
+
         "common_files": {
             "settings_json" : npx_directory,
             "probe_json" : os.path.join(extracted_data_directory,'probe_json.json')
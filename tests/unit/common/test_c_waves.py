@@ -0,0 +1,70 @@
+import numpy as np
+import os
+
+from ecephys_spike_sorting.common.c_waves import calculate_c_waves, write_c_waves_output, snr_sites, open_spikeglx_bin, \
+	NOISE_SAMPLES
+import ecephys_spike_sorting.common.synthetic as synthetic
+
+
+def test_snr_sites():
+
+	site_x = np.tile([43, 11, 59, 27], 8).astype('float')
+	site_y = np.repeat(np.arange(16) * 20, 2).astype('float')
+
+	assert(np.array_equal(snr_sites(1, 32, 2), [0, 1, 2, 3]))
+	assert(np.array_equal(snr_sites(30, 32, 2), [28, 29, 30, 31]))
+	assert(np.array_equal(snr_sites(10, 32, 2, 26, site_x, site_y), [8, 10, 12]))
+	assert(np.array_equal(snr_sites(10, 32, 2, 0, site_x, site_y), [8, 9, 10, 11, 12]))
+
+def test_calculate_c_waves(tmp_path):
+
+	rng = np.random.RandomState(5)
+
+	num_channels = 12
+	data = rng.randint(-100, 100, (20000, num_channels + 1)).astype('int16')
+	spike_times = np.sort(rng.randint(0, 20000, 500)).astype('uint64')
+	spike_clusters = rng.randint(0, 4, 500).astype('uint32')
+	spike_clusters[spike_clusters == 2] = 1
+	clus_table = np.array([[0, 3], [0, 0], [0, 5], [0, 11]], dtype = 'uint32')
+
+	mean_waveforms, cluster_snr = calculate_c_waves(data, spike_times, spike_clusters, clus_table, 0.195,
+													num_spikes = 50, snr_radius = 2, num_channels = num_channels,
+													chunk_bytes = 20000)
+
+	assert(mean_waveforms.shape == (4, num_channels, 82) and mean_waveforms.dtype == 'float32')
+	assert(cluster_snr.shape == (4, 2) and cluster_snr.dtype == 'float32')
+
+	# no spikes
+	assert(np.all(mean_waveforms[2] == 0) and np.all(cluster_snr[2] == 0))
+
+	for cluster in (0, 1, 3):
+
+		times = spike_times[spike_clusters == cluster].astype('int64')
+		times = times[(np.arange(50) * times.size) // 50]
+		times = times[(times >= 19) * (times + 63 <= 20000)]
+
+		waveforms = np.array([data[t - 19:t + 63, :num_channels].T * 0.195 for t in times])
+		mean = np.mean(waveforms, 0)
+
+		peak_channel = clus_table[cluster, 1]
+		sites = np.arange(max(0, peak_channel - 2), min(num_channels, peak_channel + 3))
+		residuals = (waveforms - mean)[:, sites, :NOISE_SAMPLES]
+		variance = np.sum(np.square(residuals)) / (residuals.size - sites.size * NOISE_SAMPLES)
+
+		assert(cluster_snr[cluster, 1] == times.size)
+		assert(np.allclose(mean_waveforms[cluster], mean, atol = 1e-4))
+		assert(np.isclose(cluster_snr[cluster, 0], np.ptp(mean[peak_channel]) / (2 * np.sqrt(variance)), rtol = 1e-5))
+
+	mean_waveform_fullpath, snr_fullpath = write_c_waves_output(str(tmp_path), mean_waveforms, cluster_snr, 'preprocess')
+
+	assert(os.path.basename(mean_waveform_fullpath) == 'preprocess_mean_waveforms.npy')
+	assert(np.array_equal(np.load(snr_fullpath), cluster_snr))
+
+def test_open_spikeglx_bin(tmp_path):
+
+	manifest = synthetic.make_kilosort_output(str(tmp_path), num_units = 4, duration = 2.0, num_channels = 16, write_lfp = False)
+
+	data, num_ap_channels = open_spikeglx_bin(manifest['ap_band_file'], 16)
+
+	assert(data.shape == (60000, 16))
+	assert(num_ap_channels == 16)
@@ -0,0 +1,112 @@
+import numpy as np
+import os
+
+from argschema import ArgSchemaParser
+
+import ecephys_spike_sorting.common.result_cache as result_cache
+import ecephys_spike_sorting.common.synthetic as synthetic
+import ecephys_spike_sorting.modules.kilosort_postprocessing.__main__ as kilosort_postprocessing
+import ecephys_spike_sorting.modules.noise_templates.__main__ as noise_templates
+from ecephys_spike_sorting.modules.kilosort_postprocessing._schemas import InputParameters as PostprocessingInputParameters
+from ecephys_spike_sorting.modules.noise_templates._schemas import InputParameters as NoiseTemplatesInputParameters
+
+
+def test_run_cached(tmp_path):
+
+	input_file = str(tmp_path / 'spike_times.npy')
+	output_file = str(tmp_path / 'metrics.csv')
+	np.save(input_file, np.arange(10))
+
+	runs = []
+
+	def run(args):
+		runs.append(1)
+		with open(output_file, 'w') as f:
+			f.write('cluster_id\n0\n')
+		return {'execution_time' : 1.0, 'output_file' : output_file}
+
+	args = {'directories' : {'kilosort_output_directory' : str(tmp_path)},
+			'cache_params' : {'use_cache' : True},
+			'params' : {'threshold' : 1}}
+
+	first = result_cache.run_cached('test', args, run, [input_file])
+	second = result_cache.run_cached('test', args, run, [input_file])
+
+	assert(len(runs) == 1)
+	assert(first == second)
+
+	# deleted outputs are restored from the cache
+	os.remove(output_file)
+	result_cache.run_cached('test', args, run, [input_file])
+
+	assert(len(runs) == 1)
+	assert(open(output_file).read() == 'cluster_id\n0\n')
+
+	# changed parameters or inputs are a cache miss
+	args['params']['threshold'] = 2
+	result_cache.run_cached('test', args, run, [input_file])
+	np.save(input_file, np.arange(11))
+	result_cache.run_cached('test', args, run, [input_file])
+
+	assert(len(runs) == 3)
+
+	cache = result_cache.ResultCache(str(tmp_path / result_cache.CACHE_DIRECTORY_NAME))
+
+	assert(len(cache.entries()) == 3)
+
+	cache.prune(0)
+
+	assert(len(cache.entries()) == 0)
+
+
+def test_run_cached_pipeline(tmp_path):
+
+	# rerunning a pipeline hits the cache for every module, although the later 
+	# modules write to the Kilosort directory the earlier ones read from
+	directory = str(tmp_path)
+	manifest = synthetic.make_kilosort_output(directory, num_units = 6, duration = 10.0, num_channels = 32, 
+											  mean_firing_rate = 10.0, write_lfp = False, seed = 3)
+
+	common = {'directories' : {'kilosort_output_directory' : directory},
+			  'ephys_params' : {'sample_rate' : manifest['sample_rate'], 'bit_volts' : manifest['bit_volts'],
+								'num_channels' : manifest['num_channels'], 'ap_band_file' : manifest['ap_band_file']},
+			  'cache_params' : {'use_cache' : True}}
+
+	postprocessing_args = ArgSchemaParser(input_data = dict(common, ks_postprocessing_params = {'cWaves_engine' : 'python', 'cWaves_path' : directory}),
+										  schema_type = PostprocessingInputParameters, args = []).args
+	noise_templates_args = ArgSchemaParser(input_data = dict(common, noise_waveform_params = {'classifier_path' : 'unused.pkl', 
+																							 'multiprocessing_worker_count' : 1}),
+										   schema_type = NoiseTemplatesInputParameters, args = []).args
+
+	runs = []
+
+	def counted(name, run):
+		def counted_run(args):
+			runs.append(name)
+			return run(args)
+		return counted_run
+
+	def run_pipeline():
+		result_cache.run_cached('kilosort_postprocessing', postprocessing_args, 
+								counted('kilosort_postprocessing', kilosort_postprocessing.run_postprocessing), 
+								*kilosort_postprocessing.cache_files(postprocessing_args))
+		result_cache.run_cached('noise_templates', noise_templates_args, 
+								counted('noise_templates', noise_templates.classify_noise_templates), 
+								*noise_templates.cache_files(noise_templates_args))
+
+	run_pipeline()
+	spike_times = np.load(os.path.join(directory, 'spike_times.npy'))
+
+	assert(runs == ['kilosort_postprocessing', 'noise_templates'])
+
+	run_pipeline()
+
+	assert(runs == ['kilosort_postprocessing', 'noise_templates'])
+	assert(np.array_equal(np.load(os.path.join(directory, 'spike_times.npy')), spike_times))
+
+	# a deleted output is restored
+	os.remove(os.path.join(directory, 'cluster_group.tsv'))
+	run_pipeline()
+
+	assert(len(runs) == 2)
+	assert(os.path.isfile(os.path.join(directory, 'cluster_group.tsv')))
@@ -0,0 +1,54 @@
+import numpy as np
+
+import ecephys_spike_sorting.common.synthetic as synthetic
+import ecephys_spike_sorting.common.benchmark as benchmark
+from ecephys_spike_sorting.common.utils import load_kilosort_data
+
+
+def test_make_kilosort_output(tmp_path):
+
+	manifest = synthetic.make_kilosort_output(str(tmp_path / 'a'), num_units = 8, duration = 4.0, num_channels = 32, seed = 3)
+	again = synthetic.make_kilosort_output(str(tmp_path / 'b'), num_units = 8, duration = 4.0, num_channels = 32, seed = 3)
+
+	for filename in ('spike_times.npy', 'spike_clusters.npy', 'amplitudes.npy', 'templates.npy', 'pc_features.npy'):
+		assert(np.array_equal(np.load(str(tmp_path / 'a' / filename)), np.load(str(tmp_path / 'b' / filename))))
+
+	assert(np.array_equal(np.fromfile(manifest['ap_band_file'], dtype = 'int16'), np.fromfile(again['ap_band_file'], dtype = 'int16')))
+
+	spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
+	channel_pos, cluster_ids, cluster_quality, cluster_amplitude, pc_features, pc_feature_ind, template_features = \
+		load_kilosort_data(str(tmp_path / 'a'), 30000.0, convert_to_seconds = False, include_pcs = True)
+
+	assert(spike_times.size == manifest['num_spikes'])
+	assert(np.all(np.diff(spike_times.astype('int64')) >= 0))
+	assert(templates.shape == (8, 61, 32))
+	assert(pc_features.shape == (spike_times.size, 3, 32))
+	assert(cluster_amplitude.size == 8)
+
+	# the unwhitened template matches the spikes injected into the binary
+	data = np.memmap(manifest['ap_band_file'], dtype = 'int16', mode = 'r').reshape((-1, 32))
+	unit = np.argmax(np.bincount(spike_clusters))
+	peak_channel = np.argmax(np.max(np.abs(templates[unit]), 0))
+	times = spike_times[spike_clusters == unit].astype('int64')
+	mean_waveform = np.mean([data[t - 20:t + 61, peak_channel] for t in times], 0)
+
+	assert(np.argmin(mean_waveform) == 20)
+	assert(np.argmin(templates[unit, :, peak_channel]) == 20)
+
+	# unchanged arguments reuse the folder
+	assert(synthetic.load_or_make_kilosort_output(str(tmp_path / 'a'), num_units = 8, duration = 4.0, num_channels = 32, seed = 3) == manifest)
+
+def test_run_benchmarks(tmp_path):
+
+	scale_params = {'tiny' : {'num_units' : 6, 'duration' : 4.0, 'num_channels' : 32}}
+
+	report = benchmark.run_benchmarks(['kilosort_postprocessing', 'noise_templates'], ['tiny'], str(tmp_path),
+									  isolate = False, scale_params = scale_params)
+
+	assert(len(report['results']) == 2)
+	assert(all(result['status'] == 'ok' for result in report['results']))
+	assert(all(result['peak_traced_mb'] > 0 for result in report['results']))
+
+	rows = benchmark.compare_results(report, report)
+
+	assert(all(row['time_ratio'] == 1.0 for row in rows))
@@ -1,5 +1,6 @@
 import pytest
 import numpy as np
+import pandas as pd
 import os
 
 import ecephys_spike_sorting.common.utils as utils
@@ -46,3 +47,152 @@ def test_find_range():
 	output = utils.find_range(data, 20, 30)
 
 	assert(np.array_equal(output, np.arange(20,31)))
+
+
+def test_spike_index():
+
+	spike_clusters = np.array([3, 0, 3, 1, 0, 3, 5])
+
+	spike_index = utils.SpikeIndex(spike_clusters)
+
+	assert(spike_index.total_units == 6)
+	assert(np.array_equal(spike_index.cluster_ids, [0, 1, 3, 5]))
+	assert(np.array_equal(spike_index.counts, [2, 1, 0, 3, 0, 1]))
+
+	for cluster_id in range(spike_index.total_units):
+		assert(np.array_equal(spike_index.spikes_for(cluster_id), np.where(spike_clusters == cluster_id)[0]))
+
+	assert(np.array_equal(spike_index.sorted_clusters(), spike_index.sort(spike_clusters)))
+
+	restricted = spike_index.restrict(2, 6)
+	expected = utils.SpikeIndex(spike_clusters[2:6], spike_index.total_units)
+
+	assert(np.array_equal(restricted.counts, expected.counts))
+	assert(np.array_equal(restricted.order, expected.order))
+	assert(np.array_equal(restricted.cluster_ids, expected.cluster_ids))
+
+def test_cluster_template_counts():
+
+	rng = np.random.RandomState(0)
+
+	spike_clusters = rng.randint(0, 20, 5000)
+	spike_clusters[spike_clusters == 4] = 5   # unit without spikes
+	spike_templates = rng.randint(0, 30, 5000)
+	spike_templates[spike_clusters == 7] = 3
+
+	template_counts = utils.ClusterTemplateCounts(spike_clusters, spike_templates)
+
+	# the same counts, added in blocks
+	in_blocks = utils.ClusterTemplateCounts()
+	for start in range(0, 5000, 700):
+		in_blocks.add(spike_clusters[start:start + 700], spike_templates[start:start + 700], block_size = 300)
+
+	expected = [np.argmax(np.bincount(spike_templates[spike_clusters == c])) if c != 4 else -1 for c in range(20)]
+
+	assert(np.array_equal(template_counts.majority_templates(), expected))
+	assert(np.array_equal(in_blocks.majority_templates(), expected))
+	assert(np.array_equal(template_counts.spike_counts(), np.bincount(spike_clusters)))
+	assert(np.array_equal(template_counts.cluster_ids(), np.unique(spike_clusters)))
+	assert(template_counts.purity()[7] == 1.0)
+	assert(np.isnan(template_counts.purity()[4]))
+
+def test_channel_index():
+
+	rng = np.random.RandomState(0)
+
+	channel_pos = np.column_stack((np.tile([0, 32], 8), np.repeat(np.arange(8) * 20, 2)))
+	pc_feature_ind = rng.randint(0, 14, (10, 4))
+	pc_feature_ind[3, :] = 2   # channel listed more than once for a template
+	template_ids = rng.randint(0, 10, 25)
+	template_ids[[4, 7]] = 35   # units without a template
+
+	channel_index = utils.ChannelIndex(pc_feature_ind, channel_pos, template_ids)
+
+	for channel in range(16):
+
+		templates = np.unravel_index(np.where(pc_feature_ind.flatten() == channel)[0], pc_feature_ind.shape)[0]
+		units = np.concatenate([np.where(template_ids == j)[0] for j in templates] + [np.zeros((0,), dtype = 'int')])
+		distances = np.sqrt(np.sum(np.square(channel_pos - channel_pos[channel]), 1))
+
+		assert(np.array_equal(channel_index.templates_for(channel), templates))
+		assert(np.array_equal(channel_index.units_for(channel), units))
+		assert(np.allclose(channel_index.distances[channel], distances))
+		assert(np.array_equal(channel_index.channels_within(channel, 40), np.where(distances < 40)[0]))
+
+def test_memmapped_rows(tmp_path):
+
+	data = np.arange(4000, dtype = 'float32').reshape((500, 2, 4))
+	filename = str(tmp_path / 'features.npy')
+	np.save(filename, data)
+
+	features = np.load(filename, mmap_mode = 'r')
+	mask = np.arange(500) % 3 == 0
+
+	assert(np.array_equal(utils.gather_rows(features, mask, chunk_bytes = 100), data[mask]))
+
+	# a contiguous block of rows stays a memory-mapped view
+	block = utils.select_rows(features, (np.arange(500) >= 100) * (np.arange(500) < 200))
+	assert(isinstance(block, np.memmap))
+	assert(np.array_equal(block, data[100:200]))
+
+	written = utils.write_rows(str(tmp_path / 'subset.npy'), features, mask, chunk_bytes = 100)
+	assert(np.array_equal(written, data[mask]))
+
+	shm, spec = utils.share_array(block)
+	assert(shm is None)
+	assert(np.array_equal(utils.attach_shared_array(spec)[1], data[100:200]))
+
+	# a plain slice does not know its own offset in the file, so it is copied
+	shm, spec = utils.share_array(features[100:200])
+	assert(shm is not None)
+	view_shm, view = utils.attach_shared_array(spec)
+	assert(np.array_equal(view, data[100:200]))
+	del view
+	view_shm.close()
+	shm.close()
+	shm.unlink()
+
+def test_scatter_pcs_to_channels():
+
+	rng = np.random.RandomState(0)
+
+	pc_features = rng.normal(size = (200, 3, 4))
+	pc_feature_ind = np.array([[0, 1, 2, 3], [4, 5, 6, 7], [7, 6, 5, 4], [2, 3, 4, 5]])
+	spike_templates = rng.randint(0, 4, 200)
+	spike_inds = rng.permutation(200)[:50]
+
+	max_channel = np.max(pc_feature_ind)
+	expected = np.zeros((50, max_channel * 3 + 1))
+
+	for idx, i in enumerate(spike_inds):
+		channels = pc_feature_ind[spike_templates[i], :]
+		for j in range(3):
+			expected[idx, channels + max_channel * j] = pc_features[i, j, :]
+
+	all_pcs = utils.scatter_pcs_to_channels(pc_features, spike_templates, pc_feature_ind, spike_inds)
+	sparse_pcs = utils.scatter_pcs_to_channels(pc_features, spike_templates, pc_feature_ind, spike_inds, sparse = True)
+
+	assert(np.array_equal(all_pcs, expected))
+	assert(np.array_equal(sparse_pcs.toarray(), expected))
+
+def test_write_read_metrics(tmp_path):
+
+	filename = str(tmp_path / 'metrics.csv')
+	feather_file = utils.metrics_feather_file(filename)
+
+	metrics = pd.DataFrame({'cluster_id' : np.arange(5), 'firing_rate' : np.linspace(0, 1, 5),
+							'epoch_name' : ['complete_session'] * 5})
+
+	utils.write_metrics(metrics, filename, write_feather = True)
+
+	assert(os.path.exists(filename))
+	assert(utils.read_metrics(filename).equals(metrics))
+
+	if os.path.exists(feather_file):   # pyarrow is installed
+		assert(pd.read_feather(feather_file).dtypes.equals(metrics.dtypes))
+
+	# a CSV-only rewrite removes the older Feather copy
+	utils.write_metrics(metrics.iloc[:3], filename)
+
+	assert(not os.path.exists(feather_file))
+	assert(utils.read_metrics(filename).equals(metrics.iloc[:3]))
@@ -0,0 +1,20 @@
+import numpy as np
+
+from ecephys_spike_sorting.modules.kilosort_postprocessing.postprocessing import align_spike_times
+import ecephys_spike_sorting.common.synthetic as synthetic
+
+
+def test_align_spike_times_python_engine(tmp_path):
+
+	# synthetic spike times are on the trough of each unit's waveform
+	manifest = synthetic.make_kilosort_output(str(tmp_path), num_units = 6, duration = 10.0, num_channels = 32, 
+											  mean_firing_rate = 10.0, write_lfp = False, seed = 2)
+
+	spike_times = np.load(str(tmp_path / 'spike_times.npy'))
+	spike_clusters = np.load(str(tmp_path / 'spike_clusters.npy'))
+
+	aligned = align_spike_times(spike_times.copy(), spike_clusters, manifest['ap_band_file'], str(tmp_path), None,
+								engine = 'python', num_channels = 32, bit_volts = manifest['bit_volts'])
+
+	assert(np.bincount(spike_clusters).min() > 10)
+	assert(np.array_equal(aligned, spike_times))
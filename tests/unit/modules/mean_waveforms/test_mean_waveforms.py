@@ -1,12 +1,17 @@
 import pytest
 import numpy as np
+import pandas as pd
 import os
 
-from ecephys_spike_sorting.modules.mean_waveforms.extract_waveforms import extract_waveforms
+from ecephys_spike_sorting.modules.mean_waveforms.extract_waveforms import extract_waveforms, WaveformAccumulator, \
+    accumulate_waveforms, extract_waveforms_parallel, group_ranges, unit_metrics_task, unit_metrics
+from ecephys_spike_sorting.modules.mean_waveforms.waveform_metrics import calculate_waveform_metrics, calculate_snr, \
+    waveform_metric_row, WaveformMetricsTable, snr_from_moments, calculate_waveform_metrics_batch
 import ecephys_spike_sorting.common.utils as utils
 
 DATA_DIR = os.environ.get('ECEPHYS_SPIKE_SORTING_DATA', False)
 
+
 def test_extract_waveforms():
 
     sample_rate = 30000.0
@@ -29,4 +34,178 @@ def test_extract_waveforms():
     
     data, spike_counts, coords, labels = extract_waveforms(data, spike_times, spike_clusters, cluster_ids, cluster_quality, bit_volts, sample_rate, params)
 
-    print(labels)
\ No newline at end of file
+    print(labels)
+
+
+def test_waveform_metrics_table():
+
+    rng = np.random.RandomState(0)
+
+    site_x = np.tile([43, 11, 59, 27], 8)
+    site_y = np.repeat(np.arange(16) * 20, 2)
+    t = np.arange(82)
+
+    table = WaveformMetricsTable(4)
+    expected = []
+
+    for cluster_id in range(3):
+
+        peak_channel = 4 + 8 * cluster_id
+        spike = -np.exp(-0.5 * np.square((t - 20) / 2.0)) + 0.3 * np.exp(-0.5 * np.square((t - 32) / 6.0))
+        decay = np.exp(-np.abs(np.arange(32) - peak_channel) / 3.0)
+        waveforms = 80 * decay[np.newaxis, :, np.newaxis] * spike + rng.normal(0, 5, (20, 32, 82))
+
+        metrics = calculate_waveform_metrics(waveforms, cluster_id, peak_channel, np.arange(32), 30000.0,
+                                             200 / 82, 0.12, 16, 20e-6, site_x, site_y, 'complete_session')
+        expected.append(metrics)
+
+        table.append(waveform_metric_row(np.nanmean(waveforms, 0), calculate_snr(waveforms[:, peak_channel, :]), cluster_id, 
+                                         peak_channel, 'complete_session', 30000.0, 200 / 82, 0.12, 16, site_x, site_y))
+
+    expected = pd.concat(expected)
+
+    assert(table.to_dataframe().to_csv(index=False) == expected.to_csv(index=False))
+
+
+def test_snr_from_moments():
+
+    rng = np.random.RandomState(1)
+
+    W = np.sin(np.arange(82) / 8.0) * 50 + rng.normal(0, 10, (40, 82))
+
+    assert(np.isclose(snr_from_moments(np.mean(W, 0), np.std(W, 0)), calculate_snr(W)))
+
+
+def test_extract_waveforms_single_sweep():
+
+    rng = np.random.RandomState(2)
+
+    num_channels = 16
+    params = {'samples_per_spike' : 82, 'pre_samples' : 20, 'num_epochs' : 1, 'spikes_per_epoch' : 10,
+              'upsampling_factor' : 200 / 82, 'spread_threshold' : 0.12, 'site_range' : 16,
+              'chunk_size_mb' : 0.01}
+
+    data = rng.randint(-200, 200, (30000, num_channels)).astype('int16')
+    spike_times = np.sort(rng.randint(0, 30000, 600)).astype('uint64')
+    spike_clusters = rng.randint(0, 5, 600)
+    templates = rng.normal(0, 1, (5, 82, num_channels))
+    site_x = np.tile([43, 11, 59, 27], 4)
+    site_y = np.repeat(np.arange(8) * 20, 2)
+
+    np.random.seed(0)
+    mean_waveforms, spike_count, coords, labels, metrics = extract_waveforms(data, spike_times, spike_clusters, templates,
+        np.arange(num_channels), 0.195, 30000.0, 20e-6, site_x, site_y, params)
+
+    # reference: the same spikes, read one at a time
+    np.random.seed(0)
+
+    for cluster_idx in range(5):
+
+        times = spike_times[spike_clusters == cluster_idx].astype('int64')
+        np.random.shuffle(times)
+        times = times[:10]
+        times = times[(times >= 20) * (times + 62 <= 30000)]
+
+        waveforms = np.array([data[t - 20:t + 62, :].T * 0.195 for t in times])
+        mean = np.mean(waveforms, 0)
+
+        assert(spike_count[cluster_idx, 0] == min(10, np.sum(spike_clusters == cluster_idx)))
+        assert(np.allclose(mean_waveforms[cluster_idx, 0, 0], mean - mean[:, :1]))
+        assert(np.allclose(mean_waveforms[cluster_idx, 0, 1], np.std(waveforms, 0)))
+
+    assert(metrics.shape[0] == 5)
+
+
+def test_waveform_accumulator():
+
+    rng = np.random.RandomState(3)
+
+    snippets = rng.randint(-300, 300, (200, 82, 8)).astype('int16') + 1000
+    groups = rng.randint(0, 4, 200)
+
+    for dtype, tolerance in (('float64', 1e-9), ('float32', 1e-3)):
+
+        accumulator = WaveformAccumulator(5, 82, 8, dtype)
+
+        for start, end in ((0, 1), (1, 70), (70, 71), (71, 200)):
+            accumulator.add(groups[start:end], snippets[start:end])
+
+        mean, std = accumulator.mean_std(0.195)
+
+        assert(accumulator.mean.dtype == dtype)
+        assert(np.all(np.isnan(mean[4])) and np.all(np.isnan(std[4])))
+
+        for group in range(4):
+            expected = snippets[groups == group].transpose(0, 2, 1) * 0.195
+            assert(accumulator.count[group] == expected.shape[0])
+            assert(np.allclose(mean[group], np.mean(expected, 0), rtol = tolerance))
+            assert(np.allclose(std[group], np.std(expected, 0), rtol = tolerance))
+
+
+def test_extract_waveforms_parallel(tmp_path):
+
+    rng = np.random.RandomState(4)
+
+    data = np.memmap(str(tmp_path / 'continuous.dat'), dtype = 'int16', mode = 'w+', shape = (40000, 8))
+    data[:] = rng.randint(-200, 200, data.shape)
+    data.flush()
+
+    starts = np.sort(rng.randint(0, 40000 - 82, 300))
+    groups = rng.randint(0, 6, 300)
+
+    site_x = np.tile([43, 11, 59, 27], 2)
+    site_y = np.repeat(np.arange(4) * 20, 2)
+    metric_args = (30000.0, 200 / 82, 0.12, 16, site_x, site_y, None)
+    units = [(group, group, group % 8, 'complete_session') for group in range(6)]
+
+    ranges = group_ranges(groups, 6, 4)
+    assert(ranges[0][0] == 0 and ranges[-1][1] == 6 and all(a[1] == b[0] for a, b in zip(ranges[:-1], ranges[1:])))
+
+    accumulator = accumulate_waveforms(data, starts, groups, 6, 82, chunk_bytes = 10000)
+    mean, std = accumulator.mean_std(0.195)
+    metrics = unit_metrics(unit_metrics_task(mean, std, units), metric_args)
+
+    for raw_data in (np.memmap(str(tmp_path / 'continuous.dat'), dtype = 'int16', mode = 'r', shape = (40000, 8)), np.array(data)):
+
+        parallel_mean, parallel_std, parallel_metrics = extract_waveforms_parallel(raw_data, starts, groups, 6, 82, 10000, 'float64', 
+                                                                                   0.195, units, metric_args, 3)
+
+        assert(np.allclose(parallel_mean, mean))
+        assert(np.allclose(parallel_std, std))
+        assert(np.array_equal(parallel_metrics['cluster_id'], metrics['cluster_id']))
+        assert(np.allclose(parallel_metrics.iloc[:, 3:].astype(float), metrics.iloc[:, 3:].astype(float), equal_nan = True))
+
+
+def test_calculate_waveform_metrics_batch():
+
+    rng = np.random.RandomState(6)
+
+    site_x = np.tile([43, 11, 59, 27], 8).astype('float')
+    site_y = np.repeat(np.arange(16) * 20, 2).astype('float')
+    distances = utils.channel_distances(np.column_stack((site_x, site_y)))
+
+    t = np.arange(82)
+    peak_channels = rng.randint(0, 32, 40)
+    mean_waveforms = rng.randn(40, 32, 82)
+
+    for unit, peak_channel in enumerate(peak_channels):
+        amplitude = np.exp(-np.abs(site_y - site_y[peak_channel]) / 40) * rng.uniform(20, 100) * rng.choice([-1, 1])
+        shape = rng.uniform(0.1, 1.5) * np.exp(-np.square(t - 30) / 30) - np.exp(-np.square(t - 20) / 8)
+        mean_waveforms[unit] += amplitude[:, np.newaxis] * shape
+
+    snr = rng.uniform(1, 10, 40)
+    metric_args = (30000.0, 200 / 82, 0.12, 16, site_x, site_y, distances)
+
+    metrics = calculate_waveform_metrics_batch(mean_waveforms, peak_channels, snr, np.arange(40) + 100, 'complete_session', *metric_args)
+
+    table = WaveformMetricsTable(40)
+    for unit in range(40):
+        table.append(waveform_metric_row(mean_waveforms[unit], snr[unit], unit + 100, peak_channels[unit], 'complete_session', *metric_args))
+    expected = table.to_dataframe()
+
+    assert(list(metrics.columns) == list(expected.columns))
+    assert(all(metrics.dtypes == expected.dtypes))
+    assert(np.array_equal(metrics.iloc[:, :3], expected.iloc[:, :3]))
+    assert(np.allclose(metrics.iloc[:, 3:].astype(float), expected.iloc[:, 3:].astype(float), rtol = 1e-9, equal_nan = True))
+
+    assert(calculate_waveform_metrics_batch(mean_waveforms[:0], [], [], [], 'complete_session', *metric_args).shape == (0, 13))
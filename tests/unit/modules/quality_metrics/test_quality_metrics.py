@@ -3,7 +3,10 @@ import numpy as np
 import os
 
 from ecephys_spike_sorting.modules.quality_metrics.metrics import calculate_metrics
+from ecephys_spike_sorting.modules.quality_metrics.streaming import calculate_metrics_streaming
+import ecephys_spike_sorting.modules.quality_metrics.metrics as metrics
 import ecephys_spike_sorting.common.utils as utils
+from ecephys_spike_sorting.common.epoch import Epoch
 
 DATA_DIR = os.environ.get('ECEPHYS_SPIKE_SORTING_DATA', False)
 
@@ -31,6 +34,546 @@ def te_st_quality_metrics():
 
 	print(metrics)
 
+def make_spike_train(num_units = 20, num_spikes = 20000, duration = 300.0, seed = 0):
+
+	rng = np.random.RandomState(seed)
+
+	spike_clusters = rng.randint(0, num_units, num_spikes)
+	spike_clusters[spike_clusters == 3] = 4   # leave one unit empty
+	spike_times = np.sort(rng.uniform(0, duration, num_spikes))
+
+	# add near-duplicate spikes
+	duplicates = rng.choice(num_spikes, 500, replace = False)
+	spike_times = np.concatenate((spike_times, spike_times[duplicates] + 0.0001))
+	spike_clusters = np.concatenate((spike_clusters, spike_clusters[duplicates]))
+	order = np.argsort(spike_times, kind = 'stable')
+
+	return spike_times[order], spike_clusters[order]
+
+
+def test_spike_train_metrics():
+
+	spike_times, spike_clusters = make_spike_train()
+	total_units = np.max(spike_clusters) + 1
+
+	firing_rate, presence_ratio, isi_viol, num_viol = \
+		metrics.calculate_spike_train_metrics(spike_times, spike_clusters, total_units, 0.0015, 0.000166)
+
+	expected_viol, expected_num_viol = metrics.calculate_isi_violations(spike_times, spike_clusters, total_units, 0.0015, 0.000166)
+
+	assert(np.allclose(firing_rate, metrics.calculate_firing_rate(spike_times, spike_clusters, total_units)))
+	assert(np.allclose(presence_ratio, metrics.calculate_presence_ratio(spike_times, spike_clusters, total_units)))
+	assert(np.allclose(isi_viol, expected_viol))
+	assert(np.array_equal(num_viol, expected_num_viol))
+
+def ccg_reference(st1, st2, nbins, tbin, auto):
+
+	# original Kilosort2 walk over both spike trains, kept to check the vectorized ccg
+	st1 = np.sort(np.squeeze(st1))
+	st2 = np.sort(np.squeeze(st2))
+
+	dt = nbins*tbin  # cross correlogram spans -dt-dt
+
+	T = max(np.max(st1),np.max(st2)) - min(np.min(st1),np.min(st2))
+
+	ilow = 0
+	ihigh = 0
+	j = 0
+
+	n_st2 = len(st2)
+	n_st1 = len(st1)
+
+	K = np.zeros((2*nbins+1,))
+
+	while j < n_st2:                      # walk over all spikes in 2nd spike train
+		while (ihigh < n_st1) and (st1[ihigh] < st2[j]+dt):
+			ihigh = ihigh + 1             # increase upper bound until its outisde the dt range
+		while (ilow < n_st1) and (st1[ilow] <= st2[j]-dt):
+			ilow = ilow + 1                # increase lower bound until it is inside the dt range
+		if ilow > n_st1:
+			break
+		if st1[ilow] > st2[j] + dt:
+			j = j + 1
+			continue
+		for k in range(ilow,ihigh):
+			ibin = int(np.round((st2[j]-st1[k])/tbin))    # calculate which bin
+			K[ibin + nbins] = K[ibin + nbins] + 1    # increment corresponding bin in correlogram
+		j = j + 1   # go to next spike in st2
+
+	if auto:
+		K[nbins] = K[nbins] - n_st1     # remove "self found" spikes from
+
+	irange1 = np.concatenate((np.arange(1, int(nbins/2)), np.arange(int(3/2*nbins), 2*nbins-1)),0) # this index range corresponds to the CCG shoulders, excluding end bins
+	irange2 = np.arange(nbins-50, nbins-10)  # 40 channels to negative side of peak
+	irange3 = np.arange(nbins+10, nbins+50)  # 40 channels to positive side of peak
+
+	mean_firing_rate = (n_st2)/T
+	Q00 = (sum(K[irange1])/(n_st1 * tbin * len(irange1)))/mean_firing_rate
+	Q01_neg = (sum(K[irange2])/(n_st1 * tbin * len(irange2)))/mean_firing_rate
+	Q01_pos = (sum(K[irange3])/(n_st1 * tbin * len(irange3)))/mean_firing_rate
+	Q01 = max(Q01_neg, Q01_pos)
+
+	R00 = max(np.mean(K[irange2]), np.mean(K[irange3])) # Larger of the two shoulders near t = 0
+	R00 = max(R00, np.mean(K[irange1])) # compare this to the asymptotic shoulder
+
+	Qi = np.zeros((11,))
+	Ri = np.zeros((11,))
+	for i in range(1,11):
+		irange = np.arange(nbins-i,nbins+i)
+		Qi[i] = (sum(K[irange])/(n_st1 * (2*i+1)*tbin))/mean_firing_rate    #rate in this time period/mean rate
+
+	return K, Qi, Q00, Q01, Ri
+
+
+def test_ccg():
+
+	spike_times, spike_clusters = make_spike_train(num_units = 5, num_spikes = 6000, duration = 60.0)
+
+	for cluster_id in [0, 1, 2]:
+
+		st = spike_times[spike_clusters == cluster_id]
+
+		K, Qi, Q00, Q01, Ri = metrics.ccg(st, st, 500, 0.001, True)
+		K_ref, Qi_ref, Q00_ref, Q01_ref, Ri_ref = ccg_reference(st, st, 500, 0.001, True)
+
+		assert(np.array_equal(K, K_ref))
+		assert(np.array_equal(Qi, Qi_ref))
+		assert(Q00 == Q00_ref)
+		assert(Q01 == Q01_ref)
+
+	# small block size forces the pairs to be binned in several passes
+	st1 = spike_times[spike_clusters == 0]
+	st2 = spike_times[spike_clusters == 1]
+
+	assert(np.array_equal(metrics.ccg_histogram(st1, st2, 100, 0.001, max_pairs = 50), metrics.ccg_histogram(st1, st2, 100, 0.001)))
+
+
+def test_calculate_acgs():
+
+	spike_times, spike_clusters = make_spike_train(num_units = 5, num_spikes = 6000, duration = 60.0)
+	total_units = np.max(spike_clusters) + 1
+
+	acgs = metrics.calculate_acgs(spike_times, spike_clusters, total_units, 500, 0.001)
+
+	for cluster_id in range(total_units):
+
+		st = spike_times[spike_clusters == cluster_id]
+
+		if st.size > 0:
+			assert(np.array_equal(acgs[cluster_id, :], metrics.ccg(st, st, 500, 0.001, True)[0]))
+		else:
+			assert(np.all(acgs[cluster_id, :] == 0))
+
+
+def make_pc_features(spike_clusters, num_channels = 32, num_features = 8, seed = 0):
+
+	rng = np.random.RandomState(seed)
+
+	total_units = np.max(spike_clusters) + 1
+
+	channel_pos = np.zeros((num_channels, 2))
+	channel_pos[:, 0] = np.tile([0, 32], num_channels // 2)
+	channel_pos[:, 1] = np.repeat(np.arange(num_channels // 2) * 20, 2)
+
+	# one template per unit, with pcs on the channels closest to its peak
+	peak_channels = rng.randint(0, num_channels, total_units)
+	pc_feature_ind = np.zeros((total_units, num_features), dtype = 'uint32')
+
+	for unit in range(total_units):
+		chan_dist = np.sqrt(np.sum(np.square(channel_pos - channel_pos[peak_channels[unit]]), 1))
+		pc_feature_ind[unit, :] = np.argsort(chan_dist, kind = 'stable')[:num_features]
+
+	pc_features = rng.normal(size = (spike_clusters.size, 3, num_features)).astype('float32')
+	pc_features[:, 0, 0] += 5 + spike_clusters % 7
+
+	return pc_features, pc_feature_ind, channel_pos
+
+
+def test_pc_metrics_parallel():
+
+	spike_times, spike_clusters = make_spike_train(num_units = 12, num_spikes = 8000)
+	total_units = np.max(spike_clusters) + 1
+	spike_templates = spike_clusters.copy()
+
+	pc_features, pc_feature_ind, channel_pos = make_pc_features(spike_clusters)
+
+	cluster_ids = np.unique(spike_clusters)
+	template_ids = np.arange(total_units, dtype = 'uint16')
+
+	args = (spike_clusters, spike_templates, total_units, cluster_ids, template_ids,
+			pc_features, pc_feature_ind, channel_pos, 68, 200, 2000, 4)
+
+	serial = metrics.calculate_pc_metrics(*args, num_workers = 1, seed = 7)
+	parallel = metrics.calculate_pc_metrics(*args, num_workers = 3, seed = 7)
+
+	assert(np.any(np.isfinite(serial[0])))
+
+	for expected, result in zip(serial, parallel):
+		assert(np.array_equal(expected, result, equal_nan = True))
+
+
+def test_pc_metrics_nn_modes():
+
+	spike_times, spike_clusters = make_spike_train(num_units = 12, num_spikes = 8000)
+	total_units = np.max(spike_clusters) + 1
+	spike_templates = spike_clusters.copy()
+
+	pc_features, pc_feature_ind, channel_pos = make_pc_features(spike_clusters)
+
+	cluster_ids = np.unique(spike_clusters)
+	template_ids = np.arange(total_units, dtype = 'uint16')
+
+	args = (spike_clusters, spike_templates, total_units, cluster_ids, template_ids,
+			pc_features, pc_feature_ind, channel_pos, 68, 200, 2000, 4)
+
+	ball_tree = metrics.calculate_pc_metrics(*args, seed = 7)
+	kd_tree = metrics.calculate_pc_metrics(*args, seed = 7, nn_algorithm = 'kd_tree')
+
+	for expected, result in zip(ball_tree, kd_tree):
+		assert(np.allclose(expected, result, equal_nan = True))
+
+	serial = metrics.calculate_pc_metrics(*args, seed = 7, nn_mode = 'neighbourhood')
+	parallel = metrics.calculate_pc_metrics(*args, num_workers = 3, seed = 7, nn_mode = 'neighbourhood')
+
+	for expected, result in zip(serial, parallel):
+		assert(np.array_equal(expected, result, equal_nan = True))
+
+	# only the nearest-neighbor rates come from the shared graphs
+	for expected, result in zip(ball_tree[:3], serial[:3]):
+		assert(np.array_equal(expected, result, equal_nan = True))
+
+	computed = np.isfinite(ball_tree[3])
+	assert(np.array_equal(computed, np.isfinite(serial[3])))
+	assert(np.all(np.abs(ball_tree[3][computed] - serial[3][computed]) < 0.2))
+
+
+def test_memmapped_pc_features(tmp_path):
+
+	spike_times, spike_clusters = make_spike_train(num_units = 8, num_spikes = 4000, duration = 120.0)
+	spike_templates = spike_clusters.copy()
+	amplitudes = np.random.RandomState(1).gamma(5, 3, spike_times.size)
+
+	pc_features, pc_feature_ind, channel_pos = make_pc_features(spike_clusters)
+
+	filename = str(tmp_path / 'pc_features.npy')
+	np.save(filename, pc_features)
+
+	params = {'isi_threshold' : 0.0015, 'min_isi' : 0.000166, 'tbin_sec' : 0.001, 'max_radius_um' : 68,
+			  'max_spikes_for_unit' : 200, 'max_spikes_for_nn' : 2000, 'n_neighbors' : 4, 'n_silhouette' : 1000,
+			  'drift_metrics_interval_s' : 30, 'drift_metrics_min_spikes_per_interval' : 10, 'include_pcs' : True,
+			  'pc_metrics_seed' : 3}
+
+	epochs = [Epoch('first_half', 0, 60), Epoch('complete_session', 0, np.inf)]
+
+	np.random.seed(0)
+	expected = calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes, np.arange(32), 
+								 channel_pos, None, pc_features, pc_feature_ind, params, epochs)
+	np.random.seed(0)
+	result = calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes, np.arange(32), 
+							   channel_pos, None, np.load(filename, mmap_mode = 'r'), pc_feature_ind, params, epochs)
+
+	assert(expected.equals(result))
+
+
+def test_pairwise_silhouette_scores():
+
+	from sklearn.metrics import silhouette_score
+
+	rng = np.random.RandomState(0)
+
+	labels = rng.randint(0, 6, 300)
+	labels[:2] = 6   # a cluster with only two samples
+	labels[2] = 7    # and one with a single sample
+	X = rng.normal(size = (300, 5)) + labels[:, np.newaxis]
+	X[10, :] = X[11, :]   # duplicate points give a = b = 0 in a pair
+
+	cluster_ids, label_index, counts = np.unique(labels, return_inverse = True, return_counts = True)
+
+	pair_scores = metrics.pairwise_silhouette_scores(X, label_index, counts)
+
+	for i in range(cluster_ids.size):
+		for j in range(i + 1, cluster_ids.size):
+			inds = (label_index == i) + (label_index == j)
+			if np.sum(inds) > 2:
+				assert(np.isclose(pair_scores[i, j], silhouette_score(X[inds, :], labels[inds])))
+
+
+def test_grouped_median_depths():
+
+	spike_times, spike_clusters = make_spike_train(num_units = 6, num_spikes = 5000, duration = 100.0)
+	total_units = np.max(spike_clusters) + 1
+
+	rng = np.random.RandomState(2)
+	depths = rng.uniform(0, 3840, spike_times.size)
+	depths[rng.choice(spike_times.size, 5, replace = False)] = np.nan
+
+	interval_starts = np.arange(np.min(spike_times), np.max(spike_times), 7.0)
+	interval_ends = interval_starts + 7.0
+
+	# spikes exactly on an interval start are excluded
+	spike_times[100] = interval_starts[2]
+
+	median_depths = metrics.grouped_median_depths(spike_times, spike_clusters, depths, total_units, 
+												  interval_starts, interval_ends, 10)
+
+	for cluster_id in range(total_units):
+		for idx, (t1, t2) in enumerate(zip(interval_starts, interval_ends)):
+			in_range = (spike_clusters == cluster_id) * (spike_times > t1) * (spike_times < t2)
+			if np.sum(in_range) >= 10:
+				assert(np.array_equal(median_depths[cluster_id, idx], np.median(depths[in_range]), equal_nan = True))
+			else:
+				assert(np.isnan(median_depths[cluster_id, idx]))
+
+
+def test_mahalanobis_metrics():
+
+	from scipy.spatial.distance import cdist
+	from scipy.stats import chi2
+
+	rng = np.random.RandomState(0)
+
+	all_labels = rng.randint(0, 5, 2000)
+	all_pcs = rng.normal(size = (2000, 12)) + (all_labels == 0)[:, np.newaxis]
+
+	this_unit = all_pcs[all_labels == 0, :]
+	other_units = all_pcs[all_labels != 0, :]
+	VI = np.linalg.inv(np.cov(this_unit.T))
+	distances = np.sort(cdist(np.mean(this_unit, 0)[np.newaxis, :], other_units, 'mahalanobis', VI = VI)[0])
+
+	isolation_distance, l_ratio = metrics.mahalanobis_metrics(all_pcs, all_labels, 0)
+
+	assert(np.isclose(isolation_distance, distances[this_unit.shape[0] - 1] ** 2))
+	assert(np.isclose(l_ratio, np.sum(1 - chi2.cdf(distances ** 2, 12)) / distances.size))
+
+	# a well-separated unit has a large but finite isolation distance, and a small L-ratio
+	separated_pcs = all_pcs + 5 * (all_labels == 0)[:, np.newaxis]
+	isolation_distance, l_ratio = metrics.mahalanobis_metrics(separated_pcs, all_labels, 0)
+	assert(100 < isolation_distance < 1e4 and 0 <= l_ratio < 0.01)
+
+	# features that are constant for this unit (e.g. zero-filled channels) are left out
+	constant_pcs = all_pcs.copy()
+	constant_pcs[all_labels == 0, 3] = 0.0
+	constant_pcs[all_labels == 0, 7] = 0.0
+	assert(np.allclose(metrics.mahalanobis_metrics(constant_pcs, all_labels, 0),
+					   metrics.mahalanobis_metrics(np.delete(all_pcs, [3, 7], 1), all_labels, 0)))
+
+	# a singular covariance is shrunk, giving values close to those without the redundant feature
+	duplicated_pcs = separated_pcs.copy()
+	duplicated_pcs[:, 1] = duplicated_pcs[:, 0]
+	isolation_distance, l_ratio = metrics.mahalanobis_metrics(duplicated_pcs, all_labels, 0)
+	expected_distance, expected_l_ratio = metrics.mahalanobis_metrics(np.delete(separated_pcs, 1, 1), all_labels, 0)
+	assert(np.isclose(isolation_distance, expected_distance, rtol = 0.1) and 0 <= l_ratio < 0.01)
+
+	few_labels = all_labels.copy()
+	few_labels[np.flatnonzero(all_labels == 0)[10:]] = 1
+	isolation_distance, l_ratio = metrics.mahalanobis_metrics(all_pcs, few_labels, 0)
+	assert(0 < isolation_distance < 1e3 and 0 <= l_ratio <= 1)
+
+	# only a unit whose spikes are all identical has no distances
+	few_labels[np.flatnonzero(all_labels == 0)[1:]] = 1
+	assert(np.all(np.isnan(metrics.mahalanobis_metrics(all_pcs, few_labels, 0))))
+
+
+def test_epoch_slices():
+
+	spike_times, spike_clusters = make_spike_train(num_units = 8, num_spikes = 4000, duration = 120.0)
+	spike_templates = spike_clusters.copy()
+	amplitudes = np.random.RandomState(1).gamma(5, 3, spike_times.size)
+
+	params = {'isi_threshold' : 0.0015, 'min_isi' : 0.000166, 'tbin_sec' : 0.001, 'include_pcs' : False}
+
+	epochs = [Epoch('first', 0, 40), Epoch('second', 40, 80), Epoch('rest', 80, np.inf)]
+
+	result = calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes, None, 
+							   None, None, None, None, params, epochs)
+
+	for epoch in epochs:
+
+		in_epoch = (spike_times > epoch.start_time) * (spike_times < epoch.end_time)
+
+		# compare against the same epoch computed from copies of its spikes
+		expected = calculate_metrics(spike_times[in_epoch], spike_clusters[in_epoch], spike_templates[in_epoch], 
+									 amplitudes[in_epoch], None, None, None, None, None, params, 
+									 [Epoch(epoch.name, epoch.start_time, epoch.end_time)])
+
+		rows = result[result.epoch_name == epoch.name].reset_index(drop = True)
+		rows = rows[rows.cluster_id.isin(expected.cluster_id)].reset_index(drop = True)
+
+		assert(np.allclose(rows.drop(columns = 'epoch_name').values.astype('float64'), 
+						   expected.drop(columns = 'epoch_name').values.astype('float64'), equal_nan = True))
+
+
+def test_incremental_pc_metrics():
+
+	spike_times, spike_clusters = make_spike_train(num_units = 12, num_spikes = 6000, duration = 120.0)
+	spike_templates = spike_clusters.copy()
+	amplitudes = np.random.RandomState(1).gamma(5, 3, spike_times.size)
+
+	pc_features, pc_feature_ind, channel_pos = make_pc_features(spike_clusters)
+
+	params = {'isi_threshold' : 0.0015, 'min_isi' : 0.000166, 'tbin_sec' : 0.001, 'max_radius_um' : 68,
+			  'max_spikes_for_unit' : 200, 'max_spikes_for_nn' : 2000, 'n_neighbors' : 4, 'n_silhouette' : 1000,
+			  'drift_metrics_interval_s' : 30, 'drift_metrics_min_spikes_per_interval' : 10, 'include_pcs' : True,
+			  'pc_metrics_seed' : 3}
+
+	previous_layout = {}
+	np.random.seed(0)
+	previous = calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes, np.arange(32), 
+								 channel_pos, None, pc_features, pc_feature_ind, params, pc_layout = previous_layout)
+	previous_ids, previous_fingerprints = metrics.cluster_fingerprints(spike_times, spike_clusters)
+
+	assert(list(previous_layout.keys()) == ['complete_session'])
+
+	# curation: move unit 2 to a new unit 12 (which has neighbours)
+	curated_clusters = spike_clusters.copy()
+	curated_clusters[curated_clusters == 2] = 12
+
+	cluster_ids, fingerprints = metrics.cluster_fingerprints(spike_times, curated_clusters)
+	changed = metrics.changed_clusters(previous_ids, previous_fingerprints, cluster_ids, fingerprints)
+
+	assert(np.array_equal(changed, [2, 12]))
+
+	np.random.seed(0)
+	expected = calculate_metrics(spike_times, curated_clusters, spike_templates, amplitudes, np.arange(32), 
+								 channel_pos, None, pc_features, pc_feature_ind, params)
+	np.random.seed(0)
+	result = calculate_metrics(spike_times, curated_clusters, spike_templates, amplitudes, np.arange(32), 
+							   channel_pos, None, pc_features, pc_feature_ind, params,
+							   previous_metrics = previous, changed_cluster_ids = changed, previous_pc_layout = previous_layout)
+
+	assert(np.allclose(expected.drop(columns = 'epoch_name').values, result.drop(columns = 'epoch_name').values, equal_nan = True))
+
+	# curation: merge unit 1 (the only neighbour of unit 0) with the larger, distant unit 4 into a new 
+	# unit 12, which takes the template of unit 4; unit 0 keeps its spikes but loses its neighbour
+	template_ids, peak_channels = previous_layout['complete_session']
+	neighbours, channels = metrics.pc_neighbourhood(peak_channels[0], template_ids, peak_channels, pc_feature_ind, channel_pos, 68)
+	assert(np.array_equal(neighbours, [0, 1]))
+
+	merged_clusters = spike_clusters.copy()
+	merged_clusters[np.isin(merged_clusters, [1, 4])] = 12
+
+	cluster_ids, fingerprints = metrics.cluster_fingerprints(spike_times, merged_clusters)
+	changed = metrics.changed_clusters(previous_ids, previous_fingerprints, cluster_ids, fingerprints)
+
+	assert(np.array_equal(changed, [1, 4, 12]))
+
+	layout = {}
+	np.random.seed(0)
+	expected = calculate_metrics(spike_times, merged_clusters, spike_templates, amplitudes, np.arange(32), 
+								 channel_pos, None, pc_features, pc_feature_ind, params, pc_layout = layout)
+
+	template_ids, peak_channels = layout['complete_session']
+	units = metrics.units_to_recompute(changed, cluster_ids, template_ids, peak_channels, pc_feature_ind, channel_pos, 68,
+									   *previous_layout['complete_session'])
+	assert(0 in units)
+
+	np.random.seed(0)
+	result = calculate_metrics(spike_times, merged_clusters, spike_templates, amplitudes, np.arange(32), 
+							   channel_pos, None, pc_features, pc_feature_ind, params,
+							   previous_metrics = previous, changed_cluster_ids = changed, previous_pc_layout = previous_layout)
+
+	assert(np.allclose(expected.drop(columns = 'epoch_name').values, result.drop(columns = 'epoch_name').values, equal_nan = True))
+
+
+def test_metrics_to_compute():
+
+	spike_times, spike_clusters = make_spike_train(num_units = 8, num_spikes = 4000, duration = 120.0)
+	spike_templates = spike_clusters.copy()
+	amplitudes = np.random.RandomState(1).gamma(5, 3, spike_times.size)
+
+	params = {'isi_threshold' : 0.0015, 'min_isi' : 0.000166, 'tbin_sec' : 0.001, 'include_pcs' : True,
+			  'metrics_to_compute' : ['amplitude_cutoff', 'firing_rate', 'isi_viol']}
+
+	assert(metrics.required_inputs(params['metrics_to_compute']) == {'times', 'amplitudes'})
+	assert('pcs' in metrics.required_inputs(['firing_rate', 'd_prime']))
+
+	# no PC features are needed for these metrics
+	result = calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes, None, 
+							   None, None, None, None, params)
+
+	assert(list(result.columns) == ['cluster_id', 'firing_rate', 'isi_viol', 'amplitude_cutoff', 'epoch_name'])
+
+	params['include_pcs'] = False
+	params['metrics_to_compute'] = None
+	expected = calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes, None, 
+								 None, None, None, None, params)
+
+	assert(expected[result.columns].equals(result))
+
+	with pytest.raises(ValueError):
+		metrics.metric_columns(['firing_rate', 'snr'])
+
+
+def test_streaming_metrics():
+
+	spike_times, spike_clusters = make_spike_train(num_units = 12, num_spikes = 6000, duration = 120.0)
+	rng = np.random.RandomState(2)
+	spike_templates = spike_clusters.copy()
+	other = rng.rand(spike_times.size) < 0.1
+	spike_templates[other] = rng.randint(0, 12, np.sum(other))
+	amplitudes = rng.gamma(5, 3, spike_times.size).astype('float32')
+
+	pc_features, pc_feature_ind, channel_pos = make_pc_features(spike_clusters)
+
+	params = {'isi_threshold' : 0.0015, 'min_isi' : 0.000166, 'tbin_sec' : 0.001, 'max_radius_um' : 68,
+			  'max_spikes_for_unit' : 1000, 'max_spikes_for_nn' : 10000, 'n_neighbors' : 4, 'n_silhouette' : 10000,
+			  'drift_metrics_interval_s' : 30, 'drift_metrics_min_spikes_per_interval' : 10, 'include_pcs' : True,
+			  'pc_metrics_seed' : 3}
+
+	# spike times in samples, as read by load_streaming_data
+	spike_samples = np.round(spike_times * 30000.0).astype('uint64')
+	expected_times = spike_samples / 30000.0
+
+	np.random.seed(0)
+	expected = calculate_metrics(expected_times, spike_clusters, spike_templates, amplitudes, np.arange(32), 
+								 channel_pos, None, pc_features, pc_feature_ind, params)
+
+	# with room for every spike in the samples, everything matches
+	np.random.seed(0)
+	result = calculate_metrics_streaming(spike_samples, spike_clusters, spike_templates, amplitudes, channel_pos, 
+										 pc_features, pc_feature_ind, params, sample_rate = 30000.0)
+
+	assert(list(result.columns) == list(expected.columns))
+	assert(np.allclose(expected.drop(columns = 'epoch_name').values, result.drop(columns = 'epoch_name').values, equal_nan = True))
+
+	# a budget too small for one unit's histograms: blocks of 1000 spikes, and a sample of one spike per unit
+	result = calculate_metrics_streaming(spike_samples, spike_clusters, spike_templates, amplitudes, channel_pos, 
+										 pc_features, pc_feature_ind, params, sample_rate = 30000.0, memory_budget_mb = 0.05)
+
+	exact = ['cluster_id', 'firing_rate', 'presence_ratio', 'isi_viol', 'num_viol', 'amplitude_cutoff', 
+			 'contam_rate', 'max_drift', 'cumulative_drift']
+
+	assert(np.allclose(expected[exact].values, result[exact].values, equal_nan = True))
+
+	with pytest.raises(ValueError):
+		calculate_metrics_streaming(spike_samples[::-1], spike_clusters, spike_templates, amplitudes, channel_pos, 
+									pc_features, pc_feature_ind, params, sample_rate = 30000.0)
+
+
+def test_amplitude_cutoff():
+
+	spike_times, spike_clusters = make_spike_train(num_units = 12, num_spikes = 6000, duration = 120.0)
+	rng = np.random.RandomState(1)
+
+	for dtype in ('float32', 'float64'):
+
+		amplitudes = rng.gamma(5, 3, spike_times.size).astype(dtype)
+		amplitudes[spike_clusters == 5] = 2.5   # all amplitudes equal
+		amplitudes[np.where(spike_clusters == 6)[0][1:]] = 0
+		spike_clusters[np.where(spike_clusters == 6)[0][1:]] = 7   # single spike
+
+		result = metrics.calculate_amplitude_cutoff(spike_clusters, amplitudes, 12)
+
+		expected = np.zeros((12,))
+		for cluster_id in np.unique(spike_clusters):
+			expected[cluster_id] = metrics.amplitude_cutoff(amplitudes[spike_clusters == cluster_id])
+
+		assert(np.array_equal(result, expected))
+
+		# Kilosort saves amplitudes as a column vector
+		assert(np.array_equal(metrics.calculate_amplitude_cutoff(spike_clusters, amplitudes[:, np.newaxis], 12), expected))
+
+
 if __name__ == "__main__":
     #test_quality_metrics()
     pass
\ No newline at end of file